@@ -0,0 +1,226 @@
+import gc
+import json
+import platform
+import sqlite3
+from collections import OrderedDict
+from statistics import median
+from time import perf_counter
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from blog.models import Author, Post
+from repeat_queries.middleware import DuplicateQueryMiddleware
+
+
+# REPEAT_QUERIES settings of each configuration, None runs the view
+# without the middleware. Warnings and logging are off so only the
+# recording itself is measured.
+CONFIGS = OrderedDict([
+    ('baseline', None),
+    ('instrumented', {
+        'STACK_MODE': 'off', 'STORE_PARAMS': False, 'STORE_PATTERNS': False,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('unsampled', {
+        'SAMPLE_RATE': 0, 'ALWAYS_RECORD_MORE_QUERIES_THAN': 10 ** 9,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('stack_frames', {
+        'STACK_MODE': 'frames', 'STORE_PARAMS': False, 'STORE_PATTERNS': False,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('stack_full', {
+        'STACK_MODE': 'full', 'STORE_PARAMS': False, 'STORE_PATTERNS': False,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('params', {
+        'STACK_MODE': 'off', 'STORE_PARAMS': True, 'STORE_PATTERNS': False,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('patterns', {
+        'STACK_MODE': 'off', 'STORE_PARAMS': False, 'STORE_PATTERNS': True,
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+    }),
+    ('persisted', {
+        'STACK_MODE': 'frames', 'STORE_PARAMS': False, 'STORE_PATTERNS': True,
+        'WRITER': 'repeat_queries.writers.SyncWriter',
+    }),
+])
+
+COMMON_CONFIG = {
+    'SAMPLE_RATES': {},
+    'MAX_RECORDED_PER_SECOND': None,
+    'N_PLUS_ONE_THRESHOLD': None,
+    'LONG_TRANSACTION_THRESHOLD': None,
+    'VERBOSITY': 0,
+    'SUMMARY_HOOKS': [],
+    'EXPLAIN': False,
+}
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def seed(size):
+    """
+    Replace the blog fixtures with ``size`` authors, each with a post.
+    """
+    Post.objects.all().delete()
+    Author.objects.all().delete()
+    Author.objects.bulk_create([
+        Author(name='author %d' % i, short_description='short', long_description='long')
+        for i in range(size)
+    ])
+    authors = list(Author.objects.order_by('pk'))
+    Post.objects.bulk_create([
+        Post(title='post %d' % i, description='description', author=author)
+        for i, author in enumerate(authors)
+    ])
+
+
+# Posts loaded by each query of the benchmark view
+PAGE_SIZE = 10
+
+
+def make_view(size, num_queries):
+    """
+    A view running ``num_queries`` queries, each loading the next page of
+    the ``size`` seeded posts, so the database walks the whole table.
+    """
+    def view(request):
+        for i in range(num_queries):
+            offset = (i * PAGE_SIZE) % size
+            list(Post.objects.order_by('pk')[offset:offset + PAGE_SIZE])
+        return HttpResponse('ok')
+    return view
+
+
+def unwrap_connection():
+    """
+    Remove the patch wrap_cursor left on the connection of this thread,
+    so the baseline runs on the plain cursor.
+    """
+    patched = connections[DEFAULT_DB_ALIAS].__dict__
+    for name in ('cursor', 'commit', 'rollback', 'custom_cursor', 'custom_commit', 'custom_rollback'):
+        patched.pop(name, None)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the overhead of DuplicateQueryMiddleware and the cursor '
+        'wrapper on the blog app, in a test database, and print the results '
+        'as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=_int_list, default=[100, 1000],
+                            help='Comma separated numbers of seeded authors and posts, '
+                                 'the view pages through all of them')
+        parser.add_argument('--queries', type=_int_list, default=[1, 100, 10000],
+                            help='Comma separated numbers of queries per request')
+        parser.add_argument('--configs', type=lambda value: value.split(','),
+                            default=list(CONFIGS),
+                            help='Comma separated configurations, among %s' % ', '.join(CONFIGS))
+        parser.add_argument('--repeat', type=int, default=10,
+                            help='Timed requests per measurement')
+        parser.add_argument('--output', help='Write the JSON to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = self.run_benchmarks(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'vendor': connection.vendor,
+            },
+            'repeat': options['repeat'],
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_benchmarks(self, options):
+        factory = RequestFactory()
+        results = []
+        for size in options['sizes']:
+            seed(size)
+            for num_queries in options['queries']:
+                view = make_view(size, num_queries)
+                timings = self.measure(options['configs'], view, factory, options['repeat'])
+                # Overheads compare the fastest runs, the least disturbed
+                # by the rest of the machine (see timeit). The first
+                # configuration, baseline by default, is the reference.
+                baseline = min(timings[options['configs'][0]])
+                for name in options['configs']:
+                    best = min(timings[name])
+                    overhead = (best - baseline) * 10 ** 6
+                    results.append(OrderedDict([
+                        ('config', name),
+                        ('fixture_size', size),
+                        ('queries', num_queries),
+                        ('best_request_us', round(best * 10 ** 6, 1)),
+                        ('median_request_us', round(median(timings[name]) * 10 ** 6, 1)),
+                        ('overhead_per_request_us', round(overhead, 1)),
+                        ('overhead_per_query_us', round(overhead / num_queries, 2)),
+                    ]))
+                    self.stderr.write('%s, %d rows, %d queries: %.1fus per request' % (
+                        name, size, num_queries, best * 10 ** 6))
+        return results
+
+    def measure(self, names, view, factory, repeat):
+        """
+        Time ``repeat`` requests per configuration. The configurations
+        without the middleware run first, on an unpatched connection, then
+        the others one after the other in each round so a slower machine
+        affects them alike.
+        """
+        plain = [name for name in names if CONFIGS[name] is None]
+        instrumented = [name for name in names if CONFIGS[name] is not None]
+        handlers = {}
+        for name in plain:
+            handlers[name] = ({}, view)
+        for name in instrumented:
+            settings = dict(COMMON_CONFIG, **CONFIGS[name])
+            with override_settings(REPEAT_QUERIES=settings):
+                # Built under its settings, the sampler reads them once
+                handlers[name] = (settings, DuplicateQueryMiddleware(view))
+
+        timings = {name: [] for name in names}
+        # The middleware patches the connection for good once it ran
+        unwrap_connection()
+        for group in (plain, instrumented):
+            for round_number in range(repeat + 1):
+                for name in group:
+                    elapsed = self.time_request(factory, *handlers[name])
+                    # the first round warms up
+                    if round_number:
+                        timings[name].append(elapsed)
+        return timings
+
+    def time_request(self, factory, settings, handler):
+        gc_enabled = gc.isenabled()
+        with override_settings(REPEAT_QUERIES=settings):
+            request = factory.get('/blog/benchmark/')
+            gc.disable()
+            try:
+                start = perf_counter()
+                handler(request)
+                return perf_counter() - start
+            finally:
+                if gc_enabled:
+                    gc.enable()
@@ -1,6 +1,47 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+from io import StringIO
 
-# Create your tests here.
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from blog.management.commands import benchmark_overhead
+from blog.models import Post
+
+
+class BenchmarkOverheadTests(TestCase):
+
+    def test_views_page_through_the_seeded_posts(self):
+        benchmark_overhead.seed(25)
+        view = benchmark_overhead.make_view(25, 3)
+        with self.assertNumQueries(3):
+            view(RequestFactory().get('/'))
+        self.assertEqual(Post.objects.count(), 25)
+
+    def test_baseline_runs_on_an_unpatched_connection(self):
+        patched = []
+
+        def view(request):
+            patched.append('custom_cursor' in connections[DEFAULT_DB_ALIAS].__dict__)
+            Post.objects.count()
+            return HttpResponse('ok')
+
+        command = benchmark_overhead.Command()
+        # Patched by an earlier measurement
+        command.measure(['instrumented'], view, RequestFactory(), 1)
+        del patched[:]
+        timings = command.measure(['instrumented', 'baseline'], view, RequestFactory(), 2)
+        self.assertEqual(patched, [False] * 3 + [True] * 3)
+        self.assertEqual(len(timings['baseline']), 2)
+        self.assertEqual(len(timings['instrumented']), 2)
+
+    def test_results(self):
+        results = benchmark_overhead.Command(stderr=StringIO()).run_benchmarks({
+            'sizes': [20], 'queries': [1, 4], 'configs': ['baseline', 'unsampled'], 'repeat': 1,
+        })
+        self.assertEqual(
+            [(row['config'], row['fixture_size'], row['queries']) for row in results],
+            [('baseline', 20, 1), ('unsampled', 20, 1), ('baseline', 20, 4), ('unsampled', 20, 4)])
+        self.assertEqual(results[0]['overhead_per_request_us'], 0)
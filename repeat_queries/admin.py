@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 from django.core.urlresolvers import reverse
-from repeat_queries.models import SQLQuery, Request
+from repeat_queries.models import QueryPattern, SQLQuery, Request, Transaction
 
 
 class SQLQueryAdmin(admin.ModelAdmin):
@@ -13,7 +13,23 @@ class SQLQueryAdmin(admin.ModelAdmin):
 
 
 class RequestAdmin(admin.ModelAdmin):
-    list_display = ['id', 'path', 'time_taken', 'view_report']
+    list_display = ['id', 'path', 'time_taken', 'sql_count', 'sql_time', 'view_report']
+    # skip the second COUNT over the whole table when filtering
+    show_full_result_count = False
+
+    # The totals are kept on the request by the recorder, including for
+    # requests whose queries were not stored, nothing is joined
+    def sql_count(self, obj):
+        return obj.num_sql_queries
+
+    sql_count.short_description = 'Queries'
+    sql_count.admin_order_field = 'num_sql_queries'
+
+    def sql_time(self, obj):
+        return obj.meta_time_spent_queries
+
+    sql_time.short_description = 'Time in SQL (ms)'
+    sql_time.admin_order_field = 'meta_time_spent_queries'
 
     def view_report(self, obj):
         tag = '<a href="%s">%s</a>'%(reverse('request_sql', kwargs={'request_id': obj.id}), 'View Report of Request')
@@ -22,5 +38,27 @@ class RequestAdmin(admin.ModelAdmin):
     view_report.allow_tags = True
 
 
+class QueryPatternAdmin(admin.ModelAdmin):
+    list_display = [
+        'view_name', 'alias', 'sample_query', 'count', 'num_requests',
+        'max_per_request', 'total_duration', 'suggestion', 'saved_queries',
+        'last_seen'
+    ]
+    list_filter = ['view_name']
+    ordering = ['-max_per_request']
+
+
+class TransactionAdmin(admin.ModelAdmin):
+    list_display = [
+        'trans_id', 'request', 'alias', 'duration', 'idle_time',
+        'num_queries', 'outcome', 'start_time'
+    ]
+    list_filter = ['alias', 'outcome']
+    list_select_related = ['request']
+    ordering = ['-duration']
+
+
 admin.site.register(Request, RequestAdmin)
 admin.site.register(SQLQuery, SQLQueryAdmin)
+admin.site.register(QueryPattern, QueryPatternAdmin)
+admin.site.register(Transaction, TransactionAdmin)
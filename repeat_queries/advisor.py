@@ -0,0 +1,240 @@
+from collections import defaultdict
+from time import time
+
+import sqlparse
+from django.apps import apps
+from django.db import connections
+from django.db.models import Count, Max, Sum
+from sqlparse import tokens as T
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.fingerprint import fingerprint
+from repeat_queries.models import SQLQuery
+
+
+# Keywords starting a clause whose columns are worth indexing
+CLAUSES = {
+    'WHERE': 'where',
+    'ON': 'join',
+    'ORDER': 'order_by',
+    'ORDER BY': 'order_by',
+}
+# Keywords ending such a clause
+CLAUSE_ENDS = {
+    'SELECT', 'FROM', 'GROUP', 'GROUP BY', 'HAVING', 'LIMIT', 'OFFSET',
+    'UNION', 'SET', 'VALUES', 'RETURNING', 'FOR',
+}
+
+
+def _name(token):
+    return token.value.strip('"`[]')
+
+
+def _is_name(token):
+    return (
+        (token.ttype in T.Name and token.ttype not in T.Name.Placeholder) or
+        token.ttype in T.String.Symbol
+    )
+
+
+def extract_columns(sql):
+    """
+    Return the set of (clause, table, column) used by ``sql`` in WHERE,
+    JOIN ... ON and ORDER BY clauses, table aliases resolved.
+    """
+    tokens = [
+        token for token in sqlparse.parse(sql)[0].flatten()
+        if not token.is_whitespace and token.ttype not in T.Comment
+    ]
+    aliases = {}
+    tables = []
+    # First pass: the tables after FROM / JOIN and their aliases
+    for index, token in enumerate(tokens):
+        keyword = ' '.join(token.value.upper().split())
+        if token.ttype in T.Keyword and (keyword == 'FROM' or keyword.endswith('JOIN')):
+            if index + 1 < len(tokens) and _is_name(tokens[index + 1]):
+                table = _name(tokens[index + 1])
+                tables.append(table)
+                aliases[table] = table
+                following = tokens[index + 2:index + 4]
+                if following and following[0].ttype in T.Keyword and following[0].value.upper() == 'AS':
+                    following = following[1:]
+                if following and _is_name(following[0]):
+                    aliases[_name(following[0])] = table
+
+    columns = set()
+    clause = None
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.ttype in T.Keyword:
+            keyword = ' '.join(token.value.upper().split())
+            if keyword in CLAUSES:
+                clause = CLAUSES[keyword]
+            elif keyword in CLAUSE_ENDS or keyword.endswith('JOIN'):
+                clause = None
+        elif clause and _is_name(token):
+            qualified = (
+                index + 2 < len(tokens) and tokens[index + 1].value == '.' and
+                _is_name(tokens[index + 2])
+            )
+            if qualified:
+                table = aliases.get(_name(token))
+                if table:
+                    columns.add((clause, table, _name(tokens[index + 2])))
+                index += 2
+            elif len(tables) == 1:
+                columns.add((clause, tables[0], _name(token)))
+        index += 1
+    return columns
+
+
+def query_shapes(queryset=None, chunk_size=2000):
+    """
+    Yield (sample sql, count, total duration) per query shape.
+
+    Rows with a fingerprint are grouped by the database, older rows
+    without one are read in primary key chunks, so the table is never
+    loaded at once.
+    """
+    queryset = SQLQuery.objects.all() if queryset is None else queryset
+    groups = (
+        queryset.exclude(fingerprint='').order_by()
+        .values('fingerprint')
+        .annotate(count=Count('id'), total=Sum('duration'), sample=Max('id'))
+    )
+    batch = []
+    for group in groups.iterator():
+        batch.append(group)
+        if len(batch) == chunk_size:
+            for shape in _with_samples(queryset, batch):
+                yield shape
+            batch = []
+    for shape in _with_samples(queryset, batch):
+        yield shape
+
+    shapes = {}
+    last_pk = 0
+    rows = queryset.filter(fingerprint='').order_by('pk').values_list('pk', 'query', 'duration')
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        for pk, sql, duration in chunk:
+            key = fingerprint(sql)[1]
+            if key not in shapes:
+                shapes[key] = [sql, 0, 0]
+            shapes[key][1] += 1
+            shapes[key][2] += duration or 0
+        last_pk = chunk[-1][0]
+    for sql, count, total in shapes.values():
+        yield sql, count, total
+
+
+def _with_samples(queryset, groups):
+    samples = dict(
+        queryset.filter(pk__in=[group['sample'] for group in groups])
+        .values_list('pk', 'query')
+    )
+    for group in groups:
+        if group['sample'] in samples:
+            yield samples[group['sample']], group['count'], group['total'] or 0
+
+
+def _indexed_columns(connection, table, cache):
+    """
+    Columns which lead an index, primary key or unique constraint, None if
+    the table does not exist.
+    """
+    if None not in cache:
+        cache[None] = set(connection.introspection.table_names())
+    if table not in cache:
+        if table not in cache[None]:
+            cache[table] = None
+        else:
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, table)
+            cache[table] = {
+                constraint['columns'][0] for constraint in constraints.values()
+                if constraint['columns'] and (
+                    constraint['index'] or constraint['primary_key'] or constraint['unique'])
+            }
+    return cache[table]
+
+
+def _model_field(table, column):
+    for model in apps.get_models():
+        if model._meta.db_table == table:
+            for field in model._meta.concrete_fields:
+                if field.column == column:
+                    return model._meta.label, field.name
+            return model._meta.label, None
+    return None, None
+
+
+def suggest_indexes(queryset=None, using='default', limit=None, chunk_size=2000):
+    """
+    Rank the columns used in WHERE, JOIN and ORDER BY clauses of the
+    captured queries which do not lead any index.
+
+    The time of a query shape is split evenly between its columns without
+    an index, ``attributed_duration`` adds up these shares, so a query
+    filtering on several columns is not counted once per column.
+    """
+    connection = connections[using]
+    cache = {}
+    usage = defaultdict(lambda: {
+        'count': 0, 'total_duration': 0, 'attributed_duration': 0, 'clauses': set(), 'sample': None,
+    })
+    for sql, count, total in query_shapes(queryset, chunk_size):
+        clauses = defaultdict(set)
+        for clause, table, column in extract_columns(sql):
+            indexed = _indexed_columns(connection, table, cache)
+            if indexed is not None and column not in indexed:
+                clauses[(table, column)].add(clause)
+        for key, column_clauses in clauses.items():
+            column_usage = usage[key]
+            column_usage['count'] += count
+            column_usage['total_duration'] += total
+            column_usage['attributed_duration'] += total / len(clauses)
+            column_usage['clauses'].update(column_clauses)
+            column_usage['sample'] = column_usage['sample'] or sql
+
+    suggestions = []
+    for (table, column), column_usage in usage.items():
+        model, field = _model_field(table, column)
+        suggestions.append({
+            'table': table,
+            'column': column,
+            'model': model,
+            'field': field,
+            'clauses': sorted(column_usage['clauses']),
+            'count': column_usage['count'],
+            'total_duration': column_usage['total_duration'],
+            'attributed_duration': column_usage['attributed_duration'],
+            'sample_query': column_usage['sample'],
+            'sql': 'CREATE INDEX %s ON %s (%s);' % (
+                connection.ops.quote_name('%s_%s_idx' % (table, column)),
+                connection.ops.quote_name(table),
+                connection.ops.quote_name(column),
+            ),
+        })
+    suggestions.sort(key=lambda suggestion: suggestion['attributed_duration'], reverse=True)
+    return suggestions[:limit] if limit else suggestions
+
+
+# database alias -> (time computed, suggestions), see cached_suggestions
+_cached_suggestions = {}
+
+
+def cached_suggestions(using='default', max_age=None):
+    """
+    suggest_indexes() of ``using``, computed again once the last result is
+    older than ``max_age`` seconds (INDEX_ADVISOR_CACHE_SECONDS).
+    """
+    if max_age is None:
+        max_age = rq_settings.get_config()['INDEX_ADVISOR_CACHE_SECONDS']
+    cached = _cached_suggestions.get(using)
+    if cached is None or time() - cached[0] >= max_age:
+        cached = _cached_suggestions[using] = (time(), suggest_indexes(using=using))
+    return cached[1]
@@ -0,0 +1,93 @@
+import json
+from functools import lru_cache
+
+from django.urls import Resolver404, get_urlconf, resolve
+
+
+@lru_cache(maxsize=1024)
+def _resolve_view_name(path_info, urlconf):
+    try:
+        return resolve(path_info, urlconf).view_name
+    except Resolver404:
+        return None
+
+
+def view_name(request):
+    """
+    The name of the view serving ``request``, from the resolver match once
+    Django resolved the URL, else resolved here and cached per path.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is not None:
+        return match.view_name
+    return _resolve_view_name(request.path_info, getattr(request, 'urlconf', None) or get_urlconf())
+
+
+def _cap(value, max_length):
+    value = str(value)
+    return value if len(value) <= max_length else value[:max_length] + '...'
+
+
+def headers(request, allowed, max_values, max_length):
+    """
+    JSON of the allowed request.META headers, e.g. HTTP_USER_AGENT, which
+    are set, at most ``max_values`` of them, each cut at ``max_length``.
+    """
+    captured = {}
+    for name in allowed:
+        if len(captured) >= max_values:
+            break
+        if name in request.META:
+            captured[name] = _cap(request.META[name], max_length)
+    return json.dumps(captured) if captured else ''
+
+
+def query_params(request, allowed, max_values, max_length):
+    """
+    JSON of the allowed query string parameters, all of them when
+    ``allowed`` contains '*', with the same caps as headers.
+    """
+    if not request.GET:
+        return ''
+    allow_all = '*' in allowed
+    captured = {}
+    for name, values in request.GET.lists():
+        if len(captured) >= max_values:
+            break
+        if allow_all or name in allowed:
+            captured[_cap(name, max_length)] = [_cap(value, max_length) for value in values[:max_values]]
+    return json.dumps(captured) if captured else ''
+
+
+def _content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def body(request, mode, max_size, text_types):
+    """
+    The request body as stored in Request.body, read once the response is
+    done. Only a body the view already read, or one no longer than
+    ``max_size`` bytes, is read: a large or streamed upload is described
+    by its content type and size instead. In 'content_type' mode only the
+    ``text_types`` content types are kept, 'truncate' keeps the first
+    ``max_size`` bytes of any body and 'off' nothing.
+    """
+    if mode == 'off':
+        return ''
+    length = _content_length(request)
+    if not length and not hasattr(request, '_body'):
+        return ''
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+    if mode == 'content_type' and not content_type.startswith(tuple(text_types)):
+        return '<%s, %d bytes>' % (content_type or 'no content type', length)
+    if hasattr(request, '_body'):
+        data = request._body
+    elif length <= max_size and not getattr(request, '_read_started', False):
+        data = request.body
+    else:
+        return '<%s, %d bytes, not read>' % (content_type or 'no content type', length)
+    text = data[:max_size].decode(request.encoding or 'utf-8', errors='replace')
+    return text + '...' if len(data) > max_size else text
@@ -0,0 +1,61 @@
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+
+class _Token(object):
+
+    def __init__(self, old_value):
+        self.old_value = old_value
+
+
+class _ThreadLocalVar(object):
+    """
+    Minimal stand-in for ContextVar on Pythons without contextvars, state
+    is then kept per thread which covers threaded WSGI servers.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = _Token(self.get())
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token.old_value
+
+
+if ContextVar is not None:
+    _current_recorder = ContextVar('repeat_queries_recorder', default=None)
+else:
+    _current_recorder = _ThreadLocalVar('repeat_queries_recorder', default=None)
+
+
+def get_current_recorder():
+    """
+    Return the SqlRecorder of the request being handled in this thread or
+    asyncio task, or None.
+    """
+    return _current_recorder.get()
+
+
+def set_current_recorder(recorder):
+    """
+    Make ``recorder`` current, return the token to give to
+    reset_current_recorder to restore the previous one.
+    """
+    return _current_recorder.set(recorder)
+
+
+def reset_current_recorder(token):
+    _current_recorder.reset(token)
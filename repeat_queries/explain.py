@@ -0,0 +1,158 @@
+import logging
+import os
+import re
+import threading
+from time import time
+
+from django.db import close_old_connections, connections
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.models import QueryPattern
+from repeat_queries.utils import Singleton
+
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+# "table"."column" (or with backticks) in a WHERE clause
+_COLUMN_RE = re.compile(r'[`"](\w+)[`"]\.[`"](\w+)[`"]')
+_WHERE_RE = re.compile(r'\bWHERE\b(.*?)(?:\bGROUP BY\b|\bORDER BY\b|\bLIMIT\b|$)', re.I | re.S)
+_SQLITE_SCAN_RE = re.compile(r'\bSCAN (?:TABLE )?(\w+)')
+_POSTGRES_SCAN_RE = re.compile(r'Seq Scan on (\w+)')
+
+
+def filtered_tables(sql):
+    """
+    Tables with a column used in a WHERE clause of ``sql``.
+    """
+    tables = set()
+    for where in _WHERE_RE.findall(sql):
+        tables.update(table for table, _ in _COLUMN_RE.findall(where))
+    return tables
+
+
+def run_explain(connection, sql, params):
+    """
+    Return the plan of ``sql`` as text and the tables it reads in full.
+    """
+    prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+    if prefix is None:
+        return '', set()
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        columns = [column[0] for column in cursor.description or ()]
+        rows = cursor.fetchall()
+
+    scanned = set()
+    if connection.vendor == 'mysql':
+        # one row per table, type ALL is a full table scan
+        if 'type' in columns and 'table' in columns:
+            type_index, table_index = columns.index('type'), columns.index('table')
+            scanned.update(row[table_index] for row in rows if row[type_index] == 'ALL')
+        lines = [' | '.join(columns)] + [' | '.join(str(value) for value in row) for row in rows]
+    else:
+        # sqlite: (id, parent, notused, detail), postgresql: one text column
+        lines = [str(row[-1]) for row in rows]
+        for line in lines:
+            if connection.vendor == 'sqlite':
+                match = _SQLITE_SCAN_RE.search(line)
+                if match and 'INDEX' not in line:
+                    scanned.add(match.group(1))
+            else:
+                scanned.update(_POSTGRES_SCAN_RE.findall(line))
+    return '\n'.join(lines), scanned
+
+
+class Explainer(object):
+    """
+    Runs EXPLAIN for slow or repeated query shapes on a background thread,
+    at most once per fingerprint and database every EXPLAIN_INTERVAL
+    seconds, and stores the plan on the matching QueryPattern rows.
+    """
+
+    def __init__(self, interval=None, queue_size=100):
+        self.interval = interval or rq_settings.get_config()['EXPLAIN_INTERVAL']
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._explained = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='repeat-queries-explain')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, fingerprint, alias, sql, params):
+        now = time()
+        key = (alias, fingerprint)
+        with self._lock:
+            last = self._explained.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            if len(self._explained) > 10000:
+                self._explained = {
+                    key: value for key, value in self._explained.items()
+                    if now - value < self.interval
+                }
+            self._explained[key] = now
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait((fingerprint, alias, sql, params))
+        except queue.Full:
+            self._forget(fingerprint, alias)
+            return False
+        return True
+
+    def flush(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def _forget(self, fingerprint, alias):
+        with self._lock:
+            self._explained.pop((alias, fingerprint), None)
+
+    def _run(self):
+        while True:
+            fingerprint, alias, sql, params = self.queue.get()
+            try:
+                self.explain(fingerprint, alias, sql, params)
+            except Exception:
+                logger.exception('Could not explain %s', sql)
+                close_old_connections()
+            finally:
+                self.queue.task_done()
+
+    def explain(self, fingerprint, alias, sql, params):
+        plan, scanned = run_explain(connections[alias], sql, params)
+        full_scan = bool(scanned & filtered_tables(sql))
+        updated = QueryPattern.objects.filter(alias=alias, fingerprint=fingerprint).update(
+            explain_plan=plan, explained_at=timezone.now(), full_scan=full_scan)
+        if not updated:
+            # The pattern is not stored yet, try again next time
+            self._forget(fingerprint, alias)
+        elif full_scan:
+            logger.warning(
+                'Full scan of filtered table(s) %s, a column may be missing an index: %s',
+                ', '.join(sorted(scanned)), sql)
+
+
+_explainer = Singleton(Explainer)
+
+
+def get_explainer():
+    return _explainer.get()
@@ -0,0 +1,43 @@
+import hashlib
+import re
+from functools import lru_cache
+
+
+# Order matters: literals are replaced before numbers so digits inside
+# strings are not touched, and IN lists are collapsed last.
+_PATTERNS = [
+    # -- comments and /* comments */
+    (re.compile(r'--[^\n]*'), ''),
+    (re.compile(r'/\*.*?\*/', re.S), ''),
+    # 'string literals', with '' escapes
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    # numbers which are not part of an identifier, e.g. T3 or "col1"
+    (re.compile(r'(?<![\w"`.])\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.I), '?'),
+    # DB-API placeholders
+    (re.compile(r'%\(\w+\)s|%s|\?|(?<!:):\w+'), '?'),
+    (re.compile(r'\s+'), ' '),
+    # IN (?, ?, ?) and VALUES (?, ?), (?, ?) of any length
+    (re.compile(r'\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)', re.I), 'IN (...)'),
+    (re.compile(r'\bVALUES \(.*?\)(?:\s*,\s*\(.*?\))*', re.I), 'VALUES (...)'),
+]
+
+
+def normalize(sql):
+    """
+    Reduce a statement to its shape: literals and placeholders become ``?``,
+    IN lists and multi-row VALUES are collapsed and whitespace is squashed,
+    so queries which only differ by their values compare equal.
+    """
+    for pattern, replacement in _PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(sql):
+    """
+    Return ``(shape, hash)`` for a statement. Cached on the raw SQL, so
+    statements the ORM runs over and over cost a single lookup.
+    """
+    shape = normalize(sql)
+    return shape, hashlib.sha1(shape.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,37 @@
+from bisect import bisect_left
+
+
+# Upper bounds, in milliseconds, of the latency buckets. The last bucket
+# holds everything slower than the last bound.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def new_histogram():
+    return [0] * (len(BUCKETS) + 1)
+
+
+def observe(histogram, value):
+    histogram[bisect_left(BUCKETS, value)] += 1
+
+
+def merge(histogram, other):
+    if not other:
+        return histogram
+    return [a + b for a, b in zip(histogram, other)]
+
+
+def percentile(histogram, q):
+    """
+    Approximate the ``q`` percentile (0-100) by the upper bound of the
+    bucket it falls into, None when the histogram is empty.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = total * q / 100.0
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank and count:
+            return BUCKETS[index] if index < len(BUCKETS) else float('inf')
+    return float('inf')
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from repeat_queries.models import Request
+from repeat_queries.profiler import format_collapsed, merge_collapsed
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge the Python profiles of the requests of a view into one '
+        'collapsed stack file, for flamegraph.pl or speedscope.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('view_name')
+        parser.add_argument('--hours', type=float, default=24,
+                            help='Only merge the requests of the last hours')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        profiles = Request.objects.filter(
+            view_name=options['view_name'],
+            start_time__gte=timezone.now() - timedelta(hours=options['hours']),
+        ).exclude(pyprofile='').values_list('pyprofile', flat=True)
+        collapsed = format_collapsed(merge_collapsed(profiles.iterator()))
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(collapsed)
+        else:
+            self.stdout.write(collapsed, ending='')
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.retention import prune
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete recorded requests and their queries older than a maximum '
+        'age or beyond a maximum number of rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=float,
+                            help='Defaults to RETENTION_MAX_AGE')
+        parser.add_argument('--max-rows', type=int,
+                            help='Defaults to RETENTION_MAX_ROWS')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Defaults to RETENTION_CHUNK_SIZE')
+
+    def handle(self, *args, **options):
+        config = rq_settings.get_config()
+        max_age = config['RETENTION_MAX_AGE']
+        if options['max_age_days'] is not None:
+            max_age = timedelta(days=options['max_age_days'])
+        max_rows = options['max_rows']
+        if max_rows is None:
+            max_rows = config['RETENTION_MAX_ROWS']
+        if max_age is None and max_rows is None:
+            raise CommandError('Give --max-age-days or --max-rows, or set RETENTION_MAX_AGE / RETENTION_MAX_ROWS')
+        stats = prune(max_age=max_age, max_rows=max_rows, chunk_size=options['chunk_size'])
+        self.stdout.write(
+            'Deleted %(requests)d requests, %(queries)d queries, %(patterns)d '
+            'patterns and %(rollups)d minute rollups in %(chunks)d chunks, %(seconds).2fs '
+            '(%(rows_per_second).0f rows/s)' % stats)
@@ -0,0 +1,103 @@
+import random
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from repeat_queries.middleware import DuplicateQueryMiddleware
+from repeat_queries.writers import get_writer
+
+
+class Command(BaseCommand):
+    help = (
+        'Run many concurrent requests through one DuplicateQueryMiddleware, '
+        'in a test database, and check that every captured query is '
+        'attributed to its request.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Requests per thread')
+        parser.add_argument('--queries', type=int, default=20,
+                            help='Queries per request')
+
+    def handle(self, *args, **options):
+        config = {
+            'WRITER': 'repeat_queries.writers.MemoryWriter',
+            'WRITER_QUEUE_SIZE': options['threads'] * options['requests'],
+            'SAMPLE_RATE': 1.0,
+            'SAMPLE_RATES': {},
+            'MAX_RECORDED_PER_SECOND': None,
+            'N_PLUS_ONE_THRESHOLD': None,
+        }
+        # The queries run on a throwaway test database, never on the
+        # project's own one
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(REPEAT_QUERIES=config):
+                elapsed = self.run_requests(options)
+                profiles = list(get_writer().profiles)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.verify(profiles, options, elapsed)
+
+    def run_requests(self, options):
+        num_queries = options['queries']
+
+        def view(request):
+            # Every query carries the token of its request, sleeps let
+            # the threads interleave in the middle of a request.
+            token = request.path.split('/')[2]
+            with connection.cursor() as cursor:
+                for _ in range(num_queries):
+                    cursor.execute("SELECT '%s'" % token)
+                    sleep(random.random() / 1000)
+            return HttpResponse(token)
+
+        middleware = DuplicateQueryMiddleware(view)
+        factory = RequestFactory()
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(options['requests']):
+                    middleware(factory.get('/stress/%s/' % uuid4().hex))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise CommandError('Requests failed: %r' % errors[0])
+        return time() - start
+
+    def verify(self, profiles, options, elapsed):
+        expected = options['threads'] * options['requests']
+        misattributed = 0
+        num_queries = 0
+        for profile in profiles:
+            token = profile['request'].path.split('/')[2]
+            queries = profile['queries']
+            num_queries += len(queries)
+            tokens = {q.query.split("'")[1] for q in queries}
+            if tokens != {token} or len(queries) != options['queries']:
+                misattributed += 1
+        self.stdout.write(
+            '%d requests, %d queries in %.2fs, %d misattributed' % (
+                len(profiles), num_queries, elapsed, misattributed))
+        if len(profiles) != expected or misattributed:
+            raise CommandError(
+                'Expected %d requests with %d queries each' % (
+                    expected, options['queries']))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from repeat_queries.advisor import suggest_indexes
+
+
+class Command(BaseCommand):
+    help = (
+        'Suggest indexes for the columns the captured queries filter, join '
+        'or sort on, ranked by the time spent in those queries, split between the '
+        'columns of each query.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help='Database whose indexes are inspected')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        suggestions = suggest_indexes(
+            using=options['database'], limit=options['limit'],
+            chunk_size=options['chunk_size'],
+        )
+        if not suggestions:
+            self.stdout.write('No missing index found.')
+        for suggestion in suggestions:
+            self.stdout.write(
+                '%(sql)s\n    -- %(model)s.%(field)s used in %(clause_list)s by '
+                '%(count)d queries, %(attributed_duration).1fms of their time' % dict(
+                    suggestion, clause_list=', '.join(suggestion['clauses'])))
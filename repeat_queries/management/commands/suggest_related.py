@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from repeat_queries.relations import relation_suggestions
+
+
+class Command(BaseCommand):
+    help = (
+        'List the select_related / prefetch_related calls which would remove '
+        'the repeated queries of each view, with the queries and time they save.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', dest='view_name', default=None,
+                            help='Only show the suggestions of this view')
+
+    def handle(self, *args, **options):
+        view_name = None
+        for pattern in relation_suggestions(options['view_name']).iterator():
+            if pattern.view_name != view_name:
+                view_name = pattern.view_name
+                self.stdout.write(view_name)
+            self.stdout.write(
+                '    %s  (%d queries, %.1fms saved over %d requests)%s' % (
+                    pattern.suggestion, pattern.saved_queries, pattern.saving,
+                    pattern.num_requests,
+                    '\n        at %s' % pattern.suggestion_line if pattern.suggestion_line else ''))
+        if view_name is None:
+            self.stdout.write('No repeated query loading a relation was found.')
@@ -0,0 +1,260 @@
+"""
+In-process counters and histograms of the recorded requests, rendered in
+the Prometheus text format by MetricsView.
+
+Every thread adds to its own shard, so recording a request takes no lock;
+a lock is only taken the first time a thread or a label set is seen, and
+by the scrape which adds up the shards.
+"""
+import logging
+import threading
+from bisect import bisect_left
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.histogram import BUCKETS as TIME_BUCKETS
+from repeat_queries.utils import Singleton
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the queries per request buckets
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'}
+
+# Label value standing for the label sets over METRICS_MAX_SERIES
+OTHER = '__other__'
+
+# (name, type, help, label names, buckets) of every metric
+FAMILIES = (
+    ('repeat_queries_requests_total', 'counter',
+     'Requests seen by DuplicateQueryMiddleware.', ('view_name', 'method'), None),
+    ('repeat_queries_request_duration_milliseconds', 'histogram',
+     'Time taken by a request.', ('view_name', 'method'), TIME_BUCKETS),
+    ('repeat_queries_request_queries', 'histogram',
+     'SQL queries run by a request.', ('view_name', 'method'), QUERY_BUCKETS),
+    ('repeat_queries_sql_queries_total', 'counter',
+     'SQL queries run.', ('view_name', 'method', 'alias'), None),
+    ('repeat_queries_sql_time_milliseconds', 'histogram',
+     'Time spent in SQL queries by a request, per database.',
+     ('view_name', 'method', 'alias'), TIME_BUCKETS),
+    ('repeat_queries_similar_queries_total', 'counter',
+     'Queries whose shape ran at least twice in a request, sampled requests only.',
+     ('view_name', 'method', 'alias'), None),
+    ('repeat_queries_duplicate_queries_total', 'counter',
+     'Queries run at least twice with the same parameters in a request, '
+     'sampled requests only.', ('view_name', 'method', 'alias'), None),
+)
+_BUCKETS = {name: buckets for name, kind, help, labels, buckets in FAMILIES}
+
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms keyed by (metric name, label values).
+
+    A counter is a float, a histogram a list of its bucket counts (not
+    cumulative) followed by the sum and the count of the observed values.
+    At most ``max_series`` label sets are kept per metric, the values of
+    the others are added to a label set whose values are all OTHER.
+    """
+
+    def __init__(self, max_series=None):
+        self.max_series = max_series or rq_settings.get_config()['METRICS_MAX_SERIES']
+        self._local = threading.local()
+        # (thread, shard) of every thread which recorded something
+        self._shards = []
+        # Totals of the threads which are gone
+        self._retired = {}
+        # (name, labels) -> the key it is recorded under
+        self._keys = {}
+        self._num_series = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                # Without scrapes the shards of the threads which are gone
+                # would pile up, as with a thread per request
+                self._retire_dead_shards()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_dead_shards(self):
+        # Called with the lock held
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _add(self._retired, shard)
+        self._shards = alive
+
+    def _key(self, name, labels):
+        key = self._keys.get((name, labels))
+        if key is None:
+            with self._lock:
+                key = self._keys.get((name, labels))
+                if key is None:
+                    if self._num_series.get(name, 0) >= self.max_series:
+                        # Not remembered, so the lookups stay bounded too
+                        return (name, (OTHER,) * len(labels))
+                    self._num_series[name] = self._num_series.get(name, 0) + 1
+                    key = self._keys[(name, labels)] = (name, labels)
+        return key
+
+    def inc(self, name, labels, value=1):
+        shard = self._shard()
+        key = self._key(name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = self._key(name, labels)
+        buckets = _BUCKETS[name]
+        histogram = shard.get(key)
+        if histogram is None:
+            histogram = shard[key] = [0] * (len(buckets) + 3)
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self):
+        """
+        Return {(name, labels): value} summed over every thread.
+        """
+        with self._lock:
+            self._retire_dead_shards()
+            totals = {}
+            _add(totals, self._retired)
+            for thread, shard in self._shards:
+                _add(totals, shard)
+        return totals
+
+
+def _add(totals, shard):
+    # A copy of the items is taken at once, the owner thread may be adding
+    # to its shard meanwhile
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            value = list(value)
+            total = totals.get(key)
+            totals[key] = [a + b for a, b in zip(total, value)] if total else value
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _labels(names, values):
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    """
+    The Prometheus text exposition format (version 0.0.4) of ``totals``.
+    """
+    lines = []
+    for name, kind, help, label_names, buckets in FAMILIES:
+        series = sorted((labels, value) for (key_name, labels), value in totals.items() if key_name == name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in series:
+            label_text = _labels(label_names, labels)
+            if kind == 'counter':
+                lines.append('%s{%s} %s' % (name, label_text, _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), value[:-2]):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_text, _number(bound), cumulative))
+            lines.append('%s_sum{%s} %s' % (name, label_text, _number(value[-2])))
+            lines.append('%s_count{%s} %d' % (name, label_text, value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def record(recorder):
+    """
+    Add a recorded request to the metrics of this process.
+    """
+    registry = get_registry()
+    request = recorder.request
+    view = (request.view_name if request is not None else None) or ''
+    method = request.method if request is not None else ''
+    method = method if method in METHODS else 'OTHER'
+    labels = (view, method)
+    registry.inc('repeat_queries_requests_total', labels)
+    if request is not None and request.time_taken is not None:
+        registry.observe('repeat_queries_request_duration_milliseconds', labels, request.time_taken)
+    registry.observe('repeat_queries_request_queries', labels, recorder._num_queries)
+    for alias, database in recorder._databases.items():
+        alias_labels = (view, method, alias)
+        registry.inc('repeat_queries_sql_queries_total', alias_labels, database['num_queries'])
+        registry.observe('repeat_queries_sql_time_milliseconds', alias_labels, database['time_spent'])
+    for alias, counts in recorder._similar_counts.items():
+        similar = sum(count for count in counts.values() if count >= 2)
+        if similar:
+            registry.inc('repeat_queries_similar_queries_total', (view, method, alias), similar)
+    for alias, counts in recorder._duplicate_counts.items():
+        duplicates = sum(count for count in counts.values() if count >= 2)
+        if duplicates:
+            registry.inc('repeat_queries_duplicate_queries_total', (view, method, alias), duplicates)
+
+
+_registry = Singleton(MetricsRegistry)
+
+
+def get_registry():
+    return _registry.get()
+
+
+def _load_tracer():
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning('OTEL_SPANS is set but opentelemetry-api is not installed')
+        return False
+    return trace.get_tracer('repeat_queries')
+
+
+_tracer = Singleton(_load_tracer)
+
+
+def get_tracer():
+    """
+    The OpenTelemetry tracer of the query spans, None when the
+    opentelemetry-api package is not installed.
+    """
+    return _tracer.get() or None
+
+
+def export_spans(recorder):
+    """
+    Export one span per captured query, with the time it ran, as a child
+    of the span current when the response is done, usually the one of the
+    request.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        return
+    for alias, query in recorder._queries:
+        span = tracer.start_span(
+            query['raw_sql'].split(None, 1)[0].upper() if query['raw_sql'].strip() else 'SQL',
+            start_time=int(query['start_time'] * 1e9),
+            attributes={
+                'db.system': query['vendor'],
+                'db.name': alias,
+                'db.statement': query['raw_sql'],
+                'repeat_queries.fingerprint': query['similar_key'],
+                'repeat_queries.similar_count': query.get('similar_count') or 1,
+                'repeat_queries.duplicate_count': query.get('duplicate_count') or 1,
+            },
+        )
+        span.end(end_time=int(query['stop_time'] * 1e9))
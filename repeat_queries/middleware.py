@@ -1,7 +1,10 @@
 from django.utils.deprecation import MiddlewareMixin
 from django.utils import timezone
 
+from repeat_queries import metrics
+from repeat_queries import settings as rq_settings
 from repeat_queries.recorder import SqlRecorder
+from repeat_queries.sampling import Sampler
 
 
 def should_record(request):
@@ -16,30 +19,59 @@ def should_record(request):
 class DuplicateQueryMiddleware(MiddlewareMixin):
     """
     Middleware to catch duplicate sql queries
+
+    One instance is shared by every thread of the server, so the recorder
+    of a request is kept on the request itself and never on the middleware.
     """
     def __init__(self, get_response):
         self.get_response = get_response
-        self.recorder = SqlRecorder()
+        self.sampler = Sampler()
+        config = rq_settings.get_config()
+        self.metrics = config['METRICS']
+        self.otel_spans = config['OTEL_SPANS']
+
+    def __call__(self, request):
+        try:
+            return super(DuplicateQueryMiddleware, self).__call__(request)
+        finally:
+            # process_response is skipped when the view or a middleware
+            # below raises, the recorder must not stay current
+            recorder = getattr(request, 'repeat_queries_recorder', None)
+            if recorder is not None:
+                recorder.stop_profiling()
+                recorder.disable_instrumentation()
 
     def process_request(self, request):
-        self.recorder = SqlRecorder()
+        request.repeat_queries_recorder = None
         if not should_record(request):
             return
-        self.recorder.enable_instrumentation()
-        self.recorder.record_request(request)
-        pass
+        sampled = self.sampler.should_sample(request)
+        if not sampled and not self.sampler.has_thresholds and not self.metrics:
+            return
+        recorder = SqlRecorder(capture_queries=sampled)
+        recorder.enable_instrumentation()
+        recorder.record_request(request)
+        request.repeat_queries_recorder = recorder
 
-    def process_response(self, request, response):
-        if not should_record(request):
-            return response
-        self.recorder.disable_instrumentation()
-        self.recorder.generate_stats(request, response)
-        self.recorder.record_request_end(request)
-        return response
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        recorder = getattr(request, 'repeat_queries_recorder', None)
+        if recorder is not None and recorder.request is not None:
+            # Django resolved the URL already, nothing to look up
+            recorder.request.view_name = request.resolver_match.view_name
 
-    def process_template_response(self, request, response):
-        if not should_record(request):
+    def process_response(self, request, response):
+        recorder = getattr(request, 'repeat_queries_recorder', None)
+        if recorder is None:
             return response
-        self.recorder.disable_instrumentation()
-        self.recorder.record_request_end(request)
+        recorder.stop_profiling()
+        recorder.disable_instrumentation()
+        recorder.generate_stats(request, response)
+        recorder.record_request_end(request)
+        if self.metrics:
+            metrics.record(recorder)
+        if self.otel_spans:
+            metrics.export_spans(recorder)
+        if self.sampler.should_keep(recorder):
+            recorder.report(response)
+            recorder.persist()
         return response
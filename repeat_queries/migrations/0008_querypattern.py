@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0007_sqlquery_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryPattern',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view_name', models.CharField(db_index=True, max_length=190)),
+                ('fingerprint', models.CharField(db_index=True, max_length=16)),
+                ('count', models.IntegerField(default=0)),
+                ('num_requests', models.IntegerField(default=0)),
+                ('max_per_request', models.IntegerField(default=0)),
+                ('total_duration', models.FloatField(default=0)),
+                ('min_duration', models.FloatField(blank=True, null=True)),
+                ('max_duration', models.FloatField(blank=True, null=True)),
+                ('histogram', models.TextField(blank=True, default='')),
+                ('sample_query', models.TextField(blank=True, default='')),
+                ('sample_traceback', models.TextField(blank=True, default='')),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='querypattern',
+            unique_together=set([('view_name', 'fingerprint')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0009_sqlquery_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querypattern',
+            name='explain_plan',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='explained_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='full_scan',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0010_querypattern_explain_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querypattern',
+            name='saved_queries',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='suggestion',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='querypattern',
+            name='suggestion_line',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
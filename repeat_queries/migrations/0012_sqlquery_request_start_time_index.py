@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:27
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0011_querypattern_suggestion'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='sqlquery',
+            index_together=set([('request', 'start_time')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0012_sqlquery_request_start_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EndpointRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour')], max_length=6)),
+                ('period_start', models.DateTimeField()),
+                ('view_name', models.CharField(max_length=190)),
+                ('num_requests', models.IntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+                ('max_time', models.FloatField(default=0)),
+                ('time_histogram', models.TextField(blank=True, default='')),
+                ('total_queries', models.IntegerField(default=0)),
+                ('max_queries', models.IntegerField(default=0)),
+                ('total_sql_time', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='endpointrollup',
+            unique_together=set([('resolution', 'period_start', 'view_name')]),
+        ),
+    ]
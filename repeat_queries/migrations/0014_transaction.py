@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0013_endpointrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trans_id', models.CharField(db_index=True, max_length=32)),
+                ('alias', models.CharField(max_length=100)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('num_queries', models.IntegerField()),
+                ('sql_time', models.FloatField()),
+                ('idle_time', models.FloatField()),
+                ('outcome', models.CharField(blank=True, default='', max_length=10)),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='repeat_queries.Request')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='sqlquery',
+            name='trans_id',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
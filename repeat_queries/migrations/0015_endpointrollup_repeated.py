@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 15:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0014_transaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointrollup',
+            name='repeated',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
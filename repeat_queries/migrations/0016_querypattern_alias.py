@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 16:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repeat_queries', '0015_endpointrollup_repeated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querypattern',
+            name='alias',
+            field=models.CharField(default='default', max_length=100),
+        ),
+        migrations.AlterUniqueTogether(
+            name='querypattern',
+            unique_together=set([('view_name', 'alias', 'fingerprint')]),
+        ),
+    ]
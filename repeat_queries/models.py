@@ -2,19 +2,27 @@
 from __future__ import unicode_literals
 
 from django.db import models
-from django.db import transaction
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, router, transaction
+from collections import defaultdict
+import json
+import random
 import re
 
 from django.db.models import (
     DateTimeField, TextField, CharField, ForeignKey, IntegerField,
     BooleanField, F, ManyToManyField, OneToOneField, FloatField,
-    FileField
+    FileField, Max, Sum
 )
 from django.utils import timezone
 from uuid import uuid4
-import sqlparse
 from django.utils.safestring import mark_safe
 
+from repeat_queries import settings as rq_settings
+from repeat_queries.histogram import (
+    merge as merge_histograms, new_histogram, observe, percentile
+)
+from repeat_queries.utils import format_sql, interpolate_sql
+
 
 # Seperated out so can use in tests w/o models
 def _time_taken(start_time, end_time):
@@ -57,25 +65,25 @@ class Request(models.Model):
     def total_meta_time(self):
         return (self.meta_time or 0) + (self.meta_time_spent_queries or 0)
 
-    # defined in atomic transaction within SQLQuery save()/delete() as well
-    # as in bulk_create of SQLQueryManager
-    # TODO: This is probably a bad way to do this, .count() will prob do?
-    num_sql_queries = IntegerField(default=0)  # TODO replace with count()
+    # Written once when the request is stored by SQLQueryManager.ingest,
+    # and kept up to date with UPDATE ... SET num_sql_queries =
+    # num_sql_queries +/- 1 by SQLQuery save()/delete()
+    num_sql_queries = IntegerField(default=0)
 
     @property
     def time_spent_on_sql_queries(self):
         """
-        TODO: Perhaps there is a nicer way to do this with Django aggregates?
-        My initial thought was to perform:
-        SQLQuery.objects.filter.aggregate(Sum(F('end_time')) - Sum(F('start_time')))
-        However this feature isnt available yet, however there has been talk
-        for use of F objects within aggregates for four years
-        here: https://code.djangoproject.com/ticket/14030. It looks
-        like this will go in soon at which point this should be changed.
+        Total duration of the queries in milliseconds, as kept by the
+        recorder, or of the stored queries for older requests.
         """
-        return sum(x.time_taken for x in SQLQuery.objects.filter(request=self))
+        if self.meta_time_spent_queries is not None:
+            return self.meta_time_spent_queries
+        return self.queries.aggregate(total=Sum('duration'))['total'] or 0
 
-    def save(self, *args, **kwargs):
+    def prepare_for_save(self):
+        """
+        Normalise fields before storing, bulk_create does not call save()
+        """
         # sometimes django requests return the body as 'None'
         if self.raw_body is None:
             self.raw_body = ''
@@ -94,8 +102,65 @@ class Request(models.Model):
         if self.view_name and len(self.view_name) > 190:
             self.view_name = self._shorten(self.view_name)
 
+    def save(self, *args, **kwargs):
+        self.prepare_for_save()
         super(Request, self).save(*args, **kwargs)
-        # Request.garbage_collect(force=False)
+
+    @classmethod
+    def garbage_collect(cls, force=False):
+        """
+        Apply the retention policy, on a RETENTION_SWEEP_PROBABILITY share
+        of the calls unless ``force`` is given.
+        """
+        config = rq_settings.get_config()
+        if not force and random.random() >= config['RETENTION_SWEEP_PROBABILITY']:
+            return None
+        if config['RETENTION_MAX_AGE'] is None and config['RETENTION_MAX_ROWS'] is None and \
+                config['ROLLUP_MINUTE_MAX_AGE'] is None:
+            return None
+        from repeat_queries.retention import prune
+        return prune(
+            max_age=config['RETENTION_MAX_AGE'],
+            max_rows=config['RETENTION_MAX_ROWS'],
+            max_chunks=None if force else config['RETENTION_SWEEP_MAX_CHUNKS'],
+        )
+
+
+class SQLQueryManager(models.Manager):
+
+    def ingest(self, profiles):
+        """
+        Store the queries of every profile with a single bulk_create.
+
+        Each profile is a dict with a ``request``, its ``queries`` and the
+        ``num_queries`` / ``sql_time`` totals the recorder kept in memory, so
+        the request counters are set once instead of once per query as
+        SQLQuery.save() does. Unsaved requests are inserted in bulk too.
+        """
+        new_requests = []
+        queries = []
+        transactions = []
+        with transaction.atomic(using=self.db):
+            for profile in profiles:
+                request = profile['request']
+                num_queries = profile.get('num_queries', len(profile['queries']))
+                counters = {
+                    'num_sql_queries': num_queries,
+                    'meta_num_queries': num_queries,
+                    'meta_time_spent_queries': profile.get('sql_time'),
+                }
+                for field, value in counters.items():
+                    setattr(request, field, value)
+                if request._state.adding:
+                    request.prepare_for_save()
+                    new_requests.append(request)
+                else:
+                    Request.objects.filter(pk=request.pk).update(**counters)
+                queries.extend(profile['queries'])
+                transactions.extend(profile.get('transactions', ()))
+            Request.objects.bulk_create(new_requests)
+            Transaction.objects.bulk_create(transactions)
+            return self.bulk_create(queries)
 
 
 class SQLQuery(models.Model):
@@ -111,6 +176,17 @@ class SQLQuery(models.Model):
     traceback = TextField()
     duplicate_count = IntegerField(blank=True, null=True)
     similar_count = IntegerField(blank=True, null=True)
+    # Hash of the normalised statement, see repeat_queries.fingerprint
+    fingerprint = CharField(max_length=16, db_index=True, blank=True, default='')
+    params = TextField(blank=True, default='')  # stores json
+    # Transaction.trans_id of the transaction the query ran in, if any
+    trans_id = CharField(max_length=32, blank=True, default='')
+
+    objects = SQLQueryManager()
+
+    class Meta:
+        # the queries of a request in order, see SQLView
+        index_together = [('request', 'start_time')]
 
     # TODO docstring
     @property
@@ -119,29 +195,405 @@ class SQLQuery(models.Model):
 
     @property
     def formatted_query(self):
-        return sqlparse.format(self.query, reindent=True, keyword_case='upper')
+        return format_sql(self.query)
+
+    @property
+    def interpolated_query(self):
+        """
+        The query with its parameters inlined, only available when
+        STORE_PARAMS is on.
+        """
+        if not self.params:
+            return self.query
+        params = json.loads(self.params)
+        if isinstance(params, dict) and 'executemany' in params:
+            return interpolate_sql(self.query, params['executemany'], many=True)
+        return interpolate_sql(self.query, params)
 
     # TODO: Surely a better way to handle this? May return false positives
     @property
     def num_joins(self):
         return self.query.lower().count('join ')
 
-    @transaction.atomic()
     def save(self, *args, **kwargs):
 
-        if self.stop_time and self.start_time:
+        if self.duration is None and self.stop_time and self.start_time:
             interval = self.stop_time - self.start_time
-            self.time_taken = interval.total_seconds() * 1000
+            self.duration = interval.total_seconds() * 1000
 
-        if not self.pk:
-            if self.request:
-                self.request.num_sql_queries += 1
-                self.request.save(update_fields=['num_sql_queries'])
+        using = kwargs.get('using') or router.db_for_write(SQLQuery, instance=self)
+        with transaction.atomic(using=using):
+            if not self.pk and self.request_id:
+                # Incremented by the database, concurrent saves do not
+                # overwrite each other's count
+                Request.objects.using(using).filter(pk=self.request_id).update(
+                    num_sql_queries=F('num_sql_queries') + 1)
 
-        super(SQLQuery, self).save(*args, **kwargs)
+            super(SQLQuery, self).save(*args, **kwargs)
 
-    @transaction.atomic()
     def delete(self, *args, **kwargs):
-        self.request.num_sql_queries -= 1
-        self.request.save()
-        super(SQLQuery, self).delete(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(SQLQuery, instance=self)
+        with transaction.atomic(using=using):
+            if self.request_id:
+                Request.objects.using(using).filter(pk=self.request_id).update(
+                    num_sql_queries=F('num_sql_queries') - 1)
+            return super(SQLQuery, self).delete(*args, **kwargs)
+
+
+class Transaction(models.Model):
+    """
+    A transaction (outermost atomic block) opened during a request, from
+    its first query to its commit or rollback.
+    """
+    request = ForeignKey(
+        Request, related_name='transactions', on_delete=models.CASCADE,
+    )
+    trans_id = CharField(max_length=32, db_index=True)
+    alias = CharField(max_length=100)
+    start_time = DateTimeField()
+    end_time = DateTimeField()
+    # wall time, time spent in its queries and time spent between them
+    # while it was held open, in milliseconds
+    duration = FloatField()
+    num_queries = IntegerField()
+    sql_time = FloatField()
+    idle_time = FloatField()
+    # 'commit', 'rollback', or '' when it was still open at the end of the
+    # request or ended some other way
+    outcome = CharField(max_length=10, blank=True, default='')
+
+    def __str__(self):
+        return '%s: %.1fms' % (self.trans_id, self.duration)
+
+
+class MergeManager(models.Manager):
+    """
+    Upserts running totals: rows are keyed on ``key_fields`` and merged
+    into the existing rows, locked, or created.
+    """
+    key_fields = ()
+
+    def _upsert(self, deltas):
+        if not deltas:
+            return
+        try:
+            self._merge(deltas)
+        except IntegrityError:
+            # Another process created one of the rows in the meantime,
+            # it exists now so merging again updates it.
+            self._merge(deltas)
+
+    def _merge(self, deltas):
+        with transaction.atomic(using=self.db):
+            self._merge_rows(deltas)
+
+    def _merge_rows(self, deltas):
+        existing = self.select_for_update().filter(**{
+            '%s__in' % field: {key[index] for key in deltas}
+            for index, field in enumerate(self.key_fields)
+        })
+        for row in existing:
+            delta = deltas.get(tuple(getattr(row, field) for field in self.key_fields))
+            if delta is None:
+                continue
+            row.merge(delta)
+            row.save()
+            delta.pk = row.pk
+        self.bulk_create([delta for delta in deltas.values() if delta.pk is None])
+
+
+class QueryPatternManager(MergeManager):
+    key_fields = ('view_name', 'alias', 'fingerprint')
+
+    def merge(self, profiles):
+        """
+        Add the query patterns of every profile to the running totals,
+        creating the rows which do not exist yet.
+        """
+        deltas = {}
+        for profile in profiles:
+            request = profile['request']
+            view_name = request.view_name or request.path
+            for (alias, fingerprint), pattern in profile.get('patterns', {}).items():
+                key = (view_name, alias, fingerprint)
+                if key in deltas:
+                    deltas[key].add(pattern, request.start_time)
+                else:
+                    deltas[key] = self.model(
+                        view_name=view_name, alias=alias, fingerprint=fingerprint,
+                        first_seen=request.start_time,
+                        last_seen=request.start_time,
+                    )
+                    deltas[key].add(pattern, request.start_time)
+        self._upsert(deltas)
+
+
+class QueryPattern(models.Model):
+    """
+    Running totals of one query shape (see repeat_queries.fingerprint) per
+    view and database, so finding the N+1s of an endpoint does not scan
+    every SQLQuery.
+    """
+    view_name = CharField(max_length=190, db_index=True)
+    # database alias the queries ran on
+    alias = CharField(max_length=100, default=DEFAULT_DB_ALIAS)
+    fingerprint = CharField(max_length=16, db_index=True)
+    # number of times the query ran, and in how many requests
+    count = IntegerField(default=0)
+    num_requests = IntegerField(default=0)
+    # highest number of times it ran in a single request
+    max_per_request = IntegerField(default=0)
+    total_duration = FloatField(default=0)
+    min_duration = FloatField(null=True, blank=True)
+    max_duration = FloatField(null=True, blank=True)
+    histogram = TextField(blank=True, default='')  # stores json
+    sample_query = TextField(blank=True, default='')
+    sample_traceback = TextField(blank=True, default='')
+    first_seen = DateTimeField(default=timezone.now)
+    last_seen = DateTimeField(default=timezone.now, db_index=True)
+    # Filled by repeat_queries.explain for slow or repeated patterns
+    explain_plan = TextField(blank=True, default='')
+    explained_at = DateTimeField(null=True, blank=True)
+    # The plan reads a table in full although it is filtered in WHERE
+    full_scan = BooleanField(default=False)
+    # select_related / prefetch_related call removing the repetition, see
+    # repeat_queries.relations, the code line which ran the first query
+    # and the number of queries it would have saved
+    suggestion = CharField(max_length=255, blank=True, default='')
+    suggestion_line = CharField(max_length=255, blank=True, default='')
+    saved_queries = IntegerField(default=0)
+
+    objects = QueryPatternManager()
+
+    class Meta:
+        unique_together = ('view_name', 'alias', 'fingerprint')
+
+    def __str__(self):
+        return '%s: %s' % (self.view_name, self.fingerprint)
+
+    @property
+    def avg_duration(self):
+        return self.total_duration / self.count if self.count else None
+
+    @property
+    def saved_duration(self):
+        """
+        Milliseconds the suggestion would have saved, estimated from the
+        average duration of the query.
+        """
+        return self.total_duration * self.saved_queries / self.count if self.count else 0
+
+    @property
+    def histogram_counts(self):
+        return json.loads(self.histogram) if self.histogram else new_histogram()
+
+    def add(self, pattern, seen_at):
+        """
+        Add the totals of one request, as built by SqlRecorder.
+        """
+        self.count += pattern['count']
+        self.num_requests += 1
+        self.max_per_request = max(self.max_per_request, pattern['count'])
+        self.total_duration += pattern['total_duration']
+        self.min_duration = _min(self.min_duration, pattern['min_duration'])
+        self.max_duration = _max(self.max_duration, pattern['max_duration'])
+        self.histogram = json.dumps(merge_histograms(self.histogram_counts, pattern['histogram']))
+        if not self.sample_query:
+            self.sample_query = pattern['sample_query']
+            self.sample_traceback = pattern['sample_traceback']
+        if pattern.get('suggestion'):
+            self.suggestion = pattern['suggestion']
+            self.suggestion_line = pattern['suggestion_line']
+            self.saved_queries += pattern['saved_queries']
+        if self.last_seen is None or seen_at > self.last_seen:
+            self.last_seen = seen_at
+
+    def merge(self, other):
+        self.count += other.count
+        self.num_requests += other.num_requests
+        self.max_per_request = max(self.max_per_request, other.max_per_request)
+        self.total_duration += other.total_duration
+        self.min_duration = _min(self.min_duration, other.min_duration)
+        self.max_duration = _max(self.max_duration, other.max_duration)
+        self.histogram = json.dumps(merge_histograms(self.histogram_counts, other.histogram_counts))
+        if not self.sample_query:
+            self.sample_query = other.sample_query
+            self.sample_traceback = other.sample_traceback
+        if other.suggestion:
+            self.suggestion = other.suggestion
+            self.suggestion_line = other.suggestion_line
+        self.saved_queries += other.saved_queries
+        self.last_seen = max(self.last_seen, other.last_seen)
+
+
+class EndpointRollupManager(MergeManager):
+    key_fields = ('resolution', 'period_start', 'view_name')
+
+    def merge(self, profiles):
+        """
+        Add every profile to the minute and hour totals of its view.
+        """
+        deltas = {}
+        for profile in profiles:
+            request = profile['request']
+            view_name = request.view_name or request.path
+            for resolution in (EndpointRollup.MINUTE, EndpointRollup.HOUR):
+                period_start = EndpointRollup.truncate(request.start_time, resolution)
+                key = (resolution, period_start, view_name)
+                if key not in deltas:
+                    deltas[key] = self.model(
+                        resolution=resolution, period_start=period_start,
+                        view_name=view_name,
+                    )
+                deltas[key].add(profile)
+        self._upsert(deltas)
+
+    def summary(self, since, resolution):
+        """
+        Totals and latency percentiles per view of the periods starting
+        after ``since``, busiest views first. ``repeated`` maps the
+        fingerprints repeated in the window to their totals, see
+        merge_repeated.
+        """
+        periods = self.filter(
+            resolution=resolution,
+            period_start__gte=EndpointRollup.truncate(since, resolution),
+        )
+        views = periods.values('view_name').annotate(
+            num_requests=Sum('num_requests'),
+            total_time=Sum('total_time'),
+            max_time=Max('max_time'),
+            total_queries=Sum('total_queries'),
+            max_queries=Max('max_queries'),
+            total_sql_time=Sum('total_sql_time'),
+        ).order_by()
+        views = {view['view_name']: view for view in views}
+        histograms = {}
+        repeated = {}
+        rows = periods.values_list('view_name', 'time_histogram', 'repeated')
+        for view_name, histogram, shapes in rows.iterator():
+            if histogram:
+                histograms[view_name] = merge_histograms(
+                    histograms.get(view_name, new_histogram()), json.loads(histogram))
+            if shapes:
+                repeated[view_name] = merge_repeated(repeated.get(view_name, {}), json.loads(shapes))
+        for view_name, view in views.items():
+            view['repeated'] = repeated.get(view_name, {})
+            histogram = histograms.get(view_name, new_histogram())
+            # a bucket bound can not be slower than the slowest request
+            for q in (50, 95, 99):
+                value = percentile(histogram, q)
+                view['p%d' % q] = value if value is None else min(value, view['max_time'])
+            view['avg_time'] = view['total_time'] / view['num_requests']
+            view['avg_queries'] = view['total_queries'] / view['num_requests']
+        return sorted(views.values(), key=lambda view: view['num_requests'], reverse=True)
+
+
+class EndpointRollup(models.Model):
+    """
+    Totals of the recorded requests of one view over a minute or an hour,
+    so the endpoint dashboard never scans Request rows.
+    """
+    MINUTE = 'minute'
+    HOUR = 'hour'
+
+    resolution = CharField(max_length=6, choices=((MINUTE, 'Minute'), (HOUR, 'Hour')))
+    period_start = DateTimeField()
+    view_name = CharField(max_length=190)
+    num_requests = IntegerField(default=0)
+    total_time = FloatField(default=0)
+    max_time = FloatField(default=0)
+    time_histogram = TextField(blank=True, default='')  # stores json
+    total_queries = IntegerField(default=0)
+    max_queries = IntegerField(default=0)
+    total_sql_time = FloatField(default=0)
+    # The query shapes run at least twice in a request, see merge_repeated
+    repeated = TextField(blank=True, default='')  # stores json
+
+    objects = EndpointRollupManager()
+
+    class Meta:
+        unique_together = ('resolution', 'period_start', 'view_name')
+
+    def __str__(self):
+        return '%s: %s %s' % (self.view_name, self.resolution, self.period_start)
+
+    @staticmethod
+    def truncate(moment, resolution):
+        moment = moment.replace(second=0, microsecond=0)
+        if resolution == EndpointRollup.HOUR:
+            moment = moment.replace(minute=0)
+        return moment
+
+    @property
+    def histogram_counts(self):
+        return json.loads(self.time_histogram) if self.time_histogram else new_histogram()
+
+    @property
+    def repeated_shapes(self):
+        return json.loads(self.repeated) if self.repeated else {}
+
+    def add(self, profile):
+        time_taken = profile['request'].time_taken or 0
+        num_queries = profile.get('num_queries', len(profile['queries']))
+        self.num_requests += 1
+        self.total_time += time_taken
+        self.max_time = max(self.max_time, time_taken)
+        histogram = self.histogram_counts
+        observe(histogram, time_taken)
+        self.time_histogram = json.dumps(histogram)
+        self.total_queries += num_queries
+        self.max_queries = max(self.max_queries, num_queries)
+        self.total_sql_time += profile.get('sql_time') or 0
+        # A shape is counted once per request, whichever databases it ran on
+        counts = defaultdict(int)
+        for (alias, fingerprint), pattern in (profile.get('patterns') or {}).items():
+            counts[fingerprint] += pattern['count']
+        shapes = {
+            fingerprint: [count, count, 1]
+            for fingerprint, count in counts.items() if count >= 2
+        }
+        if shapes:
+            self.repeated = json.dumps(merge_repeated(self.repeated_shapes, shapes))
+
+    def merge(self, other):
+        self.num_requests += other.num_requests
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.time_histogram = json.dumps(merge_histograms(self.histogram_counts, other.histogram_counts))
+        self.total_queries += other.total_queries
+        self.max_queries = max(self.max_queries, other.max_queries)
+        self.total_sql_time += other.total_sql_time
+        if other.repeated:
+            self.repeated = json.dumps(merge_repeated(self.repeated_shapes, other.repeated_shapes))
+
+
+# Repeated query shapes kept per rollup period
+MAX_REPEATED_SHAPES = 10
+
+
+def merge_repeated(shapes, other):
+    """
+    Add up two {fingerprint: [max per request, count, requests]} mappings
+    and keep the MAX_REPEATED_SHAPES most repeated in a request.
+    """
+    merged = dict(shapes)
+    for fingerprint, (max_per_request, count, num_requests) in other.items():
+        if fingerprint in merged:
+            totals = merged[fingerprint]
+            merged[fingerprint] = [
+                max(totals[0], max_per_request), totals[1] + count, totals[2] + num_requests]
+        else:
+            merged[fingerprint] = [max_per_request, count, num_requests]
+    if len(merged) > MAX_REPEATED_SHAPES:
+        kept = sorted(merged, key=lambda fingerprint: merged[fingerprint][:2], reverse=True)
+        merged = {fingerprint: merged[fingerprint] for fingerprint in kept[:MAX_REPEATED_SHAPES]}
+    return merged
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
@@ -0,0 +1,154 @@
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.utils import Singleton
+
+
+class ProfileSession(object):
+    """
+    The samples taken from one thread while a request runs on it.
+    """
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        # collapsed stack -> number of samples
+        self.counts = Counter()
+        # milliseconds the sampler spent on this request
+        self.meta_time = 0
+
+    @property
+    def num_samples(self):
+        return sum(self.counts.values())
+
+    def collapsed(self):
+        return format_collapsed(self.counts)
+
+
+class StackSampler(object):
+    """
+    One background thread per process which, every ``interval`` seconds,
+    reads the stack of the threads running a profiled request with
+    sys._current_frames(). Nothing is traced, the request threads only
+    pay for registering themselves, and the thread waits idle while no
+    request is profiled.
+    """
+
+    def __init__(self, interval=None, max_depth=None):
+        config = rq_settings.get_config()
+        self.interval = interval or config['PROFILE_INTERVAL']
+        self.max_depth = max_depth or config['PROFILE_MAX_DEPTH']
+        self._sessions = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='repeat-queries-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def start(self, thread_id=None):
+        session = ProfileSession(thread_id or threading.get_ident())
+        self._ensure_worker()
+        with self._lock:
+            self._sessions[session.thread_id] = session
+            self._active.set()
+        return session
+
+    def stop(self, session):
+        # Taken while sampling, no sample is added once this returns
+        with self._lock:
+            if self._sessions.get(session.thread_id) is session:
+                del self._sessions[session.thread_id]
+            if not self._sessions:
+                self._active.clear()
+        return session
+
+    def _run(self):
+        while True:
+            # Idle until a request is profiled
+            self._active.wait()
+            sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        with self._lock:
+            if not self._sessions:
+                return
+            start = perf_counter()
+            frames = sys._current_frames()
+            for thread_id, session in self._sessions.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    session.counts[self._collapse(frame)] += 1
+            elapsed = (perf_counter() - start) * 1000 / len(self._sessions)
+            for session in self._sessions.values():
+                session.meta_time += elapsed
+
+    def _label(self, frame):
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            if len(self._labels) > 10000:
+                self._labels.clear()
+            label = self._labels[code] = '%s:%s' % (
+                frame.f_globals.get('__name__', code.co_filename), code.co_name)
+        return label
+
+    def _collapse(self, frame):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame))
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+
+def format_collapsed(counts):
+    """
+    Render {stack: count} in the collapsed format read by flamegraph.pl and
+    speedscope, one ``outer;inner count`` line per stack.
+    """
+    return ''.join(
+        '%s %d\n' % (stack, count)
+        for stack, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    )
+
+
+def parse_collapsed(text):
+    counts = Counter()
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+def merge_collapsed(texts):
+    """
+    Add up the collapsed profiles of several requests.
+    """
+    counts = Counter()
+    for text in texts:
+        counts.update(parse_collapsed(text))
+    return counts
+
+
+_profiler = Singleton(StackSampler)
+
+
+def get_profiler():
+    return _profiler.get()
@@ -0,0 +1,46 @@
+"""
+Fails the tests whose requests ran a query shape N_PLUS_ONE_THRESHOLD
+times, enable it with ``pytest -p repeat_queries.pytest_plugin`` or
+``pytest_plugins = ['repeat_queries.pytest_plugin']`` in conftest.py.
+Requests are recorded in memory only, see repeat_queries.testing.
+"""
+import pytest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('repeat_queries')
+    group.addoption(
+        '--n-plus-one-threshold', type=int, default=None,
+        help='Times a query shape may run in one request, defaults to '
+             'N_PLUS_ONE_THRESHOLD or 10')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _repeat_queries_settings(request):
+    # Imported once pytest-django set Django up
+    from repeat_queries import testing
+    settings = testing.recording_settings(request.config.getoption('n_plus_one_threshold'))
+    settings.enable()
+    yield
+    settings.disable()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    # Fails in the call phase, after the test's own assertions passed, so
+    # an N+1 is reported as a failure of the test and not a teardown error
+    from repeat_queries import testing
+    testing.reset_repeated_queries()
+    outcome = yield
+    report = testing.repeated_queries_report()
+    if report and outcome.excinfo is None:
+        pytest.fail('N+1 queries:\n' + report, pytrace=False)
+
+
+@pytest.fixture
+def query_capture():
+    """
+    QueryCapture, to use as ``with query_capture(max_queries=3): ...``
+    """
+    from repeat_queries.testing import QueryCapture
+    return QueryCapture
@@ -1,14 +1,54 @@
+from collections import defaultdict
+from functools import lru_cache
 from time import time
 import json
+import logging
 import datetime
+from uuid import uuid4
 from pprint import saferepr
 from django.db import connections
-from django.utils import six
 from django.utils import timezone
-from django.utils.encoding import force_text
-SQL_WARNING_THRESHOLD = 1200
-from repeat_queries.utils import convert_epoch_to_datetime
-from repeat_queries.models import Request, SQLQuery
+from django.utils.module_loading import import_string
+from repeat_queries import capture, settings as rq_settings
+from repeat_queries.context import (
+    get_current_recorder, reset_current_recorder, set_current_recorder
+)
+from repeat_queries.explain import get_explainer
+from repeat_queries.fingerprint import fingerprint
+from repeat_queries.histogram import new_histogram, observe
+from repeat_queries.profiler import get_profiler
+from repeat_queries.utils import (
+    convert_epoch_to_datetime, quote_expr, quote_params, serialize_params
+)
+from repeat_queries.models import Request, SQLQuery, Transaction
+from repeat_queries.relations import code_line, format_suggestion, suggest
+from repeat_queries.stack import StackTable, format_full_stack
+from repeat_queries.writers import get_writer
+
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache()
+def load_hooks(paths):
+    return [import_string(path) for path in paths]
+
+
+class NPlusOneError(Exception):
+    """
+    Raised when N_PLUS_ONE_ACTION is 'raise' and a query is run
+    N_PLUS_ONE_THRESHOLD times in one request.
+    """
+
+
+# The keys used to determine similar and duplicate queries.
+def similar_key(query):
+    return fingerprint(query['raw_sql'])[1]
+
+
+def duplicate_key(query):
+    raw_params = () if query['raw_params'] is None else tuple(query['raw_params'])
+    return (query['raw_sql'], saferepr(raw_params))
 
 
 class NormalCursorWrapper(object):
@@ -24,49 +64,58 @@ class NormalCursorWrapper(object):
         self.logger = logger
 
     def _quote_expr(self, element):
-        if isinstance(element, six.string_types):
-            return "'%s'" % force_text(element).replace("'", "''")
-        else:
-            return repr(element)
+        return quote_expr(element)
 
     def _quote_params(self, params):
-        if not params:
-            return params
-        if isinstance(params, dict):
-            return {key: self._quote_expr(value) for key, value in params.items()}
-        return [self._quote_expr(p) for p in params]
+        return quote_params(params)
 
-    def _record(self, method, sql, params):
+    def _record(self, method, sql, params, many=False):
         start_time = time()
         try:
             return method(sql, params)
         finally:
             stop_time = time()
             duration = (stop_time - start_time) * 1000
-            import traceback
-            stacktrace = ''.join(reversed(traceback.format_stack()))
 
             alias = getattr(self.db, 'alias', 'default')
-            conn = self.db.connection
-            vendor = getattr(conn, 'vendor', 'unknown')
-
-            params = {
-                'vendor': vendor,
-                'alias': alias,
-                'sql': self.db.ops.last_executed_query(
-                    self.cursor, sql, self._quote_params(params)),
-                'duration': duration,
-                'raw_sql': sql,
-                'raw_params': params,
-                'stacktrace': stacktrace,
-                'start_time': start_time,
-                'stop_time': stop_time,
-                # 'is_slow': duration > dt_settings.get_config()['SQL_WARNING_THRESHOLD'],
-                'is_select': sql.lower().strip().startswith('select'),
-            }
-            print ('From inside the custom cursor record')
-            # We keep `sql` to maintain backwards compatibility
-            self.logger.record(**params)
+            if getattr(self.logger, 'capture_queries', True):
+                self._log(alias, sql, params, start_time, stop_time, duration, many)
+            else:
+                # Request was not sampled, only keep the totals
+                self.logger.count(alias, duration)
+
+    def _log(self, alias, sql, params, start_time, stop_time, duration, many=False):
+        vendor = getattr(self.db, 'vendor', 'unknown')
+        trans_id, savepoint_id = self.logger.current_transaction(alias, self.db, start_time)
+
+        num_rows = None
+        if many:
+            # Only keep the first rows of an executemany, iterators can
+            # not be sliced without consuming them so they are dropped.
+            if isinstance(params, (list, tuple)):
+                num_rows = len(params)
+                params = params[:self.logger.max_executemany_rows]
+            else:
+                params = None
+
+        # The interpolated SQL is not built here, it is rendered from
+        # raw_sql and raw_params (see utils.interpolate_sql) when shown.
+        params = {
+            'vendor': vendor,
+            'alias': alias,
+            'duration': duration,
+            'raw_sql': sql,
+            'raw_params': params,
+            'many': many,
+            'num_rows': num_rows,
+            'start_time': start_time,
+            'stop_time': stop_time,
+            'is_slow': duration > self.logger.slow_threshold,
+            'is_select': sql.lstrip()[:6].lower() == 'select',
+            'trans_id': trans_id,
+            'savepoint_id': savepoint_id,
+        }
+        self.logger.record(**params)
 
     def callproc(self, procname, params=None):
         return self._record(self.cursor.callproc, procname, params)
@@ -75,7 +124,7 @@ class NormalCursorWrapper(object):
         return self._record(self.cursor.execute, sql, params)
 
     def executemany(self, sql, param_list):
-        return self._record(self.cursor.executemany, sql, param_list)
+        return self._record(self.cursor.executemany, sql, param_list, many=True)
 
     def __getattr__(self, attr):
         return getattr(self.cursor, attr)
@@ -90,141 +139,380 @@ class NormalCursorWrapper(object):
         self.close()
 
 
-def wrap_cursor(connection, logger):
+def _wrap_transaction_end(connection, method, outcome):
+    def end(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            recorder = get_current_recorder()
+            if recorder is not None:
+                recorder.end_transaction(connection.alias, outcome)
+    return end
+
+
+def wrap_cursor(connection):
+    """
+    Patch the connection once so its cursors report to the recorder of the
+    current request, looked up when the cursor is created. The patch is
+    never removed: under ASGI several requests can share a connection, so
+    undoing it at the end of one request would stop recording the others.
+    commit() and rollback(), called when the outermost atomic block exits,
+    tell the recorder the transaction ended.
+    """
     if not hasattr(connection, 'custom_cursor'):
         connection.custom_cursor = connection.cursor
+        connection.custom_commit = connection.commit
+        connection.custom_rollback = connection.rollback
+        connection.commit = _wrap_transaction_end(connection, connection.custom_commit, 'commit')
+        connection.rollback = _wrap_transaction_end(connection, connection.custom_rollback, 'rollback')
 
         def cursor(*args, **kwargs):
-            return NormalCursorWrapper(connection.custom_cursor(*args, **kwargs), connection, logger)
+            recorder = get_current_recorder()
+            if recorder is None:
+                return connection.custom_cursor(*args, **kwargs)
+            return NormalCursorWrapper(connection.custom_cursor(*args, **kwargs), connection, recorder)
 
         connection.cursor = cursor
         return cursor
 
 
-def unwrap_cursor(connection, logger):
-    if hasattr(connection, 'custom_cursor'):
-        del connection.custom_cursor
-        del connection.cursor
-
-
 class SqlRecorder(object):
-    def __init__(self, *args, **kwargs):
+    # Recorders enabled while this one is current pass their queries on to
+    # it, see repeat_queries.testing. Off for request recorders, so one
+    # left current by a failed request is never picked up as a parent.
+    nested = False
+    # Writer of the requests recorded by this recorder and those nested in
+    # it, the WRITER setting when None
+    writer = None
+
+    def __init__(self, capture_queries=True, *args, **kwargs):
         super(SqlRecorder, self).__init__(*args, **kwargs)
-        self._offset = {k: len(connections[k].queries) for k in connections}
+        # When False only the number of queries and their total time are
+        # kept, used for requests which were not sampled.
+        self.capture_queries = capture_queries
         self._sql_time = 0
         self._num_queries = 0
         self._queries = []
         self._databases = {}
-        self._transaction_status = {}
+        # alias -> id of the transaction open on it, and the totals of
+        # every transaction seen, by id
         self._transaction_ids = {}
+        self._transactions = {}
+        self._sql_transactions = []
+        self._sql_queries = []
+        self._patterns = {}
         self.request = None
+        # The recorder which was current when this one was enabled, e.g. a
+        # repeat_queries.testing.QueryCapture around a test client request
+        self._parent = None
+        # Restores the recorder current before enable_instrumentation
+        self._token = None
+        config = rq_settings.get_config()
+        self._stack_mode = config['STACK_MODE']
+        self._stack_only_repeated = config['STACK_ONLY_REPEATED']
+        self._stacks = StackTable(
+            depth=config['STACK_DEPTH'],
+            hide_libraries=config['STACK_HIDE_LIBRARIES'],
+        )
+        self._similar_counts = defaultdict(lambda: defaultdict(int))
+        self._duplicate_counts = defaultdict(lambda: defaultdict(int))
+        self._verbosity = config['VERBOSITY']
+        self._summary_hooks = config['SUMMARY_HOOKS']
+        self.slow_threshold = config['SQL_WARNING_THRESHOLD']
+        self._explain = config['EXPLAIN']
+        self._explain_repeat_threshold = config['EXPLAIN_REPEAT_THRESHOLD']
+        self.max_executemany_rows = config['MAX_EXECUTEMANY_ROWS']
+        self._store_params = config['STORE_PARAMS']
+        self._store_queries = config['STORE_QUERIES']
+        self._store_patterns = config['STORE_PATTERNS']
+        self._body_capture = config['BODY_CAPTURE']
+        self._max_body_size = config['MAX_BODY_SIZE']
+        self._body_content_types = config['BODY_CONTENT_TYPES']
+        self._record_headers = config['RECORD_HEADERS']
+        self._record_query_params = config['RECORD_QUERY_PARAMS']
+        self._max_recorded_values = config['MAX_RECORDED_VALUES']
+        self._max_recorded_value_length = config['MAX_RECORDED_VALUE_LENGTH']
+        self._profile = config['PROFILE']
+        self._profile_session = None
+        self._long_transaction_threshold = config['LONG_TRANSACTION_THRESHOLD']
+        self._repeat_threshold = config['N_PLUS_ONE_THRESHOLD']
+        self._repeat_action = config['N_PLUS_ONE_ACTION']
+        if self._repeat_action not in ('log', 'raise', None):
+            self._repeat_action = import_string(self._repeat_action)
 
     def enable_instrumentation(self):
-        # This is thread-safe because database connections are thread-local.
+        # The recorder is kept in a context variable, so concurrent requests
+        # in threads or asyncio tasks each record into their own recorder.
+        recorder_alias = rq_settings.get_config()['DATABASE']
         for connection in connections.all():
-            wrap_cursor(connection, self)
+            # Our own writes on a dedicated database are never recorded
+            if connection.alias != recorder_alias:
+                wrap_cursor(connection)
+        parent = get_current_recorder()
+        self._parent = parent if getattr(parent, 'nested', False) else None
+        if self._parent is not None and self._parent.capture_queries:
+            # The queries are passed on to the parent, which needs them all
+            self.capture_queries = True
+        self._token = set_current_recorder(self)
 
     def disable_instrumentation(self):
-        for connection in connections.all():
-            unwrap_cursor(connection, self)
+        # Safe to call twice, the middleware calls it again when a request
+        # ends with an exception
+        if self._token is not None:
+            reset_current_recorder(self._token)
+            self._token = None
 
     def record_request(self, request):
         # When we start a request, let's create request object
         self.profile = {
             'path': request.path,
-            'body': request.body,
             'method': request.method,
-            'start_time': timezone.now()
+            'start_time': timezone.now(),
+            'query_params': capture.query_params(
+                request, self._record_query_params,
+                self._max_recorded_values, self._max_recorded_value_length),
+            'encoded_headers': capture.headers(
+                request, self._record_headers,
+                self._max_recorded_values, self._max_recorded_value_length),
         }
-        request = Request.objects.create(**self.profile)
-        self.request = request
+        # Only built in memory here, the writer stores it once the response
+        # is done so the request does not pay for our INSERTs.
+        self.request = Request(**self.profile)
+        self._sql_queries = []
+        if self._profile and self.capture_queries:
+            self._profile_session = get_profiler().start()
+
+    def stop_profiling(self):
+        """
+        Store the samples taken since record_request in Request.pyprofile,
+        with the time the sampler spent on them in meta_time.
+        """
+        session, self._profile_session = self._profile_session, None
+        if session is None or self.request is None:
+            return
+        get_profiler().stop(session)
+        self.request.pyprofile = session.collapsed()
+        self.request.meta_time = session.meta_time
 
     def record_request_end(self, request):
         from .models import _time_taken
-        if hasattr(self, 'request'):
+        if self.request is not None:
+            if not self.request.view_name:
+                self.request.view_name = capture.view_name(request)
+            # Read at the end so the view decides how the body is read
+            self.request.body = capture.body(
+                request, self._body_capture, self._max_body_size, self._body_content_types)
             self.request.end_time = timezone.now()
             self.request.time_taken = _time_taken(self.request.start_time, self.request.end_time)
-            self.request.save()
+
+    def persist(self):
+        if self.request is None:
+            return
+        writer = self.writer or getattr(self._parent, 'writer', None) or get_writer()
+        # Written with no recorder current, so a recorder this one is
+        # nested in does not count the writer's queries
+        token = set_current_recorder(None)
+        try:
+            writer.write({
+                'request': self.request,
+                'queries': self._sql_queries,
+                'patterns': self._patterns,
+                'num_queries': self._num_queries,
+                'sql_time': self._sql_time,
+                'transactions': self._sql_transactions,
+            })
+        finally:
+            reset_current_recorder(token)
+
+    def summary(self, response=None):
+        """
+        One compact dict describing the request, for logging and hooks.
+        """
+        repeated = []
+        similar_queries = duplicate_queries = 0
+        for alias, counts in self._similar_counts.items():
+            for key, count in counts.items():
+                if count >= 2:
+                    similar_queries += count
+                    repeated.append((count, key))
+        for alias, counts in self._duplicate_counts.items():
+            duplicate_queries += sum(count for count in counts.values() if count >= 2)
+        suggestions = [
+            {
+                'suggestion': pattern['suggestion'],
+                'line': pattern['suggestion_line'],
+                'saved_queries': pattern['saved_queries'],
+                'saved_time': pattern['total_duration'] * pattern['saved_queries'] / pattern['count'],
+            }
+            for pattern in self._patterns.values() if pattern.get('suggestion')
+        ]
+        request = self.request
+        return {
+            'path': request.path if request else None,
+            'method': request.method if request else None,
+            'view_name': request.view_name if request else None,
+            'status_code': getattr(response, 'status_code', None),
+            'time_taken': (request.time_taken if request else None) or 0,
+            'num_queries': self._num_queries,
+            'sql_time': self._sql_time,
+            'similar_queries': similar_queries,
+            'duplicate_queries': duplicate_queries,
+            'top_repeated': [(key, count) for count, key in sorted(repeated, reverse=True)[:5]],
+            'suggestions': suggestions,
+        }
+
+    def report(self, response=None):
+        """
+        Log the request summary and hand it to the SUMMARY_HOOKS.
+        """
+        hooks = load_hooks(tuple(self._summary_hooks))
+        if self._verbosity < 1 and not hooks:
+            return
+        summary = self.summary(response)
+        if self._verbosity >= 1:
+            logger.info(
+                '%(method)s %(path)s %(status_code)s: %(time_taken).1fms, '
+                '%(num_queries)d queries in %(sql_time).1fms, '
+                '%(similar_queries)d similar, %(duplicate_queries)d duplicates',
+                summary)
+        for hook in hooks:
+            hook(summary)
+
+    def count(self, alias, duration):
+        if alias not in self._databases:
+            self._databases[alias] = {'time_spent': 0, 'num_queries': 0}
+        self._databases[alias]['time_spent'] += duration
+        self._databases[alias]['num_queries'] += 1
+        self._sql_time += duration
+        self._num_queries += 1
 
     def record(self, alias, **kwargs):
+        if self._parent is not None:
+            self._parent.record(alias, **kwargs)
+        kwargs['similar_key'] = similar_key(kwargs)
+        similar_counts = self._similar_counts[alias]
+        similar_counts[kwargs['similar_key']] += 1
+        count = similar_counts[kwargs['similar_key']]
+
+        # With STACK_ONLY_REPEATED the stack is only captured once the
+        # shape runs a second time, queries which run once cost nothing.
+        if count >= 2 or not self._stack_only_repeated:
+            if self._stack_mode == 'frames':
+                kwargs['stack'] = self._stacks.capture()
+            elif self._stack_mode == 'full':
+                kwargs['stacktrace'] = format_full_stack()
         self._queries.append((alias, kwargs))
-        if alias not in self._databases:
-            self._databases[alias] = {
-                'time_spent': kwargs['duration'],
-                'num_queries': 1,
+        self.count(alias, kwargs['duration'])
+
+        if count == self._repeat_threshold:
+            self.on_repeated_query(alias, kwargs, self._repeat_threshold)
+
+    def count_duplicates(self):
+        """
+        Count the queries run with the same SQL and parameters. Only the
+        queries of a repeated shape can be duplicates, so the parameters
+        of the others are never compared.
+        """
+        self._duplicate_counts = defaultdict(lambda: defaultdict(int))
+        for alias, query in self._queries:
+            if self._similar_counts[alias][query['similar_key']] >= 2:
+                query['duplicate_key'] = duplicate_key(query)
+                self._duplicate_counts[alias][query['duplicate_key']] += 1
+        return self._duplicate_counts
+
+    def current_transaction(self, alias, connection, start_time):
+        """
+        Return the (transaction id, savepoint id) a query starting now on
+        ``connection`` runs in, (None, None) in autocommit mode.
+        """
+        if not connection.in_atomic_block and connection.get_autocommit():
+            if alias in self._transaction_ids:
+                # Ended without going through commit() or rollback()
+                self.end_transaction(alias, '')
+            return None, None
+        trans_id = self._transaction_ids.get(alias)
+        if trans_id is None:
+            trans_id = self._transaction_ids[alias] = uuid4().hex
+            self._transactions[trans_id] = {
+                'alias': alias,
+                'start_time': start_time,
+                'end_time': None,
+                'outcome': '',
+                'num_queries': 0,
+                'sql_time': 0,
             }
-        else:
-            self._databases[alias]['time_spent'] += kwargs['duration']
-            self._databases[alias]['num_queries'] += 1
-        self._sql_time += kwargs['duration']
-        self._num_queries += 1
+        savepoint_ids = getattr(connection, 'savepoint_ids', None)
+        return trans_id, savepoint_ids[-1] if savepoint_ids else None
+
+    def end_transaction(self, alias, outcome):
+        trans_id = self._transaction_ids.pop(alias, None)
+        if trans_id is not None:
+            self._transactions[trans_id]['end_time'] = time()
+            self._transactions[trans_id]['outcome'] = outcome
+
+    def on_repeated_query(self, alias, query, count):
+        """
+        Called as soon as a query shape was run N_PLUS_ONE_THRESHOLD times
+        in this request, while the request is still running.
+        """
+        action = self._repeat_action
+        if callable(action):
+            action(self, alias, query, count)
+        elif action == 'raise':
+            raise NPlusOneError(
+                'Query repeated %d times on %r: %s' % (count, alias, query['raw_sql']))
+        elif action == 'log':
+            logger.warning(
+                'Query repeated %d times on %r: %s', count, alias, query['raw_sql'])
 
     def generate_stats(self, request, response):
-        from collections import defaultdict
-        query_similar = defaultdict(lambda: defaultdict(int))
-        query_duplicates = defaultdict(lambda: defaultdict(int))
-
-        # The keys used to determine similar and duplicate queries.
-        def similar_key(query):
-            return query['raw_sql']
-
-        def duplicate_key(query):
-            raw_params = () if query['raw_params'] is None else tuple(query['raw_params'])
-            return (query['raw_sql'], saferepr(raw_params))
-
-        if self._queries:
-
-            trans_ids = {}
-            trans_id = None
-            i = 0
-            for alias, query in self._queries:
-                query_similar[alias][similar_key(query)] += 1
-                query_duplicates[alias][duplicate_key(query)] += 1
-
-                trans_id = query.get('trans_id')
-                last_trans_id = trans_ids.get(alias)
-
-                if trans_id != last_trans_id:
-                    if last_trans_id:
-                        self._queries[(i - 1)][1]['ends_trans'] = True
-                    trans_ids[alias] = trans_id
-                    if trans_id:
-                        query['starts_trans'] = True
-                if trans_id:
-                    query['in_trans'] = True
+        # Flag the first and last query of each transaction, per alias
+        trans_ids = {}
+        last_queries = {}
+        for alias, query in self._queries:
+            trans_id = query.get('trans_id')
+            last_trans_id = trans_ids.get(alias)
 
+            if trans_id != last_trans_id:
+                if last_trans_id:
+                    last_queries[alias]['ends_trans'] = True
+                trans_ids[alias] = trans_id
+                if trans_id:
+                    query['starts_trans'] = True
+            if trans_id:
+                query['in_trans'] = True
+                transaction = self._transactions[trans_id]
+                transaction['num_queries'] += 1
+                transaction['sql_time'] += query['duration']
+                transaction['last_stop_time'] = query['stop_time']
+            last_queries[alias] = query
+
+        for alias, trans_id in trans_ids.items():
             if trans_id:
-                self._queries[(i - 1)][1]['ends_trans'] = True
+                last_queries[alias]['ends_trans'] = True
+        self._transaction_stats()
 
         # Queries are similar / duplicates only if there's as least 2 of them.
-        # Also, to hide queries, we need to give all the duplicate groups an id
-        query_similar_groups = {
-            alias: {
-                query: similar_count
-                for query, similar_count in queries.items()
-                if similar_count >= 2
-            }
-            for alias, queries in query_similar.items()
-        }
-        query_duplicates_groups = {
-            alias: {
-                query: duplicate_count
-                for query, duplicate_count in queries.items()
-                if duplicate_count >= 2
-            }
-            for alias, queries in query_duplicates.items()
-        }
-
-        for alias, query in self._queries:
-            try:
-                query["similar_count"] = query_similar_groups[alias][similar_key(query)]
-                query["duplicate_count"] = query_duplicates_groups[alias][duplicate_key(query)]
-            except KeyError:
-                pass
-
-        print ('Inside stats recorder generate stats')
-        print (self._queries)
+        # The similar counts were kept up to date by record().
+        self.count_duplicates()
         for alias, query in self._queries:
+            similar_count = self._similar_counts[alias][query['similar_key']]
+            if similar_count >= 2:
+                query['similar_count'] = similar_count
+                duplicate_count = self._duplicate_counts[alias][query['duplicate_key']]
+                if duplicate_count >= 2:
+                    query['duplicate_count'] = duplicate_count
+
+        if self._verbosity >= 2:
+            # Formatted by the logging handler, only if it is enabled
+            logger.debug('Queries of %s: %r', self.request.path if self.request else '', self._queries)
+        self._sql_queries = []
+        self._patterns = {}
+        for index, (alias, query) in enumerate(self._queries):
+            if self._store_patterns:
+                self._add_to_pattern(alias, query, index)
+            if not self._store_queries:
+                continue
             k = {
                 'query': query['raw_sql'],
                 'duration': query['duration'],
@@ -232,9 +520,124 @@ class SqlRecorder(object):
                 'stop_time': convert_epoch_to_datetime(query['stop_time']),
                 'duplicate_count': query.get('duplicate_count'),
                 'similar_count': query.get('similar_count'),
+                'fingerprint': query['similar_key'],
+                'params': self._serialize_params(query) if self._store_params else '',
                 'request': self.request,
-                'traceback': query.get('stacktrace')
+                'traceback': self._render_stack(query),
+                'trans_id': query.get('trans_id') or '',
+            }
+            self._sql_queries.append(SQLQuery(**k))
+        if self._store_patterns:
+            self._suggest_relations()
+        if self._explain:
+            self._explain_patterns()
+
+    def _transaction_stats(self):
+        self._sql_transactions = []
+        for trans_id, transaction in self._transactions.items():
+            if not transaction['num_queries']:
+                continue
+            # Still open when the response was done: it ended with its
+            # last query as far as we know
+            end_time = transaction['end_time'] or transaction['last_stop_time']
+            duration = (end_time - transaction['start_time']) * 1000
+            idle_time = max(duration - transaction['sql_time'], 0)
+            if self._long_transaction_threshold is not None and \
+                    duration > self._long_transaction_threshold:
+                logger.warning(
+                    'Transaction on %r of %s held open %.1fms, %.1fms of it between '
+                    'its %d queries', transaction['alias'],
+                    self.request.path if self.request else '',
+                    duration, idle_time, transaction['num_queries'])
+            self._sql_transactions.append(Transaction(
+                request=self.request,
+                trans_id=trans_id,
+                alias=transaction['alias'],
+                start_time=convert_epoch_to_datetime(transaction['start_time']),
+                end_time=convert_epoch_to_datetime(end_time),
+                duration=duration,
+                num_queries=transaction['num_queries'],
+                sql_time=transaction['sql_time'],
+                idle_time=idle_time,
+                outcome=transaction['outcome'],
+            ))
+
+    def _explain_patterns(self):
+        # Plans are stored on QueryPattern rows, a background worker runs
+        # them so the request only pays for queueing.
+        for (alias, key), pattern in self._patterns.items():
+            if not pattern['is_select']:
+                continue
+            if (pattern['max_duration'] > self.slow_threshold or
+                    pattern['count'] >= self._explain_repeat_threshold):
+                get_explainer().submit(
+                    key, alias, pattern['sample_query'], pattern['sample_params'])
+
+    def _suggest_relations(self):
+        # A shape repeated in a request is usually a relation loaded once
+        # per object of the query run just before the loop.
+        for pattern in self._patterns.values():
+            if pattern['count'] < 2:
+                continue
+            index = pattern['first_index']
+            alias, query = self._queries[index]
+            parent_sql = None
+            for position in range(index - 1, -1, -1):
+                previous_alias, previous = self._queries[position]
+                if previous_alias == alias and previous['is_select'] and \
+                        previous['similar_key'] != query['similar_key']:
+                    parent_sql = previous['raw_sql']
+                    break
+            suggestion = suggest(pattern['sample_query'], parent_sql)
+            if suggestion is None:
+                continue
+            method, owner, name = suggestion
+            pattern['suggestion'] = format_suggestion(method, owner, name)
+            pattern['suggestion_line'] = code_line(pattern['stack'])
+            # select_related joins the rows into the parent query,
+            # prefetch_related loads them with one query
+            pattern['saved_queries'] = (
+                pattern['count'] if method == 'select_related' else pattern['count'] - 1)
+
+    def _add_to_pattern(self, alias, query, index=None):
+        # The same shape on two databases is two patterns
+        key = (alias, query['similar_key'])
+        pattern = self._patterns.get(key)
+        if pattern is None:
+            pattern = self._patterns[key] = {
+                'count': 0,
+                'total_duration': 0,
+                'min_duration': query['duration'],
+                'max_duration': query['duration'],
+                'histogram': new_histogram(),
+                'sample_query': query['raw_sql'],
+                'sample_traceback': self._render_stack(query),
+                # frames of the first query with a stack, the first query
+                # has none with STACK_ONLY_REPEATED
+                'stack': query.get('stack'),
+                'sample_params': query['raw_params'],
+                'is_select': query['is_select'],
+                'first_index': index,
             }
-            sql_query = SQLQuery.objects.create(**k)
-            # sql_query.save()
-            print (sql_query)
+        if pattern['stack'] is None and 'stack' in query:
+            pattern['stack'] = query['stack']
+        if not pattern['sample_traceback']:
+            pattern['sample_traceback'] = self._render_stack(query)
+        pattern['count'] += 1
+        pattern['total_duration'] += query['duration']
+        pattern['min_duration'] = min(pattern['min_duration'], query['duration'])
+        pattern['max_duration'] = max(pattern['max_duration'], query['duration'])
+        observe(pattern['histogram'], query['duration'])
+
+    def _serialize_params(self, query):
+        if query['many']:
+            return serialize_params({
+                'executemany': query['raw_params'],
+                'num_rows': query['num_rows'],
+            })
+        return serialize_params(query['raw_params'])
+
+    def _render_stack(self, query):
+        if 'stack' in query:
+            return self._stacks.render(query['stack'])
+        return query.get('stacktrace', '')
@@ -0,0 +1,123 @@
+import os
+import re
+from functools import lru_cache
+
+from django.apps import apps
+from django.db.models import F, FloatField
+from django.db.models.expressions import ExpressionWrapper
+
+from repeat_queries.advisor import extract_columns
+from repeat_queries.models import QueryPattern
+
+
+_FROM_RE = re.compile(r'\bFROM\s+[`"\[]?(\w+)', re.I)
+
+
+def main_table(sql):
+    match = _FROM_RE.search(sql)
+    return match.group(1) if match else None
+
+
+def _relations_to(model, column):
+    """
+    Relations which load rows of ``model`` looking them up by ``column``,
+    as (method, owner model, relation name).
+    """
+    relations = []
+    for owner in apps.get_models():
+        for field in owner._meta.concrete_fields:
+            if (field.many_to_one or field.one_to_one) and field.related_model is model and \
+                    field.target_field.column == column:
+                # post.author
+                relations.append(('select_related', owner, field.name))
+    for field in model._meta.concrete_fields:
+        if field.column != column or not (field.many_to_one or field.one_to_one):
+            continue
+        if model._meta.auto_created:
+            # post.tags.all(), filtered on the intermediary table
+            for owner in apps.get_models():
+                for m2m in owner._meta.many_to_many:
+                    if m2m.remote_field.through is not model:
+                        continue
+                    if m2m.m2m_field_name() == field.name:
+                        relations.append(('prefetch_related', owner, m2m.name))
+                    else:
+                        relations.append((
+                            'prefetch_related', m2m.related_model,
+                            m2m.remote_field.get_accessor_name()))
+        elif field.one_to_one:
+            # author.profile
+            relations.append((
+                'select_related', field.related_model, field.remote_field.get_accessor_name()))
+        else:
+            # author.post_set.all()
+            relations.append((
+                'prefetch_related', field.related_model, field.remote_field.get_accessor_name()))
+    return relations
+
+
+@lru_cache(maxsize=1024)
+def lazy_relations(sql):
+    """
+    Return the relations whose lazy loading runs ``sql``: a SELECT filtered
+    on a single column, the primary key of a related model or its foreign
+    key. Each is a (method, owner model, relation name, owner table).
+    Cached on the statement, the ORM issues the same one in every loop.
+    """
+    if sql.lstrip()[:6].lower() != 'select':
+        return ()
+    where = {(table, column) for clause, table, column in extract_columns(sql) if clause == 'where'}
+    if len(where) != 1:
+        return ()
+    table, column = where.pop()
+    relations = []
+    for model in apps.get_models(include_auto_created=True):
+        if model._meta.db_table == table:
+            relations.extend(_relations_to(model, column))
+    return tuple(
+        (method, owner, name, owner._meta.db_table) for method, owner, name in relations)
+
+
+def suggest(sql, parent_sql=None):
+    """
+    Return ``(method, owner model, relation name)`` for the relation a
+    repeated query lazily loads, or None when it can not be told. The query
+    run before the loop (``parent_sql``) picks the owner when several
+    relations load the same rows.
+    """
+    relations = lazy_relations(sql)
+    if len(relations) > 1 and parent_sql:
+        parent_table = main_table(parent_sql)
+        relations = [relation for relation in relations if relation[3] == parent_table]
+    if len(relations) != 1:
+        return None
+    return relations[0][:3]
+
+
+def format_suggestion(method, owner, name):
+    return "%s.objects.%s('%s')" % (owner._meta.object_name, method, name)
+
+
+def code_line(frames):
+    """
+    The innermost user code frame of a stack captured in 'frames' mode,
+    as path:line in function.
+    """
+    for filename, lineno, function in frames or ():
+        if function != '<module>':
+            return '%s:%d in %s' % (os.path.relpath(filename), lineno, function)
+    return ''
+
+
+def relation_suggestions(view_name=None):
+    """
+    The select_related / prefetch_related suggestions recorded in
+    QueryPattern, the ones saving the most time first.
+    """
+    patterns = QueryPattern.objects.exclude(suggestion='').annotate(
+        saving=ExpressionWrapper(
+            F('total_duration') * F('saved_queries') / F('count'), output_field=FloatField()),
+    ).order_by('view_name', '-saving')
+    if view_name is not None:
+        patterns = patterns.filter(view_name=view_name)
+    return patterns
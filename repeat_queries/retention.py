@@ -0,0 +1,65 @@
+from time import time
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.models import EndpointRollup, QueryPattern, Request, SQLQuery, Transaction
+
+
+def _cutoff(max_age, max_rows):
+    """
+    Return the start_time at or before which requests are removed.
+    """
+    cutoffs = []
+    if max_age is not None:
+        cutoffs.append(timezone.now() - max_age)
+    if max_rows is not None:
+        oldest_kept = Request.objects.order_by('-start_time').values_list(
+            'start_time', flat=True)[max_rows:max_rows + 1]
+        cutoffs.extend(oldest_kept)
+    return max(cutoffs) if cutoffs else None
+
+
+def prune(max_age=None, max_rows=None, chunk_size=None, max_chunks=None):
+    """
+    Delete requests older than ``max_age`` (a timedelta) or beyond the
+    ``max_rows`` most recent ones, with their queries, ``chunk_size``
+    requests at a time walking the start_time index, and the query
+    patterns not seen within ``max_age``. Per minute endpoint totals older
+    than ROLLUP_MINUTE_MAX_AGE are deleted as well.
+
+    Returns the number of deleted rows and the time it took.
+    """
+    config = rq_settings.get_config()
+    chunk_size = chunk_size or config['RETENTION_CHUNK_SIZE']
+    stats = {'requests': 0, 'queries': 0, 'patterns': 0, 'rollups': 0, 'chunks': 0}
+    start = time()
+    cutoff = _cutoff(max_age, max_rows)
+    while cutoff is not None and (max_chunks is None or stats['chunks'] < max_chunks):
+        ids = list(
+            Request.objects.filter(start_time__lte=cutoff)
+            .order_by('start_time').values_list('pk', flat=True)[:chunk_size]
+        )
+        if not ids:
+            break
+        with transaction.atomic(using=router.db_for_write(Request)):
+            # The children first, with a plain DELETE each, so the cascade
+            # of the requests only finds empty tables and loads their pks.
+            stats['queries'] += SQLQuery.objects.filter(request_id__in=ids).delete()[0]
+            Transaction.objects.filter(request_id__in=ids).delete()
+            deleted = Request.objects.filter(pk__in=ids).only('pk').delete()[1]
+            stats['requests'] += deleted.get(Request._meta.label, 0)
+        stats['chunks'] += 1
+    if max_age is not None:
+        stats['patterns'] = QueryPattern.objects.filter(
+            last_seen__lt=timezone.now() - max_age).delete()[0]
+    if config['ROLLUP_MINUTE_MAX_AGE'] is not None:
+        stats['rollups'] = EndpointRollup.objects.filter(
+            resolution=EndpointRollup.MINUTE,
+            period_start__lt=timezone.now() - config['ROLLUP_MINUTE_MAX_AGE'],
+        ).delete()[0]
+    stats['seconds'] = time() - start
+    rows = stats['requests'] + stats['queries'] + stats['patterns'] + stats['rollups']
+    stats['rows_per_second'] = rows / stats['seconds'] if stats['seconds'] else 0
+    return stats
@@ -0,0 +1,37 @@
+from repeat_queries import settings as rq_settings
+
+
+class RepeatQueriesRouter(object):
+    """
+    Routes the repeat_queries models to the DATABASE alias of the
+    REPEAT_QUERIES setting, so profiling never loads the app's database.
+
+        DATABASE_ROUTERS = ['repeat_queries.router.RepeatQueriesRouter']
+    """
+    app_label = 'repeat_queries'
+
+    def _alias(self):
+        return rq_settings.get_config()['DATABASE']
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return self._alias()
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if (obj1._meta.app_label == self.app_label) != (obj2._meta.app_label == self.app_label):
+            return False
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = self._alias()
+        if alias is None:
+            return None
+        if app_label == self.app_label:
+            return db == alias
+        # The dedicated database only holds the recorder's tables
+        if db == alias:
+            return False
+        return None
@@ -0,0 +1,98 @@
+import random
+import threading
+from time import time
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.capture import view_name
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` events per second on average, with bursts of up to
+    ``capacity`` events.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time()
+        self._lock = threading.Lock()
+
+    def consume(self):
+        with self._lock:
+            now = time()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Sampler(object):
+    """
+    Decides which requests are recorded.
+
+    A request is fully recorded with the probability given by SAMPLE_RATE,
+    or by the SAMPLE_RATES entry matching its view name or the longest
+    matching path prefix. Requests which were not sampled are still
+    recorded, without their queries, when they are slower than
+    ALWAYS_RECORD_SLOWER_THAN or run more queries than
+    ALWAYS_RECORD_MORE_QUERIES_THAN. MAX_RECORDED_PER_SECOND caps the
+    number of recorded requests for this process.
+    """
+
+    def __init__(self):
+        config = rq_settings.get_config()
+        self.sample_rate = config['SAMPLE_RATE']
+        self.path_rates = sorted(
+            ((key, rate) for key, rate in config['SAMPLE_RATES'].items()
+             if key.startswith('/')),
+            key=lambda item: len(item[0]), reverse=True,
+        )
+        self.view_rates = {
+            key: rate for key, rate in config['SAMPLE_RATES'].items()
+            if not key.startswith('/')
+        }
+        self.slower_than = config['ALWAYS_RECORD_SLOWER_THAN']
+        self.more_queries_than = config['ALWAYS_RECORD_MORE_QUERIES_THAN']
+        max_per_second = config['MAX_RECORDED_PER_SECOND']
+        self.bucket = TokenBucket(max_per_second) if max_per_second else None
+
+    @property
+    def has_thresholds(self):
+        return self.slower_than is not None or self.more_queries_than is not None
+
+    def rate_for(self, request):
+        if self.view_rates:
+            name = view_name(request)
+            if name in self.view_rates:
+                return self.view_rates[name]
+        for prefix, rate in self.path_rates:
+            if request.path.startswith(prefix):
+                return rate
+        return self.sample_rate
+
+    def should_sample(self, request):
+        rate = self.rate_for(request)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return False
+        return self.bucket is None or self.bucket.consume()
+
+    def should_keep(self, recorder):
+        """
+        Called once the response is done, tells if the request is stored.
+        """
+        if recorder.capture_queries:
+            return True
+        over_threshold = (
+            (self.slower_than is not None and
+             (recorder.request.time_taken or 0) > self.slower_than) or
+            (self.more_queries_than is not None and
+             recorder._num_queries > self.more_queries_than)
+        )
+        if not over_threshold:
+            return False
+        return self.bucket is None or self.bucket.consume()
@@ -0,0 +1,163 @@
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+# Every option can be overridden from the project settings with a
+# ``REPEAT_QUERIES`` dict, e.g. REPEAT_QUERIES = {'WRITER_FULL_POLICY': 'block'}
+CONFIG_DEFAULTS = {
+    # Alias of a dedicated database for the recorder's tables, used by
+    # repeat_queries.router.RepeatQueriesRouter. Queries on it are never
+    # recorded. None keeps everything on the default database.
+    'DATABASE': None,
+    # Dotted path of the writer used to persist finished requests.
+    # SyncWriter stores them at the end of the response, QueuedWriter hands
+    # them to a background thread which stores them in batches.
+    'WRITER': 'repeat_queries.writers.SyncWriter',
+    # Maximum number of finished requests waiting in the QueuedWriter queue
+    'WRITER_QUEUE_SIZE': 1000,
+    # Seconds the background worker waits before flushing a partial batch
+    'WRITER_FLUSH_INTERVAL': 1.0,
+    # Number of requests stored per bulk insert
+    'WRITER_BATCH_SIZE': 100,
+    # What to do when the queue is full: 'drop' the request or 'block' until
+    # the worker catches up
+    'WRITER_FULL_POLICY': 'drop',
+    # How the stack of each query is captured: 'frames' grabs raw frames and
+    # only formats them when the query is stored, 'full' formats the whole
+    # stack for every query, 'off' does not capture anything
+    'STACK_MODE': 'frames',
+    # Maximum number of frames kept per query in 'frames' mode
+    'STACK_DEPTH': 20,
+    # Skip django, standard library and installed package frames
+    'STACK_HIDE_LIBRARIES': True,
+    # Only capture the stack of a query once its shape ran a second time in
+    # the request, the first query of each shape is stored without one
+    'STACK_ONLY_REPEATED': False,
+    # Probability that a request is recorded with all its queries
+    'SAMPLE_RATE': 1.0,
+    # Per path prefix ('/api/') or per view name ('post-list') sample rates,
+    # they take precedence over SAMPLE_RATE
+    'SAMPLE_RATES': {},
+    # Requests which were not sampled are still stored, without their
+    # queries, when they take longer than this many milliseconds ...
+    'ALWAYS_RECORD_SLOWER_THAN': None,
+    # ... or run more queries than this
+    'ALWAYS_RECORD_MORE_QUERIES_THAN': None,
+    # Cap on the number of requests recorded per second by each process
+    'MAX_RECORDED_PER_SECOND': None,
+    # request.META keys stored in Request.encoded_headers. Cookies and
+    # credentials are left out unless added here.
+    'RECORD_HEADERS': [
+        'HTTP_USER_AGENT', 'HTTP_REFERER', 'HTTP_ACCEPT', 'CONTENT_TYPE',
+        'CONTENT_LENGTH', 'HTTP_X_REQUEST_ID', 'HTTP_X_FORWARDED_FOR',
+    ],
+    # Query string parameters stored in Request.query_params, none by
+    # default as they may hold tokens or keys, '*' for all
+    'RECORD_QUERY_PARAMS': [],
+    # Caps on the number of headers / parameters (and values of a
+    # parameter) kept, and on the length of each value
+    'MAX_RECORDED_VALUES': 20,
+    'MAX_RECORDED_VALUE_LENGTH': 256,
+    # How Request.body is captured: 'off', 'truncate' to the first
+    # MAX_BODY_SIZE bytes, or 'content_type' which does the same for the
+    # BODY_CONTENT_TYPES and only stores the type and size of other bodies
+    # (multipart and binary uploads). A body the view did not read is only
+    # read when it is no longer than MAX_BODY_SIZE.
+    'BODY_CAPTURE': 'content_type',
+    'MAX_BODY_SIZE': 4096,
+    'BODY_CONTENT_TYPES': [
+        'application/json', 'application/x-www-form-urlencoded',
+        'application/xml', 'text/',
+    ],
+    # Store one SQLQuery row per executed query
+    'STORE_QUERIES': True,
+    # Store the parameters of each query, so SQLQuery.interpolated_query
+    # can show it with its values. They may contain sensitive data.
+    'STORE_PARAMS': False,
+    # Parameter rows of an executemany kept per query
+    'MAX_EXECUTEMANY_ROWS': 10,
+    # Keep running totals per view and query shape in QueryPattern
+    'STORE_PATTERNS': True,
+    # Keep per minute and per hour totals of every view in EndpointRollup,
+    # read by the endpoint dashboard
+    'STORE_ROLLUPS': True,
+    # Per minute totals older than this are deleted by prune_requests and
+    # the in-process sweep, per hour totals are kept
+    'ROLLUP_MINUTE_MAX_AGE': timedelta(days=2),
+    # Requests older than this datetime.timedelta are deleted by the
+    # prune_requests command and the in-process sweep
+    'RETENTION_MAX_AGE': None,
+    # Only keep this many of the most recent requests
+    'RETENTION_MAX_ROWS': None,
+    # Requests deleted per DELETE statement
+    'RETENTION_CHUNK_SIZE': 1000,
+    # Share of stored batches after which the writer applies the retention
+    # policy, 0 leaves it to the prune_requests command
+    'RETENTION_SWEEP_PROBABILITY': 0,
+    # Bound on the chunks one in-process sweep deletes
+    'RETENTION_SWEEP_MAX_CHUNKS': 10,
+    # 0 logs nothing, 1 logs a summary of every recorded request on the
+    # 'repeat_queries' logger at INFO level, 2 also logs its queries at DEBUG
+    'VERBOSITY': 0,
+    # Dotted paths of callables called with the summary dict of every
+    # recorded request, see SqlRecorder.summary()
+    'SUMMARY_HOOKS': [],
+    # Queries slower than this many milliseconds are flagged as slow
+    'SQL_WARNING_THRESHOLD': 1200,
+    # Run EXPLAIN (EXPLAIN QUERY PLAN on SQLite) on a background thread for
+    # SELECTs slower than SQL_WARNING_THRESHOLD or repeated
+    # EXPLAIN_REPEAT_THRESHOLD times in one request, and store the plan on
+    # their QueryPattern. Needs STORE_PATTERNS.
+    'EXPLAIN': False,
+    'EXPLAIN_REPEAT_THRESHOLD': 10,
+    # Seconds before the same query shape is explained again
+    'EXPLAIN_INTERVAL': 3600,
+    # Seconds the index suggestions of dashboard/indexes/ are reused before
+    # the captured queries are read again
+    'INDEX_ADVISOR_CACHE_SECONDS': 300,
+    # Sample the Python stack of recorded requests from a background thread
+    # and store it in Request.pyprofile, see repeat_queries.profiler
+    'PROFILE': False,
+    # Seconds between two samples, and frames kept per sample
+    'PROFILE_INTERVAL': 0.005,
+    'PROFILE_MAX_DEPTH': 64,
+    # Keep counters and histograms of the requests in each process, served
+    # in the Prometheus text format at dashboard/metrics/. Requests which
+    # were not sampled are counted too, without their similar and duplicate
+    # queries.
+    'METRICS': True,
+    # Label sets kept per metric, the others are added up under '__other__'
+    'METRICS_MAX_SERIES': 1000,
+    # Export a span per captured query with opentelemetry-api, when it is
+    # installed and configured
+    'OTEL_SPANS': False,
+    # Log a warning for transactions held open longer than this many
+    # milliseconds, None disables it
+    'LONG_TRANSACTION_THRESHOLD': 1000,
+    # Number of times a query shape may run in one request before it is
+    # reported as an N+1, None disables the check. Off by default as it
+    # runs while the query executes, repeat_queries.testing turns it on.
+    'N_PLUS_ONE_THRESHOLD': None,
+    # What to do when the threshold is reached: 'log' a warning, 'raise'
+    # NPlusOneError (useful in tests) or the dotted path of a callable
+    # taking (recorder, alias, query, count)
+    'N_PLUS_ONE_ACTION': 'log',
+}
+
+
+@lru_cache()
+def get_config():
+    user_config = getattr(settings, 'REPEAT_QUERIES', {})
+    config = CONFIG_DEFAULTS.copy()
+    config.update(user_config)
+    return config
+
+
+@receiver(setting_changed)
+def update_config(**kwargs):
+    if kwargs['setting'] == 'REPEAT_QUERIES':
+        get_config.cache_clear()
@@ -0,0 +1,81 @@
+import linecache
+import os
+import sys
+import sysconfig
+import traceback
+
+import django
+
+
+def _hidden_paths():
+    paths = {
+        os.path.dirname(django.__file__),
+        os.path.dirname(os.path.abspath(__file__)),
+    }
+    for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'):
+        path = sysconfig.get_paths().get(name)
+        if path:
+            paths.add(path)
+    return tuple(os.path.join(path, '') for path in paths)
+
+
+# Frames from these directories (django, the standard library, installed
+# packages and this app) are not interesting when looking for the code
+# which issued a query.
+HIDDEN_PATHS = _hidden_paths()
+
+
+def capture_frames(depth, hide_libraries=True):
+    """
+    Return the current stack as a tuple of (filename, lineno, function),
+    innermost frame first, without formatting anything.
+    """
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None and len(frames) < depth:
+        code = frame.f_code
+        if not (hide_libraries and code.co_filename.startswith(HIDDEN_PATHS)):
+            frames.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(frames)
+
+
+def format_full_stack():
+    return ''.join(reversed(traceback.format_stack()))
+
+
+def render_frames(frames):
+    """
+    Render frames the way traceback.format_stack does, innermost first.
+    """
+    lines = []
+    for filename, lineno, name in frames:
+        lines.append('  File "%s", line %d, in %s\n' % (filename, lineno, name))
+        lines.append('    %s\n' % linecache.getline(filename, lineno).strip())
+    return ''.join(lines)
+
+
+class StackTable(object):
+    """
+    Interns the stacks captured during one request, so a loop issuing the
+    same query many times keeps a single copy of its stack and renders it
+    at most once.
+    """
+
+    def __init__(self, depth=20, hide_libraries=True):
+        self.depth = depth
+        self.hide_libraries = hide_libraries
+        self._stacks = {}
+        self._rendered = {}
+
+    def __len__(self):
+        return len(self._stacks)
+
+    def capture(self):
+        frames = capture_frames(self.depth, self.hide_libraries)
+        return self._stacks.setdefault(frames, frames)
+
+    def render(self, frames):
+        if frames not in self._rendered:
+            self._rendered[frames] = render_frames(frames)
+        return self._rendered[frames]
@@ -0,0 +1,274 @@
+"""
+Query budgets and N+1 detection for tests, recorded in memory only.
+
+    from repeat_queries.testing import QueryCapture
+
+    with QueryCapture(max_queries=5, max_repeats=2):
+        client.get('/blog/')
+
+    @QueryCapture(max_repeats=2)
+    def test_post_list(self):
+        ...
+
+NPlusOneTestRunner (TEST_RUNNER) and repeat_queries.pytest_plugin fail
+every test in which a request served by DuplicateQueryMiddleware ran a
+query shape N_PLUS_ONE_THRESHOLD times, 10 when it is not set.
+"""
+import unittest
+from collections import defaultdict
+from contextlib import ContextDecorator
+
+from django.test.runner import (
+    DiscoverRunner, ParallelTestSuite, RemoteTestResult, RemoteTestRunner
+)
+from django.test.utils import override_settings
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.fingerprint import fingerprint
+from repeat_queries.recorder import SqlRecorder
+from repeat_queries.relations import code_line
+from repeat_queries.writers import MemoryWriter
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _shorten(sql, length=200):
+    return sql if len(sql) <= length else sql[:length] + '...'
+
+
+class QueryCapture(ContextDecorator):
+    """
+    Records the queries of a block, including those of the requests the
+    test client runs through the middleware, and fails with a report when
+    more than ``max_queries`` ran or one shape ran more than
+    ``max_repeats`` times. Only queries on ``using`` are checked when given.
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None, using=None):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.using = using
+        self.recorder = None
+
+    def __enter__(self):
+        self.recorder = SqlRecorder()
+        self.recorder.nested = True
+        # The requests of the block are kept in memory, never stored
+        self.recorder.writer = MemoryWriter()
+        # Reported by check() once the block is done
+        self.recorder._repeat_action = None
+        self.recorder.enable_instrumentation()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.disable_instrumentation()
+        if exc_type is None:
+            self.check()
+
+    @property
+    def queries(self):
+        """
+        (alias, query) of each recorded query, see NormalCursorWrapper._log.
+        """
+        return [
+            (alias, query) for alias, query in self.recorder._queries
+            if self.using is None or alias == self.using
+        ]
+
+    @property
+    def profiles(self):
+        """
+        The profiles of the requests run in the block, see BaseWriter.
+        """
+        return list(self.recorder.writer.profiles)
+
+    @property
+    def num_queries(self):
+        return len(self.queries)
+
+    def similar_counts(self):
+        """
+        Number of queries per fingerprint, i.e. per query shape.
+        """
+        return self._counts(self.recorder._similar_counts)
+
+    def duplicate_counts(self):
+        """
+        Number of exact duplicates, queries run with the same sql and params
+        as another one, per fingerprint like similar_counts().
+        """
+        counts = defaultdict(int)
+        for alias, alias_counts in self.recorder.count_duplicates().items():
+            if self.using is None or alias == self.using:
+                for (sql, params), count in alias_counts.items():
+                    if count >= 2:
+                        counts[fingerprint(sql)[1]] += count
+        return dict(counts)
+
+    def _counts(self, counts_per_alias):
+        counts = defaultdict(int)
+        for alias, alias_counts in counts_per_alias.items():
+            if self.using is None or alias == self.using:
+                for key, count in alias_counts.items():
+                    counts[key] += count
+        return dict(counts)
+
+    def repeated(self, threshold=2):
+        """
+        [(count, duplicates, sample query)] of the shapes which ran at least
+        ``threshold`` times, most repeated first.
+        """
+        samples = {}
+        for alias, query in self.queries:
+            # the first query of a shape has no stack with STACK_ONLY_REPEATED
+            sample = samples.get(query['similar_key'])
+            if sample is None or ('stack' in query and 'stack' not in sample):
+                samples[query['similar_key']] = query
+        duplicates = self.duplicate_counts()
+        repeated = [
+            (count, duplicates.get(key, 0), samples[key])
+            for key, count in self.similar_counts().items()
+            if count >= threshold and key in samples
+        ]
+        repeated.sort(key=lambda item: item[0], reverse=True)
+        return repeated
+
+    def report(self, threshold=2):
+        lines = ['%d queries' % self.num_queries + (
+            ' (budget %d)' % self.max_queries if self.max_queries is not None else '')]
+        for count, duplicates, query in self.repeated(threshold):
+            lines.append('  %dx (%d exact duplicates): %s' % (
+                count, duplicates, _shorten(query['raw_sql'])))
+            line = code_line(query.get('stack'))
+            if line:
+                lines.append('      first run at %s' % line)
+        return '\n'.join(lines)
+
+    def check(self):
+        problems = []
+        if self.max_queries is not None and self.num_queries > self.max_queries:
+            problems.append('%d queries ran, the budget is %d' % (self.num_queries, self.max_queries))
+        if self.max_repeats is not None:
+            repeated = [item for item in self.repeated() if item[0] > self.max_repeats]
+            if repeated:
+                problems.append('%d query shape(s) ran more than %d times' % (
+                    len(repeated), self.max_repeats))
+        if problems:
+            raise QueryBudgetExceeded('%s\n%s' % (
+                ', '.join(problems), self.report(threshold=(self.max_repeats or 1) + 1)))
+
+
+# N_PLUS_ONE_THRESHOLD in tests when the settings leave it off
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10
+
+# N+1s reported by the middleware while the current test runs, filled by
+# collect_repeated_query through N_PLUS_ONE_ACTION
+_repeated_queries = []
+
+
+def collect_repeated_query(recorder, alias, query, count):
+    _repeated_queries.append((
+        recorder.request.path if recorder.request is not None else '',
+        alias, count, query['raw_sql'], code_line(query.get('stack')),
+    ))
+
+
+def reset_repeated_queries():
+    del _repeated_queries[:]
+
+
+def repeated_queries_report():
+    """
+    Describe the N+1s collected since the last reset, '' if there was none.
+    """
+    lines = []
+    for path, alias, count, sql, line in _repeated_queries:
+        lines.append('%s ran a query %d times on %r: %s' % (path, count, alias, _shorten(sql)))
+        if line:
+            lines.append('    at %s' % line)
+    return '\n'.join(lines)
+
+
+def recording_settings(threshold=None):
+    """
+    override_settings for a test run: requests are recorded in memory
+    only, and N+1s are collected instead of logged.
+    """
+    config = dict(rq_settings.get_config())
+    config.update({
+        'WRITER': 'repeat_queries.writers.MemoryWriter',
+        'WRITER_QUEUE_SIZE': 100,
+        'STORE_QUERIES': False,
+        'STORE_PATTERNS': False,
+        'STORE_ROLLUPS': False,
+        'EXPLAIN': False,
+        'PROFILE': False,
+        'SAMPLE_RATE': 1.0,
+        'SAMPLE_RATES': {},
+        'MAX_RECORDED_PER_SECOND': None,
+        'VERBOSITY': 0,
+        'SUMMARY_HOOKS': [],
+        'N_PLUS_ONE_ACTION': 'repeat_queries.testing.collect_repeated_query',
+    })
+    config['N_PLUS_ONE_THRESHOLD'] = (
+        threshold or config['N_PLUS_ONE_THRESHOLD'] or DEFAULT_N_PLUS_ONE_THRESHOLD)
+    return override_settings(REPEAT_QUERIES=config)
+
+
+class NPlusOneResultMixin(object):
+    """
+    Turns a passing test whose requests ran an N+1 into a failure.
+    """
+
+    def startTest(self, test):
+        reset_repeated_queries()
+        super(NPlusOneResultMixin, self).startTest(test)
+
+    def addSuccess(self, test):
+        report = repeated_queries_report()
+        if not report:
+            return super(NPlusOneResultMixin, self).addSuccess(test)
+        # Without the traceback, which would only point here, the failure
+        # can be pickled back from a --parallel worker without tblib
+        error = QueryBudgetExceeded('N+1 queries:\n' + report)
+        self.addFailure(test, (QueryBudgetExceeded, error, None))
+
+
+class NPlusOneTestResult(NPlusOneResultMixin, unittest.TextTestResult):
+    pass
+
+
+class NPlusOneRemoteTestResult(NPlusOneResultMixin, RemoteTestResult):
+    pass
+
+
+class NPlusOneRemoteTestRunner(RemoteTestRunner):
+    resultclass = NPlusOneRemoteTestResult
+
+
+class NPlusOneParallelTestSuite(ParallelTestSuite):
+    # The workers are forked once the settings are overridden
+    runner_class = NPlusOneRemoteTestRunner
+
+
+class NPlusOneTestRunner(DiscoverRunner):
+    """
+    TEST_RUNNER = 'repeat_queries.testing.NPlusOneTestRunner' fails the
+    tests which pass but whose requests ran a query shape
+    N_PLUS_ONE_THRESHOLD times, with --parallel too.
+    """
+    parallel_test_suite = NPlusOneParallelTestSuite
+
+    def setup_test_environment(self, **kwargs):
+        super(NPlusOneTestRunner, self).setup_test_environment(**kwargs)
+        self._repeat_queries_settings = recording_settings()
+        self._repeat_queries_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._repeat_queries_settings.disable()
+        super(NPlusOneTestRunner, self).teardown_test_environment(**kwargs)
+
+    def get_resultclass(self):
+        return super(NPlusOneTestRunner, self).get_resultclass() or NPlusOneTestResult
@@ -1,6 +1,1522 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import importlib.util
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import warnings
+from datetime import timedelta
+from io import StringIO
+from time import sleep
+from unittest import mock
+from uuid import uuid4
 
-# Create your tests here.
+from django.conf.urls import url
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from blog.models import Author, Post
+from blog.views import PostListView
+from repeat_queries import advisor, capture, metrics, settings as rq_settings, views
+from repeat_queries.context import _ThreadLocalVar, get_current_recorder
+from repeat_queries.explain import Explainer, filtered_tables, run_explain
+from repeat_queries.fingerprint import fingerprint, normalize
+from repeat_queries.middleware import DuplicateQueryMiddleware
+from repeat_queries.profiler import StackSampler, format_collapsed, merge_collapsed, parse_collapsed
+from repeat_queries.models import (
+    MAX_REPEATED_SHAPES, EndpointRollup, QueryPattern, Request, SQLQuery, Transaction,
+    merge_repeated
+)
+from repeat_queries.recorder import NPlusOneError, SqlRecorder
+from repeat_queries.retention import prune
+from repeat_queries.router import RepeatQueriesRouter
+from repeat_queries.sampling import Sampler, TokenBucket
+from repeat_queries.testing import (
+    NPlusOneTestResult, NPlusOneTestRunner, QueryBudgetExceeded, QueryCapture, recording_settings
+)
+from repeat_queries.stack import HIDDEN_PATHS, StackTable, capture_frames, render_frames
+from repeat_queries.utils import Singleton, interpolate_sql
+from repeat_queries.writers import (
+    MemoryWriter, QueuedWriter, SyncWriter, get_writer
+)
+
+
+def config(**options):
+    """
+    override_settings of REPEAT_QUERIES with ``options`` over the defaults.
+    """
+    return override_settings(REPEAT_QUERIES=dict(rq_settings.CONFIG_DEFAULTS, **options))
+
+
+def make_profile(path='/posts/', num_queries=2, view_name='post-list', **request_fields):
+    request = Request(path=path, method='GET', view_name=view_name, **request_fields)
+    queries = [
+        SQLQuery(query='SELECT %d' % i, duration=1.5, request=request, traceback='')
+        for i in range(num_queries)
+    ]
+    return {
+        'request': request,
+        'queries': queries,
+        'num_queries': num_queries,
+        'sql_time': 1.5 * num_queries,
+        'patterns': {},
+    }
+
+
+class CollectingWriter(QueuedWriter):
+    """
+    Keeps the batches instead of storing them, ``gate`` holds the worker.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CollectingWriter, self).__init__(*args, **kwargs)
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def persist(self, profiles):
+        self.gate.wait()
+        self.batches.append(profiles)
+
+
+class WriterTests(TestCase):
+
+    def test_sync_writer_stores_request_and_queries(self):
+        profile = make_profile(num_queries=3)
+        SyncWriter().write(profile)
+        request = Request.objects.get(pk=profile['request'].pk)
+        self.assertEqual(request.queries.count(), 3)
+        self.assertEqual(request.num_sql_queries, 3)
+        self.assertEqual(request.meta_time_spent_queries, 4.5)
+
+    def test_memory_writer_keeps_latest_profiles(self):
+        writer = MemoryWriter(maxlen=2)
+        profiles = [make_profile() for _ in range(3)]
+        for profile in profiles:
+            writer.write(profile)
+        self.assertEqual(list(writer.profiles), profiles[1:])
+        self.assertFalse(Request.objects.exists())
+
+    def test_queued_writer_stores_in_batches(self):
+        writer = CollectingWriter(batch_size=10, flush_interval=0.05)
+        for _ in range(5):
+            writer.write(make_profile())
+        writer.flush()
+        self.assertEqual(sum(len(batch) for batch in writer.batches), 5)
+        self.assertLessEqual(len(writer.batches), 5)
+
+    def test_queued_writer_drops_when_full(self):
+        writer = CollectingWriter(queue_size=1, batch_size=1, flush_interval=0.01)
+        writer.gate.clear()
+        with self.assertLogs('repeat_queries.writers', 'WARNING'):
+            for _ in range(5):
+                writer.write(make_profile())
+        # One profile held by the worker, at most one waiting in the queue
+        self.assertGreaterEqual(writer.dropped, 3)
+        writer.gate.set()
+        writer.flush()
+        self.assertEqual(sum(len(batch) for batch in writer.batches) + writer.dropped, 5)
+
+    def test_concurrent_drops_are_all_counted(self):
+        writer = CollectingWriter(queue_size=1, batch_size=1, flush_interval=0)
+        writer.gate.clear()
+        profile = make_profile()
+
+        def write():
+            for _ in range(200):
+                writer.write(profile)
+
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        with self.assertLogs('repeat_queries.writers', 'WARNING'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        writer.gate.set()
+        writer.flush()
+        self.assertEqual(sum(len(batch) for batch in writer.batches) + writer.dropped, 1600)
+
+    def test_queued_writer_settings(self):
+        self.assertEqual(QueuedWriter(flush_interval=0).flush_interval, 0)
+        with config(WRITER_FLUSH_INTERVAL=2.5):
+            self.assertEqual(QueuedWriter().flush_interval, 2.5)
+
+    def test_queued_writer_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            QueuedWriter(full_policy='wait')
+
+    def test_get_writer_follows_settings(self):
+        with config(WRITER='repeat_queries.writers.MemoryWriter'):
+            writer = get_writer()
+            self.assertIsInstance(writer, MemoryWriter)
+            self.assertIs(get_writer(), writer)
+        self.assertIsInstance(get_writer(), SyncWriter)
+
+
+class SingletonTests(TestCase):
+
+    def test_threads_share_one_instance(self):
+        calls = []
+
+        def factory():
+            calls.append(1)
+            sleep(0.01)
+            return object()
+
+        singleton = Singleton(factory)
+        instances = []
+        threads = [
+            threading.Thread(target=lambda: instances.append(singleton.get()))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len({id(instance) for instance in instances}), 1)
+
+    def test_reset(self):
+        singleton = Singleton(object)
+        first = singleton.get()
+        singleton.reset()
+        self.assertIsNot(singleton.get(), first)
+
+
+class IngestTests(TestCase):
+
+    def count_queries(self, profiles):
+        with CaptureQueriesContext(connection) as context:
+            SQLQuery.objects.ingest(profiles)
+        return len(context.captured_queries)
+
+    def test_statements_do_not_depend_on_the_number_of_rows(self):
+        few = self.count_queries([make_profile(num_queries=1)])
+        many = self.count_queries([make_profile(num_queries=5) for _ in range(10)])
+        self.assertEqual(few, many)
+        self.assertEqual(Request.objects.count(), 11)
+        self.assertEqual(SQLQuery.objects.count(), 51)
+
+    def test_counters_are_set_from_the_recorder_totals(self):
+        # Only one of the 4 queries is stored, the totals count them all
+        profile = make_profile(num_queries=1)
+        profile['num_queries'] = 4
+        profile['sql_time'] = 8.0
+        SQLQuery.objects.ingest([profile])
+        request = Request.objects.get()
+        self.assertEqual(request.num_sql_queries, 4)
+        self.assertEqual(request.meta_num_queries, 4)
+        self.assertEqual(request.meta_time_spent_queries, 8.0)
+
+    def test_saved_request_is_updated(self):
+        request = Request.objects.create(path='/saved/', method='GET')
+        profile = make_profile(num_queries=2)
+        profile['request'] = request
+        for query in profile['queries']:
+            query.request = request
+        SQLQuery.objects.ingest([profile])
+        request.refresh_from_db()
+        self.assertEqual(request.num_sql_queries, 2)
+        self.assertEqual(request.queries.count(), 2)
+
+
+def record_queries(queries, **options):
+    """
+    Run ``queries``, (sql, params) pairs, under a new SqlRecorder built
+    with ``options``, and return it.
+    """
+    with config(**options):
+        recorder = SqlRecorder()
+        recorder.enable_instrumentation()
+        try:
+            with connection.cursor() as cursor:
+                for sql, params in queries:
+                    cursor.execute(sql, params)
+        finally:
+            recorder.disable_instrumentation()
+    return recorder
+
+
+class StackTests(TestCase):
+
+    def test_library_frames_are_hidden(self):
+        frames = capture_frames(50, hide_libraries=False)
+        self.assertEqual(frames[0][2], 'test_library_frames_are_hidden')
+        hidden = capture_frames(50, hide_libraries=True)
+        self.assertFalse([frame for frame in hidden if frame[0] == __file__])
+        self.assertFalse([frame for frame in hidden if frame[0].startswith(HIDDEN_PATHS)])
+
+    def test_stacks_are_interned_and_rendered_once(self):
+        table = StackTable(depth=10, hide_libraries=False)
+        stacks = [table.capture() for _ in range(3)]
+        self.assertEqual(len(table), 1)
+        self.assertIs(stacks[0], stacks[2])
+        rendered = table.render(stacks[0])
+        self.assertIn('in test_stacks_are_interned_and_rendered_once', rendered)
+        self.assertIs(table.render(stacks[1]), rendered)
+
+    def test_render_frames(self):
+        rendered = render_frames([(__file__, 1, 'module')])
+        self.assertEqual(
+            rendered, '  File "%s", line 1, in module\n    # -*- coding: utf-8 -*-\n' % __file__)
+
+    def test_frames_mode(self):
+        recorder = record_queries([('SELECT %s', [1])], STACK_HIDE_LIBRARIES=False)
+        alias, query = recorder._queries[0]
+        self.assertIn('record_queries', [frame[2] for frame in query['stack']])
+        self.assertNotIn('stacktrace', query)
+
+    def test_off_mode(self):
+        recorder = record_queries([('SELECT %s', [1])], STACK_MODE='off')
+        alias, query = recorder._queries[0]
+        self.assertNotIn('stack', query)
+        self.assertNotIn('stacktrace', query)
+
+    def test_only_repeated_captures_from_the_second_query(self):
+        recorder = record_queries(
+            [('SELECT %s', [1]), ('SELECT 1 + %s', [1]), ('SELECT %s', [2]), ('SELECT %s', [3])],
+            STACK_ONLY_REPEATED=True, STACK_HIDE_LIBRARIES=False,
+        )
+        captured = [('stack' in query) for alias, query in recorder._queries]
+        self.assertEqual(captured, [False, False, True, True])
+        recorder.generate_stats(None, None)
+        patterns = list(recorder._patterns.values())
+        repeated = [pattern for pattern in patterns if pattern['count'] == 3][0]
+        self.assertIn('record_queries', repeated['sample_traceback'])
+        stored = recorder._sql_queries
+        self.assertEqual(stored[0].traceback, '')
+        self.assertIn('record_queries', stored[2].traceback)
+
+
+def seed_posts(count=5):
+    for i in range(count):
+        author = Author.objects.create(
+            name='author %d' % i, short_description='short', long_description='long')
+        Post.objects.create(title='post %d' % i, description='description', author=author)
+
+
+class SamplingTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_view_rate_then_longest_prefix(self):
+        rates = {'/blog/': 0.5, '/blog/archive/': 0.25, 'post-list': 0.75, '/': 0.1}
+        with config(SAMPLE_RATE=1.0, SAMPLE_RATES=rates):
+            sampler = Sampler()
+        self.assertEqual(sampler.rate_for(self.factory.get('/blog/')), 0.75)
+        self.assertEqual(sampler.rate_for(self.factory.get('/blog/archive/2018/')), 0.25)
+        self.assertEqual(sampler.rate_for(self.factory.get('/other/')), 0.1)
+
+    def test_rates(self):
+        with config(SAMPLE_RATE=0):
+            self.assertFalse(Sampler().should_sample(self.factory.get('/blog/')))
+        with config(SAMPLE_RATE=1.0):
+            self.assertTrue(Sampler().should_sample(self.factory.get('/blog/')))
+
+    def test_max_recorded_per_second(self):
+        with config(MAX_RECORDED_PER_SECOND=2):
+            sampler = Sampler()
+        sampled = [sampler.should_sample(self.factory.get('/blog/')) for _ in range(5)]
+        self.assertEqual(sampled, [True, True, False, False, False])
+
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(rate=1000, capacity=1)
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        bucket.updated -= 0.01
+        self.assertTrue(bucket.consume())
+
+    def test_unsampled_request_is_not_stored(self):
+        seed_posts()
+        with config(SAMPLE_RATE=0):
+            self.assertEqual(Client().get('/blog/').status_code, 200)
+        self.assertFalse(Request.objects.exists())
+
+    def test_unsampled_request_over_threshold_is_stored_without_queries(self):
+        seed_posts()
+        with config(SAMPLE_RATE=0, ALWAYS_RECORD_MORE_QUERIES_THAN=3):
+            Client().get('/blog/')
+        request = Request.objects.get()
+        self.assertEqual(request.num_sql_queries, 6)
+        self.assertFalse(request.queries.exists())
+
+    def test_sampled_request_is_stored_with_queries(self):
+        seed_posts()
+        with config(SAMPLE_RATE=1.0):
+            Client().get('/blog/')
+        request = Request.objects.get()
+        self.assertEqual(request.queries.count(), 6)
+
+
+class RecorderContextTests(TestCase):
+
+    def test_concurrent_requests_keep_their_queries(self):
+        num_threads, num_requests, num_queries = 8, 5, 10
+
+        def view(request):
+            # Every query carries the token of its request, the sleeps let
+            # the threads interleave in the middle of a request
+            token = request.path.split('/')[2]
+            with connection.cursor() as cursor:
+                for _ in range(num_queries):
+                    cursor.execute("SELECT '%s'" % token)
+                    sleep(random.random() / 1000)
+            return HttpResponse(token)
+
+        factory = RequestFactory()
+        errors = []
+
+        def worker(middleware):
+            try:
+                for _ in range(num_requests):
+                    middleware(factory.get('/stress/%s/' % uuid4().hex))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        with config(WRITER='repeat_queries.writers.MemoryWriter', WRITER_QUEUE_SIZE=1000,
+                    N_PLUS_ONE_THRESHOLD=None):
+            middleware = DuplicateQueryMiddleware(view)
+            threads = [
+                threading.Thread(target=worker, args=(middleware,)) for _ in range(num_threads)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            profiles = list(get_writer().profiles)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(profiles), num_threads * num_requests)
+        for profile in profiles:
+            token = profile['request'].path.split('/')[2]
+            self.assertEqual(len(profile['queries']), num_queries)
+            self.assertEqual({query.query.split("'")[1] for query in profile['queries']}, {token})
+
+    def test_recorder_is_reset_when_the_response_fails(self):
+        def failing(request):
+            raise ValueError('failed')
+
+        with config(WRITER='repeat_queries.writers.MemoryWriter'):
+            middleware = DuplicateQueryMiddleware(failing)
+            with self.assertRaises(ValueError):
+                middleware(RequestFactory().get('/blog/'))
+        self.assertIsNone(get_current_recorder())
+
+    def test_nested_recorders_restore_the_previous_one(self):
+        outer = SqlRecorder()
+        outer.nested = True
+        outer.enable_instrumentation()
+        inner = SqlRecorder()
+        inner.enable_instrumentation()
+        self.assertIs(get_current_recorder(), inner)
+        inner.disable_instrumentation()
+        inner.disable_instrumentation()
+        self.assertIs(get_current_recorder(), outer)
+        outer.disable_instrumentation()
+        self.assertIsNone(get_current_recorder())
+
+    def test_thread_local_fallback(self):
+        var = _ThreadLocalVar('test')
+        token = var.set(1)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(var.get()))
+        thread.start()
+        thread.join()
+        self.assertEqual((var.get(), other), (1, [None]))
+        var.reset(token)
+        self.assertIsNone(var.get())
+
+
+class RepeatedQueryTests(TestCase):
+    queries = [
+        ('SELECT %s', [1]), ('SELECT %s', [1]), ('SELECT %s', [2]), ('SELECT 1 + %s', [1]),
+    ]
+
+    def test_counts(self):
+        recorder = record_queries(self.queries)
+        # Parameters are only compared once the request is done
+        self.assertFalse([query for alias, query in recorder._queries if 'duplicate_key' in query])
+        recorder.generate_stats(None, None)
+        counts = [
+            (query.get('similar_count'), query.get('duplicate_count'))
+            for alias, query in recorder._queries
+        ]
+        self.assertEqual(counts, [(3, 2), (3, 2), (3, None), (None, None)])
+        self.assertNotIn('duplicate_key', recorder._queries[3][1])
+        summary = recorder.summary()
+        self.assertEqual((summary['similar_queries'], summary['duplicate_queries']), (3, 2))
+
+    def test_raise_as_soon_as_the_threshold_is_reached(self):
+        with self.assertRaises(NPlusOneError):
+            record_queries(
+                [('SELECT %s', [i]) for i in range(5)],
+                N_PLUS_ONE_THRESHOLD=3, N_PLUS_ONE_ACTION='raise',
+            )
+        self.assertIsNone(get_current_recorder())
+
+    def test_log_and_callable_actions(self):
+        queries = [('SELECT %s', [i]) for i in range(5)]
+        with self.assertLogs('repeat_queries.recorder', 'WARNING') as logs:
+            record_queries(queries, N_PLUS_ONE_THRESHOLD=3, N_PLUS_ONE_ACTION='log')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Query repeated 3 times', logs.output[0])
+
+        del repeated_calls[:]
+        record_queries(
+            queries, N_PLUS_ONE_THRESHOLD=2,
+            N_PLUS_ONE_ACTION='repeat_queries.tests.on_repeated',
+        )
+        self.assertEqual(len(repeated_calls), 1)
+        recorder, alias, query, count = repeated_calls[0]
+        self.assertEqual((alias, query['raw_sql'], count), ('default', 'SELECT %s', 2))
+
+    def test_off_by_default(self):
+        with mock.patch.object(SqlRecorder, 'on_repeated_query') as on_repeated_query:
+            record_queries([('SELECT %s', [i]) for i in range(20)])
+        self.assertFalse(on_repeated_query.called)
+
+    def test_unsampled_recorder_only_counts(self):
+        with config():
+            recorder = SqlRecorder(capture_queries=False)
+            recorder.enable_instrumentation()
+            try:
+                with connection.cursor() as cursor:
+                    for i in range(3):
+                        cursor.execute('SELECT %s', [i])
+            finally:
+                recorder.disable_instrumentation()
+        self.assertEqual(recorder._num_queries, 3)
+        self.assertEqual(recorder._databases['default']['num_queries'], 3)
+        self.assertEqual(recorder._queries, [])
+        self.assertEqual(dict(recorder._similar_counts), {})
+
+
+repeated_calls = []
+
+
+def on_repeated(recorder, alias, query, count):
+    repeated_calls.append((recorder, alias, query, count))
+
+
+class FingerprintTests(TestCase):
+
+    def test_values_are_replaced(self):
+        self.assertEqual(
+            normalize("SELECT * FROM t WHERE name = 'it''s 42' AND id = 42 AND x = %s"),
+            'SELECT * FROM t WHERE name = ? AND id = ? AND x = ?')
+        self.assertEqual(
+            normalize('SELECT "t3"."col1" FROM t3 WHERE a = :a AND b = %(b)s AND c = 1.5e3'),
+            'SELECT "t3"."col1" FROM t3 WHERE a = ? AND b = ? AND c = ?')
+
+    def test_lists_comments_and_whitespace(self):
+        self.assertEqual(
+            normalize('SELECT a  FROM t -- comment\n WHERE id IN (%s, %s,%s) /* hint */'),
+            'SELECT a FROM t WHERE id IN (...)')
+        self.assertEqual(
+            normalize('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO t (a, b) VALUES (...)')
+
+    def test_same_shape_same_fingerprint(self):
+        first = fingerprint('SELECT * FROM t WHERE id IN (1, 2, 3)')
+        second = fingerprint('SELECT * FROM t WHERE id IN (%s)')
+        self.assertEqual(first, second)
+        self.assertEqual(len(first[1]), 16)
+        self.assertNotEqual(first[1], fingerprint('SELECT * FROM u WHERE id IN (%s)')[1])
+
+    def test_cached_on_the_statement(self):
+        sql = 'SELECT %s FROM cached_fingerprint'
+        fingerprint(sql)
+        hits = fingerprint.cache_info().hits
+        fingerprint(sql)
+        self.assertEqual(fingerprint.cache_info().hits, hits + 1)
+
+
+class QueryPatternTests(TestCase):
+
+    def setUp(self):
+        seed_posts(5)
+
+    def author_pattern(self):
+        return QueryPattern.objects.get(view_name='post-list', sample_query__contains='FROM "blog_author"')
+
+    def test_totals_per_view_and_shape(self):
+        with config():
+            Client().get('/blog/')
+            Client().get('/blog/')
+        pattern = self.author_pattern()
+        self.assertEqual(pattern.count, 10)
+        self.assertEqual(pattern.num_requests, 2)
+        self.assertEqual(pattern.max_per_request, 5)
+        self.assertEqual(sum(pattern.histogram_counts), 10)
+        self.assertGreater(pattern.total_duration, 0)
+        self.assertLessEqual(pattern.min_duration, pattern.max_duration)
+        self.assertEqual(QueryPattern.objects.filter(view_name='post-list').count(), 2)
+
+    def test_patterns_without_queries(self):
+        with config(STORE_QUERIES=False):
+            Client().get('/blog/')
+        self.assertFalse(SQLQuery.objects.exists())
+        self.assertEqual(self.author_pattern().count, 5)
+
+    def test_profiles_of_a_batch_are_merged(self):
+        with config(WRITER='repeat_queries.writers.MemoryWriter'):
+            Client().get('/blog/')
+            Client().get('/blog/')
+            profiles = list(get_writer().profiles)
+        QueryPattern.objects.merge(profiles)
+        self.assertEqual(self.author_pattern().num_requests, 2)
+        QueryPattern.objects.merge(profiles[:1])
+        self.assertEqual(self.author_pattern().count, 15)
+
+    def test_merge_retries_when_a_row_was_created_meanwhile(self):
+        with config(WRITER='repeat_queries.writers.MemoryWriter'):
+            Client().get('/blog/')
+            profiles = list(get_writer().profiles)
+        merge = QueryPattern.objects._merge
+        calls = []
+
+        def concurrent_merge(deltas):
+            calls.append(deltas)
+            if len(calls) == 1:
+                # Another process stores the same rows first
+                view_name, alias, key = list(deltas)[0]
+                QueryPattern.objects.create(view_name=view_name, alias=alias, fingerprint=key)
+                raise IntegrityError('duplicate key')
+            return merge(deltas)
+
+        with mock.patch.object(QueryPattern.objects, '_merge', side_effect=concurrent_merge):
+            QueryPattern.objects.merge(profiles)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(QueryPattern.objects.filter(view_name='post-list').count(), 2)
+        self.assertEqual(self.author_pattern().count, 5)
+
+    def test_same_shape_on_two_databases(self):
+        sql = 'SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."id" = %s'
+        recorder = record_queries([(sql, [1]), (sql, [2]), (sql, [3])])
+        recorder._queries = [
+            ('replica' if index else alias, query)
+            for index, (alias, query) in enumerate(recorder._queries)]
+        recorder.generate_stats(None, None)
+        self.assertEqual(
+            sorted((alias, pattern['count']) for (alias, key), pattern in recorder._patterns.items()),
+            [('default', 1), ('replica', 2)])
+        profile = make_profile(start_time=timezone.now())
+        profile['patterns'] = recorder._patterns
+        QueryPattern.objects.merge([profile])
+        self.assertEqual(
+            sorted(QueryPattern.objects.values_list('alias', 'count')),
+            [('default', 1), ('replica', 2)])
+
+
+class RetentionTests(TestCase):
+
+    def store_requests(self, ages):
+        now = timezone.now()
+        profiles = [make_profile(start_time=now - timedelta(days=age)) for age in ages]
+        SyncWriter().persist(profiles)
+        return [profile['request'] for profile in profiles]
+
+    def test_prune_by_age_deletes_queries_first(self):
+        old, recent = self.store_requests([10, 1])
+        with CaptureQueriesContext(connection) as captured:
+            stats = prune(max_age=timedelta(days=5))
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['queries'], 2)
+        self.assertEqual(list(Request.objects.values_list('pk', flat=True)), [str(recent.pk)])
+        self.assertEqual(SQLQuery.objects.filter(request_id=old.pk).count(), 0)
+        self.assertEqual(SQLQuery.objects.count(), 2)
+        # The requests are only loaded by their primary key
+        selects = [q['sql'] for q in captured if q['sql'].startswith('SELECT')
+                   and 'FROM "repeat_queries_request"' in q['sql']]
+        self.assertTrue(all('"path"' not in sql for sql in selects))
+
+    def test_prune_by_rows_in_chunks(self):
+        requests = self.store_requests([5, 4, 3, 2, 1])
+        stats = prune(max_rows=2, chunk_size=2)
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['chunks'], 2)
+        self.assertEqual(
+            set(Request.objects.values_list('pk', flat=True)),
+            {str(requests[3].pk), str(requests[4].pk)})
+
+    def test_max_chunks_bounds_a_sweep(self):
+        self.store_requests([5, 4, 3])
+        stats = prune(max_rows=0, chunk_size=1, max_chunks=2)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(Request.objects.count(), 1)
+
+    def test_prune_old_patterns_and_minute_rollups(self):
+        now = timezone.now()
+        QueryPattern.objects.create(view_name='old', fingerprint='a', last_seen=now - timedelta(days=10))
+        QueryPattern.objects.create(view_name='new', fingerprint='b', last_seen=now)
+        EndpointRollup.objects.create(
+            resolution=EndpointRollup.MINUTE, period_start=now - timedelta(days=3), view_name='old')
+        EndpointRollup.objects.create(
+            resolution=EndpointRollup.HOUR, period_start=now - timedelta(days=3), view_name='old')
+        with config(ROLLUP_MINUTE_MAX_AGE=timedelta(days=2)):
+            stats = prune(max_age=timedelta(days=5))
+        self.assertEqual(stats['patterns'], 1)
+        self.assertEqual(stats['rollups'], 1)
+        self.assertEqual(list(QueryPattern.objects.values_list('view_name', flat=True)), ['new'])
+        self.assertEqual(EndpointRollup.objects.get().resolution, EndpointRollup.HOUR)
+
+    def test_garbage_collect_follows_settings(self):
+        self.store_requests([10, 1])
+        with config(RETENTION_MAX_AGE=timedelta(days=5)):
+            self.assertIsNone(Request.garbage_collect())
+            self.assertEqual(Request.objects.count(), 2)
+            self.assertEqual(Request.garbage_collect(force=True)['requests'], 1)
+        with config(RETENTION_MAX_AGE=timedelta(days=5), RETENTION_SWEEP_PROBABILITY=1):
+            # Swept by the writer
+            self.store_requests([10])
+        self.assertEqual(Request.objects.count(), 1)
+
+    def test_command_requires_a_limit(self):
+        with self.assertRaises(CommandError):
+            call_command('prune_requests')
+        self.store_requests([10, 1])
+        out = StringIO()
+        call_command('prune_requests', max_age_days=5, stdout=out)
+        self.assertIn('Deleted 1 requests, 2 queries', out.getvalue())
+
+
+summaries = []
+
+
+def collect_summary(summary):
+    summaries.append(summary)
+
+
+class ReportTests(TestCase):
+
+    def setUp(self):
+        seed_posts(5)
+        del summaries[:]
+
+    def test_summary_hooks_get_the_summary(self):
+        with config(SUMMARY_HOOKS=['repeat_queries.tests.collect_summary']):
+            Client().get('/blog/')
+        summary, = summaries
+        self.assertEqual(summary['path'], '/blog/')
+        self.assertEqual(summary['status_code'], 200)
+        self.assertEqual(summary['num_queries'], 6)
+        self.assertEqual(summary['similar_queries'], 5)
+        self.assertEqual(summary['duplicate_queries'], 0)
+        self.assertEqual(len(summary['top_repeated']), 1)
+        self.assertEqual(summary['top_repeated'][0][1], 5)
+        suggestion, = summary['suggestions']
+        self.assertEqual(suggestion['suggestion'], "Post.objects.select_related('author')")
+        self.assertEqual(suggestion['saved_queries'], 5)
+
+    def test_verbosity_logs_instead_of_printing(self):
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            with config(VERBOSITY=2), self.assertLogs('repeat_queries.recorder', 'DEBUG') as logs:
+                Client().get('/blog/')
+        self.assertEqual(stdout.getvalue(), '')
+        info, = [record for record in logs.records if record.levelname == 'INFO']
+        self.assertEqual(
+            info.getMessage(), 'GET /blog/ 200: %.1fms, 6 queries in %.1fms, 5 similar, 0 duplicates'
+            % (info.args['time_taken'], info.args['sql_time']))
+        self.assertTrue(any(record.levelname == 'DEBUG' for record in logs.records))
+
+    def test_nothing_is_logged_by_default(self):
+        with mock.patch('repeat_queries.recorder.logger') as logger, \
+                mock.patch.object(SqlRecorder, 'summary') as summary:
+            with config():
+                Client().get('/blog/')
+        self.assertFalse(logger.info.called)
+        self.assertFalse(logger.debug.called)
+        self.assertFalse(summary.called)
+
+
+class RouterTests(TestCase):
+
+    def setUp(self):
+        self.router = RepeatQueriesRouter()
+
+    def test_without_database_everything_is_left_to_django(self):
+        self.assertIsNone(self.router.db_for_read(Request))
+        self.assertIsNone(self.router.db_for_write(Post))
+        self.assertIsNone(self.router.allow_migrate('default', 'repeat_queries'))
+        self.assertIsNone(self.router.allow_migrate('default', 'blog'))
+
+    def test_models_go_to_database(self):
+        with config(DATABASE='profiling'):
+            self.assertEqual(self.router.db_for_read(Request), 'profiling')
+            self.assertEqual(self.router.db_for_write(SQLQuery), 'profiling')
+            self.assertIsNone(self.router.db_for_read(Post))
+            self.assertTrue(self.router.allow_migrate('profiling', 'repeat_queries'))
+            self.assertFalse(self.router.allow_migrate('default', 'repeat_queries'))
+            self.assertFalse(self.router.allow_migrate('profiling', 'blog'))
+            self.assertIsNone(self.router.allow_migrate('default', 'blog'))
+
+    def test_no_relations_across_apps(self):
+        self.assertFalse(self.router.allow_relation(Request(), Post()))
+        self.assertIsNone(self.router.allow_relation(Request(), SQLQuery()))
+        self.assertIsNone(self.router.allow_relation(Post(), Author()))
+
+    def test_recorder_database_is_not_wrapped(self):
+        recorder = SqlRecorder()
+        with config(DATABASE='default'), mock.patch('repeat_queries.recorder.wrap_cursor') as wrap:
+            recorder.enable_instrumentation()
+            recorder.disable_instrumentation()
+        self.assertNotIn(connection, [call[0][0] for call in wrap.call_args_list])
+        with mock.patch('repeat_queries.recorder.wrap_cursor') as wrap:
+            recorder.enable_instrumentation()
+            recorder.disable_instrumentation()
+        self.assertIn(connection, [call[0][0] for call in wrap.call_args_list])
+
+
+class ParamsTests(TestCase):
+
+    def test_interpolate_sql(self):
+        self.assertEqual(
+            interpolate_sql('SELECT * FROM t WHERE a = %s AND b = %s', ["it's", 2]),
+            "SELECT * FROM t WHERE a = 'it''s' AND b = 2")
+        self.assertEqual(interpolate_sql('SELECT %(a)s', {'a': None}), 'SELECT None')
+        self.assertEqual(interpolate_sql('INSERT %s', [[1], [2]], many=True), 'INSERT 1')
+        self.assertEqual(interpolate_sql('SELECT 1', None), 'SELECT 1')
+        # Unmatched parameters are shown as is
+        self.assertEqual(interpolate_sql('SELECT %s, %s', [1]), 'SELECT %s, %s')
+
+    def test_recorder_keeps_raw_params(self):
+        with mock.patch.object(connection.ops, 'last_executed_query') as last_executed_query:
+            recorder = record_queries([('SELECT %s', ["it's"])])
+        self.assertFalse(last_executed_query.called)
+        alias, query = recorder._queries[0]
+        self.assertEqual(query['raw_sql'], 'SELECT %s')
+        self.assertEqual(query['raw_params'], ["it's"])
+
+    def test_stored_params(self):
+        recorder = record_queries([('SELECT %s', ["it's"])], STORE_PARAMS=True)
+        recorder.generate_stats(None, None)
+        query = recorder._sql_queries[0]
+        self.assertEqual(json.loads(query.params), ["it's"])
+        self.assertEqual(query.interpolated_query, "SELECT 'it''s'")
+        recorder = record_queries([('SELECT %s', ["it's"])])
+        recorder.generate_stats(None, None)
+        self.assertEqual(recorder._sql_queries[0].params, '')
+        self.assertEqual(recorder._sql_queries[0].interpolated_query, 'SELECT %s')
+
+    def test_executemany_rows_are_capped(self):
+        seed_posts(1)
+        author = Author.objects.get()
+        sql = 'UPDATE blog_author SET name = %s WHERE id = %s'
+        consumed = []
+
+        def rows():
+            for i in range(3):
+                consumed.append(i)
+                yield ('g%d' % i, author.pk)
+
+        with config(MAX_EXECUTEMANY_ROWS=2, STORE_PARAMS=True):
+            recorder = SqlRecorder()
+        recorder.enable_instrumentation()
+        try:
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, [('a%d' % i, author.pk) for i in range(5)])
+                cursor.executemany(sql, rows())
+        finally:
+            recorder.disable_instrumentation()
+        # The iterator was left for the database to consume
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertEqual(Author.objects.get().name, 'g2')
+        (alias, listed), (alias, generated) = recorder._queries
+        self.assertEqual(listed['num_rows'], 5)
+        self.assertEqual(len(listed['raw_params']), 2)
+        self.assertIsNone(generated['raw_params'])
+        recorder.generate_stats(None, None)
+        self.assertEqual(
+            recorder._sql_queries[0].interpolated_query,
+            "UPDATE blog_author SET name = 'a0' WHERE id = %d" % author.pk)
+        self.assertEqual(json.loads(recorder._sql_queries[0].params)['num_rows'], 5)
+
+
+class ExplainTests(TestCase):
+
+    def test_filtered_tables(self):
+        self.assertEqual(
+            filtered_tables(
+                'SELECT "blog_post"."id" FROM "blog_post" INNER JOIN "blog_author" ON '
+                '("blog_post"."author_id" = "blog_author"."id") WHERE "blog_author"."name" = %s '
+                'ORDER BY "blog_post"."title" LIMIT 1'),
+            {'blog_author'})
+        self.assertEqual(filtered_tables('SELECT "blog_post"."id" FROM "blog_post"'), set())
+
+    def test_run_explain_finds_full_scans(self):
+        sql = 'SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."title" = %s'
+        plan, scanned = run_explain(connection, sql, ['a'])
+        self.assertIn('SCAN', plan)
+        self.assertEqual(scanned, {'blog_post'})
+        plan, scanned = run_explain(
+            connection, 'SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."id" = %s', [1])
+        self.assertEqual(scanned, set())
+
+    def test_explain_updates_the_pattern(self):
+        QueryPattern.objects.create(view_name='post-list', fingerprint='abc')
+        sql = 'SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."title" = %s'
+        explainer = Explainer(interval=60)
+        with self.assertLogs('repeat_queries.explain', 'WARNING'):
+            explainer.explain('abc', 'default', sql, ['a'])
+        pattern = QueryPattern.objects.get()
+        self.assertTrue(pattern.full_scan)
+        self.assertIn('SCAN', pattern.explain_plan)
+        self.assertIsNotNone(pattern.explained_at)
+
+    def test_submit_once_per_interval(self):
+        explainer = Explainer(interval=60)
+        with mock.patch.object(explainer, '_ensure_worker'):
+            self.assertTrue(explainer.submit('abc', 'default', 'SELECT 1', ()))
+            self.assertFalse(explainer.submit('abc', 'default', 'SELECT 1', ()))
+            self.assertTrue(explainer.submit('def', 'default', 'SELECT 2', ()))
+            self.assertTrue(explainer.submit('abc', 'replica', 'SELECT 1', ()))
+            # Tried again when the pattern was not stored yet
+            explainer.explain('abc', 'default', 'SELECT 1', ())
+            self.assertTrue(explainer.submit('abc', 'default', 'SELECT 1', ()))
+        self.assertEqual(explainer.queue.qsize(), 4)
+
+    def test_recorder_submits_repeated_selects(self):
+        seed_posts(3)
+        with mock.patch('repeat_queries.recorder.get_explainer') as get_explainer:
+            with config(EXPLAIN=True, EXPLAIN_REPEAT_THRESHOLD=3):
+                Client().get('/blog/')
+        (fingerprint, alias, sql, params), kwargs = get_explainer().submit.call_args
+        self.assertEqual(alias, 'default')
+        self.assertIn('FROM "blog_author"', sql)
+        self.assertEqual(get_explainer().submit.call_count, 1)
+
+
+class IndexAdvisorTests(TestCase):
+
+    def setUp(self):
+        advisor._cached_suggestions.clear()
+        request = Request.objects.create(path='/posts/', method='GET')
+        for sql, duration in [
+                ('SELECT "blog_post"."id" FROM "blog_post" WHERE ("blog_post"."title" = %s '
+                 'AND "blog_post"."description" = %s AND "blog_post"."id" = %s)', 10),
+                ('SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."title" = %s', 4)]:
+            SQLQuery.objects.create(query=sql, duration=duration, request=request, traceback='')
+
+    def test_extract_columns(self):
+        self.assertEqual(
+            advisor.extract_columns(
+                'SELECT "p"."id" FROM "blog_post" "p" INNER JOIN "blog_author" ON '
+                '("p"."author_id" = "blog_author"."id") WHERE "blog_author"."name" = %s '
+                'ORDER BY "p"."title" LIMIT 1'),
+            {('join', 'blog_post', 'author_id'), ('join', 'blog_author', 'id'),
+             ('where', 'blog_author', 'name'), ('order_by', 'blog_post', 'title')})
+
+    def test_time_is_split_between_unindexed_columns(self):
+        suggestions = advisor.suggest_indexes()
+        self.assertEqual(
+            [(s['column'], s['count'], s['total_duration'], s['attributed_duration']) for s in suggestions],
+            [('title', 2, 14, 9), ('description', 1, 10, 5)])
+        self.assertEqual(suggestions[0]['model'], 'blog.Post')
+        self.assertEqual(suggestions[0]['field'], 'title')
+        self.assertIn('CREATE INDEX', suggestions[0]['sql'])
+
+    def test_suggestions_are_cached(self):
+        with mock.patch.object(advisor, 'suggest_indexes', return_value=[]) as suggest:
+            advisor.cached_suggestions('default', max_age=60)
+            advisor.cached_suggestions('default', max_age=60)
+            self.assertEqual(suggest.call_count, 1)
+            advisor.cached_suggestions('default', max_age=0)
+            self.assertEqual(suggest.call_count, 2)
+
+    def test_view_validates_its_parameters(self):
+        client = Client()
+        response = client.get('/dashboard/indexes/', {'limit': 'x'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'blog_post_title_idx')
+        response = client.get('/dashboard/indexes/', {'limit': '1'})
+        self.assertNotContains(response, 'blog_post_description_idx')
+        self.assertEqual(client.get('/dashboard/indexes/', {'database': 'unknown'}).status_code, 400)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('suggest_indexes', stdout=out)
+        self.assertIn('blog.Post.title used in where by 2 queries, 9.0ms of their time', out.getvalue())
+
+
+def slow_view(request):
+    sleep(0.05)
+    return HttpResponse('ok')
+
+
+urlpatterns = [
+    url(r'^posts/$', PostListView.as_view(), name='post-list-view'),
+    url(r'^slow/$', slow_view, name='slow'),
+]
+
+
+@override_settings(ROOT_URLCONF='repeat_queries.tests')
+class TemplateResponseTests(TestCase):
+
+    def test_queries_of_the_template_are_recorded(self):
+        seed_posts(5)
+        del summaries[:]
+        with config(SUMMARY_HOOKS=['repeat_queries.tests.collect_summary']):
+            Client().get('/posts/')
+        summary, = summaries
+        self.assertEqual(summary['view_name'], 'post-list-view')
+        # The paginator COUNT, the page and one author per post, run while
+        # the response renders
+        self.assertEqual(summary['num_queries'], 7)
+        self.assertEqual(summary['similar_queries'], 5)
+        suggestion, = summary['suggestions']
+        self.assertEqual(suggestion['suggestion'], "Post.objects.select_related('author')")
+        pattern = QueryPattern.objects.get(view_name='post-list-view', sample_query__contains='FROM "blog_author"')
+        self.assertEqual(pattern.count, 5)
+        self.assertEqual(pattern.suggestion, "Post.objects.select_related('author')")
+
+
+class SQLViewTests(TestCase):
+
+    def setUp(self):
+        profile = make_profile(num_queries=5)
+        for query in profile['queries']:
+            query.fingerprint = query.query[-1]
+        SyncWriter().write(profile)
+        self.rp_request = profile['request']
+        self.url = '/dashboard/request/%s/sql/' % self.rp_request.pk
+
+    def test_pages_of_queries(self):
+        response = Client().get(self.url, {'per_page': 2, 'page': 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.context['page']
+        self.assertEqual(page.paginator.count, 5)
+        self.assertEqual(len(response.context['queries']), 2)
+        self.assertTrue(all(query.formatted.startswith('SELECT') for query in response.context['queries']))
+
+    def test_page_parameters_are_bounded(self):
+        client = Client()
+        self.assertEqual(client.get(self.url, {'per_page': 'x'}).context['page'].paginator.per_page, 100)
+        self.assertEqual(client.get(self.url, {'per_page': 10 ** 6}).context['page'].paginator.per_page, 1000)
+        self.assertEqual(client.get(self.url, {'per_page': 2, 'page': 99}).context['page'].number, 3)
+        self.assertEqual(client.get(self.url, {'page': 'x'}).context['page'].number, 1)
+
+    def test_sql_text_is_loaded_once_per_shape(self):
+        views._formatted_queries.clear()
+        client = Client()
+        with CaptureQueriesContext(connection) as first:
+            client.get(self.url)
+        with CaptureQueriesContext(connection) as second:
+            client.get(self.url)
+        self.assertEqual(len(second), len(first) - 1)
+        self.assertFalse([q for q in second if '"repeat_queries_sqlquery"."query"' in q['sql']])
+
+    def test_unknown_request(self):
+        self.assertEqual(Client().get('/dashboard/request/missing/sql/').status_code, 404)
+
+    def test_query_view(self):
+        query = SQLQuery.objects.first()
+        response = Client().get('/dashboard/sql/%d/' % query.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['query'], query)
+        self.assertEqual(Client().get('/dashboard/sql/0/').status_code, 404)
+
+
+class RequestAdminTests(TestCase):
+
+    def test_changelist_reads_the_request_totals(self):
+        seed_posts(5)
+        with config(STORE_QUERIES=False):
+            Client().get('/blog/')
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        client = Client()
+        client.login(username='admin', password='password')
+        with CaptureQueriesContext(connection) as captured:
+            response = client.get('/admin/repeat_queries/request/', {'o': '4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in captured if 'repeat_queries_sqlquery' in q['sql']])
+        rp_request, = response.context['cl'].result_list
+        self.assertEqual(rp_request.num_sql_queries, 6)
+        self.assertContains(response, '<td class="field-sql_count">6</td>', html=True)
+        self.assertGreater(rp_request.time_spent_on_sql_queries, 0)
+
+
+class EndpointRollupTests(TestCase):
+
+    def rollup(self, minutes_ago, shapes, view_name='post-list'):
+        period_start = timezone.now() - timedelta(minutes=minutes_ago)
+        return EndpointRollup.objects.create(
+            resolution=EndpointRollup.MINUTE, view_name=view_name, num_requests=1,
+            period_start=EndpointRollup.truncate(period_start, EndpointRollup.MINUTE),
+            repeated=json.dumps(shapes),
+        )
+
+    def test_requests_add_their_repeated_shapes(self):
+        seed_posts(3)
+        with config():
+            Client().get('/blog/')
+            Client().get('/blog/')
+        rollup = EndpointRollup.objects.get(resolution=EndpointRollup.HOUR, view_name='post-list')
+        pattern = QueryPattern.objects.get(view_name='post-list', sample_query__contains='FROM "blog_author"')
+        self.assertEqual(rollup.repeated_shapes, {pattern.fingerprint: [3, 6, 2]})
+
+    def test_merge_keeps_the_most_repeated(self):
+        shapes = {'f%d' % i: [i, i, 1] for i in range(MAX_REPEATED_SHAPES)}
+        merged = merge_repeated(shapes, {'f1': [20, 20, 1], 'new': [5, 5, 1], 'rare': [0, 0, 1]})
+        self.assertEqual(len(merged), MAX_REPEATED_SHAPES)
+        self.assertEqual(merged['f1'], [20, 21, 2])
+        self.assertIn('new', merged)
+        self.assertNotIn('rare', merged)
+        self.assertNotIn('f0', merged)
+
+    def test_dashboard_shapes_come_from_the_window(self):
+        QueryPattern.objects.create(
+            view_name='post-list', fingerprint='recent', sample_query='SELECT recent',
+            max_per_request=3, count=3, num_requests=1)
+        QueryPattern.objects.create(
+            view_name='post-list', fingerprint='old', sample_query='SELECT old',
+            max_per_request=50, count=5000, num_requests=100, last_seen=timezone.now())
+        self.rollup(10, {'recent': [3, 3, 1]})
+        self.rollup(10, {'single': [1, 1, 1]}, view_name='other')
+        self.rollup(3 * 60, {'old': [50, 5000, 100]})
+        response = Client().get('/dashboard/endpoints/', {'window': '1h'})
+        endpoint, = [e for e in response.context['endpoints'] if e['view_name'] == 'post-list']
+        self.assertEqual(
+            [(shape['sample_query'], shape['max_per_request']) for shape in endpoint['repeated']],
+            [('SELECT recent', 3)])
+        self.assertContains(response, '3x in a request (3 over 1 requests) : SELECT recent')
+        other, = [e for e in response.context['endpoints'] if e['view_name'] == 'other']
+        self.assertEqual(other['repeated'], [])
+        response = Client().get('/dashboard/endpoints/', {'window': '6h'})
+        endpoint, = [e for e in response.context['endpoints'] if e['view_name'] == 'post-list']
+        self.assertEqual(
+            [shape['sample_query'] for shape in endpoint['repeated']], ['SELECT old', 'SELECT recent'])
+
+
+class CaptureTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_query_params_are_opt_in(self):
+        request = self.factory.get('/blog/', {'page': '2', 'token': 'secret'})
+        self.assertEqual(
+            capture.query_params(request, rq_settings.CONFIG_DEFAULTS['RECORD_QUERY_PARAMS'], 20, 256), '')
+        self.assertEqual(
+            json.loads(capture.query_params(request, ['page'], 20, 256)), {'page': ['2']})
+        self.assertEqual(
+            json.loads(capture.query_params(request, ['*'], 20, 256)),
+            {'page': ['2'], 'token': ['secret']})
+
+    def test_values_are_capped(self):
+        request = self.factory.get('/blog/', {'a': ['x' * 10, 'y', 'z'], 'b': '1', 'c': '2'})
+        captured = json.loads(capture.query_params(request, ['*'], 2, 4))
+        self.assertEqual(captured, {'a': ['xxxx...', 'y'], 'b': ['1']})
+
+    def test_only_allowed_headers(self):
+        request = self.factory.get('/blog/', HTTP_USER_AGENT='agent', HTTP_COOKIE='sessionid=1')
+        captured = json.loads(capture.headers(request, rq_settings.CONFIG_DEFAULTS['RECORD_HEADERS'], 20, 256))
+        self.assertEqual(captured, {'HTTP_USER_AGENT': 'agent'})
+
+    def test_view_name_is_resolved_once_per_path(self):
+        capture._resolve_view_name.cache_clear()
+        request = self.factory.get('/blog/')
+        self.assertEqual(capture.view_name(request), 'post-list')
+        self.assertEqual(capture.view_name(self.factory.get('/blog/')), 'post-list')
+        self.assertEqual(capture._resolve_view_name.cache_info().hits, 1)
+        self.assertIsNone(capture.view_name(self.factory.get('/missing/')))
+
+    def test_stored_request(self):
+        with config(RECORD_QUERY_PARAMS=['page']):
+            Client().get('/blog/', {'page': '2', 'api_key': 'secret'}, HTTP_USER_AGENT='agent')
+        rp_request = Request.objects.get()
+        self.assertEqual(json.loads(rp_request.query_params), {'page': ['2']})
+        self.assertEqual(json.loads(rp_request.encoded_headers), {'HTTP_USER_AGENT': 'agent'})
+        self.assertEqual(rp_request.view_name, 'post-list')
+
+
+class BodyCaptureTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def body(self, request, mode='content_type', max_size=10):
+        return capture.body(request, mode, max_size, rq_settings.CONFIG_DEFAULTS['BODY_CONTENT_TYPES'])
+
+    def test_text_bodies_are_kept(self):
+        request = self.factory.post('/blog/', '{"a": 1}', content_type='application/json')
+        self.assertEqual(self.body(request), '{"a": 1}')
+        request = self.factory.post('/blog/', '{"a": 12345678}', content_type='application/json')
+        request.body
+        self.assertEqual(self.body(request), '{"a": 1234...')
+
+    def test_uploads_are_described(self):
+        request = self.factory.post('/blog/', {'file': StringIO('x' * 100)})
+        self.assertRegex(self.body(request), r'^<multipart/form-data, \d+ bytes>$')
+        self.assertFalse(hasattr(request, '_body'))
+        request = self.factory.post('/blog/', b'\x00' * 5, content_type='application/octet-stream')
+        self.assertEqual(self.body(request, 'truncate'), '\x00' * 5)
+
+    def test_large_unread_bodies_are_not_read(self):
+        request = self.factory.post('/blog/', 'x' * 100, content_type='text/plain')
+        self.assertEqual(self.body(request), '<text/plain, 100 bytes, not read>')
+        self.assertFalse(hasattr(request, '_body'))
+        # Read by the view already
+        request.body
+        self.assertEqual(self.body(request), 'xxxxxxxxxx...')
+
+    def test_off(self):
+        request = self.factory.post('/blog/', '{"a": 1}', content_type='application/json')
+        self.assertEqual(self.body(request, 'off'), '')
+        self.assertEqual(self.body(self.factory.get('/blog/')), '')
+
+    def test_stored_request(self):
+        with config():
+            Client().post('/blog/', 'key=value', content_type='application/x-www-form-urlencoded')
+            Client().post('/blog/', {'file': StringIO('x' * 100)})
+        self.assertEqual(
+            sorted(Request.objects.values_list('body', flat=True))[1:], ['key=value'])
+        self.assertTrue(Request.objects.filter(body__startswith='<multipart/form-data').exists())
+
+
+class TransactionRecordingTests(TransactionTestCase):
+    # Real commits and rollbacks, TestCase wraps every test in an atomic block
+
+    def record(self, **options):
+        with config(**options):
+            recorder = SqlRecorder()
+        request = RequestFactory().get('/blog/')
+        recorder.enable_instrumentation()
+        recorder.record_request(request)
+        try:
+            with transaction.atomic():
+                Author.objects.create(name='a', short_description='s', long_description='l')
+                Author.objects.count()
+            Author.objects.count()
+            try:
+                with transaction.atomic():
+                    Author.objects.create(name='b', short_description='s', long_description='l')
+                    raise ValueError
+            except ValueError:
+                pass
+        finally:
+            recorder.disable_instrumentation()
+        recorder.generate_stats(request, None)
+        recorder.record_request_end(request)
+        return recorder
+
+    def test_queries_are_grouped_by_transaction(self):
+        recorder = self.record(LONG_TRANSACTION_THRESHOLD=None)
+        # Django issues BEGIN itself on SQLite, before the block is open
+        trans_ids = [
+            query.get('trans_id') for alias, query in recorder._queries if query['raw_sql'] != 'BEGIN']
+        self.assertIsNone(trans_ids[2])
+        self.assertEqual(trans_ids[0], trans_ids[1])
+        self.assertNotEqual(trans_ids[0], trans_ids[3])
+        transactions = sorted(recorder._sql_transactions, key=lambda t: t.start_time)
+        self.assertEqual([t.outcome for t in transactions], ['commit', 'rollback'])
+        self.assertEqual([t.num_queries for t in transactions], [2, 1])
+        self.assertEqual(Author.objects.count(), 1)
+
+    def test_transactions_are_stored(self):
+        recorder = self.record(LONG_TRANSACTION_THRESHOLD=None)
+        recorder.persist()
+        rp_request = Request.objects.get()
+        self.assertEqual(rp_request.transactions.count(), 2)
+        committed = rp_request.transactions.get(outcome='commit')
+        self.assertEqual(
+            list(rp_request.queries.filter(trans_id=committed.trans_id).values_list('trans_id', flat=True)),
+            [committed.trans_id] * 2)
+        self.assertGreaterEqual(committed.duration, committed.sql_time)
+
+    def test_times_are_aware(self):
+        before = timezone.now()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            recorder = self.record(LONG_TRANSACTION_THRESHOLD=None)
+            recorder.persist()
+        committed = Transaction.objects.get(outcome='commit')
+        self.assertTrue(timezone.is_aware(committed.start_time))
+        self.assertLessEqual(before, committed.start_time)
+        self.assertLessEqual(committed.end_time, timezone.now())
+        query = SQLQuery.objects.filter(trans_id=committed.trans_id).earliest('start_time')
+        self.assertLessEqual(before, query.start_time)
+
+    def test_long_transactions_are_logged(self):
+        with self.assertLogs('repeat_queries.recorder', 'WARNING') as logs:
+            self.record(LONG_TRANSACTION_THRESHOLD=0)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('held open', logs.records[0].getMessage())
+
+
+class ProfilerTests(TestCase):
+
+    def test_collapsed_format(self):
+        counts = {'a;b': 2, 'a;c': 3}
+        text = format_collapsed(counts)
+        self.assertEqual(text, 'a;c 3\na;b 2\n')
+        self.assertEqual(parse_collapsed(text + 'garbage\n'), counts)
+        self.assertEqual(merge_collapsed([text, 'a;b 1\n']), {'a;b': 3, 'a;c': 3})
+
+    def test_sample_reads_the_stack_of_profiled_threads(self):
+        sampler = StackSampler(interval=60, max_depth=64)
+        ready, done = threading.Event(), threading.Event()
+
+        def wait_for_sample():
+            ready.set()
+            done.wait()
+
+        thread = threading.Thread(target=wait_for_sample)
+        thread.start()
+        ready.wait()
+        try:
+            with mock.patch.object(sampler, '_ensure_worker'):
+                session = sampler.start(thread.ident)
+            sampler.sample()
+            sampler.sample()
+            sampler.stop(session)
+            sampler.sample()
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(session.num_samples, 2)
+        stack, = session.counts
+        self.assertIn('repeat_queries.tests:wait_for_sample', stack.split(';'))
+        self.assertGreater(session.meta_time, 0)
+        self.assertFalse(sampler._active.is_set())
+
+    @override_settings(ROOT_URLCONF='repeat_queries.tests')
+    def test_profiled_requests_are_stored(self):
+        with config(PROFILE=True):
+            Client().get('/slow/')
+        rp_request = Request.objects.get()
+        self.assertIn('repeat_queries.tests:slow_view', rp_request.pyprofile)
+        self.assertIsNotNone(rp_request.meta_time)
+
+    def test_merge_profiles_command(self):
+        Request.objects.create(path='/a/', method='GET', view_name='a', pyprofile='x;y 2\n')
+        Request.objects.create(path='/a/', method='GET', view_name='a', pyprofile='x;y 1\nx;z 1\n')
+        Request.objects.create(path='/b/', method='GET', view_name='b', pyprofile='x;w 5\n')
+        Request.objects.create(
+            path='/a/', method='GET', view_name='a', pyprofile='x;old 5\n',
+            start_time=timezone.now() - timedelta(days=2))
+        out = StringIO()
+        call_command('merge_profiles', 'a', stdout=out)
+        self.assertEqual(out.getvalue(), 'x;y 3\nx;z 1\n')
+
+
+class QueryCaptureTests(TestCase):
+
+    def setUp(self):
+        seed_posts(5)
+
+    def test_counts_the_queries_of_the_view_only(self):
+        with config(), QueryCapture() as captured:
+            Client().get('/blog/')
+        # The posts and one author per post, none of the profiler's writes
+        self.assertEqual(captured.num_queries, 6)
+        self.assertEqual(sorted(captured.similar_counts().values()), [1, 5])
+        self.assertFalse(Request.objects.exists())
+        profile, = captured.profiles
+        self.assertEqual(profile['num_queries'], 6)
+
+    def test_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with config(), QueryCapture(max_queries=4):
+                Client().get('/blog/')
+        self.assertIn('6 queries ran, the budget is 4', str(raised.exception))
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with config(), QueryCapture(max_repeats=2):
+                Client().get('/blog/')
+        self.assertIn('5x (0 exact duplicates): SELECT', str(raised.exception))
+        with config(), QueryCapture(max_queries=6, max_repeats=5):
+            Client().get('/blog/')
+
+    def test_using(self):
+        with QueryCapture(using='other') as captured:
+            list(Post.objects.all())
+        self.assertEqual(captured.num_queries, 0)
+
+    def test_n_plus_one_fails_a_passing_test(self):
+        class ViewTest(TestCase):
+            def test_view(self):
+                Client().get('/blog/')
+
+        result = NPlusOneTestResult(StringIO(), descriptions=False, verbosity=0)
+        with recording_settings(threshold=3):
+            ViewTest('test_view').run(result)
+        failure, = result.failures
+        self.assertIn('/blog/ ran a query 3 times on \'default\'', failure[1])
+        self.assertFalse(Request.objects.exists())
+
+    def test_n_plus_one_fails_a_test_run_in_parallel(self):
+        class ViewTest(TestCase):
+            def test_view(self):
+                Client().get('/blog/')
+
+        suite = NPlusOneTestRunner(parallel=2).parallel_test_suite(unittest.TestSuite(), 2)
+        result = suite.runner_class().resultclass()
+        with recording_settings(threshold=3):
+            ViewTest('test_view').run(result)
+        # Sent back to the main process by the worker
+        (event, index, error), = [event for event in result.events if event[0] == 'addFailure']
+        self.assertIn('/blog/ ran a query 3 times', str(pickle.loads(pickle.dumps(error))[1]))
+
+    def test_duplicates_per_fingerprint(self):
+        with QueryCapture() as captured:
+            with connection.cursor() as cursor:
+                for post_id in [1, 1, 2, 2, 3]:
+                    cursor.execute('SELECT "blog_post"."id" FROM "blog_post" WHERE "blog_post"."id" = %d' % post_id)
+        # The same keys as similar_counts(), the third id ran once only
+        key, = captured.similar_counts()
+        self.assertEqual(captured.duplicate_counts(), {key: 4})
+
+
+PYTEST_MODULE = """
+import pytest
+from blog.models import Author, Post
+
+
+@pytest.fixture
+def posts(db):
+    for i in range(3):
+        author = Author.objects.create(name='a', short_description='s', long_description='l')
+        Post.objects.create(title='t', description='d', author=author)
+
+
+def test_n_plus_one(client, posts):
+    assert client.get('/blog/').status_code == 200
+
+
+def test_clean(client, db):
+    assert client.get('/blog/').status_code == 200
+"""
+
+
+@unittest.skipUnless(importlib.util.find_spec('pytest_django'), 'pytest-django is not installed')
+class PytestPluginTests(TestCase):
+
+    def test_n_plus_one_fails_the_test_call(self):
+        project = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'test_views.py'), 'w') as module:
+                module.write(PYTEST_MODULE)
+            result = subprocess.run(
+                [sys.executable, '-m', 'pytest', '-p', 'repeat_queries.pytest_plugin',
+                 '-p', 'no:cacheprovider', '--ds=smart_queries.settings',
+                 '--n-plus-one-threshold', '3', '-rA', '-W', 'ignore', directory],
+                cwd=project, env=dict(os.environ, PYTHONPATH=project),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+            )
+        self.assertRegex(result.stdout, r'FAILED \S*test_views.py::test_n_plus_one')
+        self.assertRegex(result.stdout, r'PASSED \S*test_views.py::test_clean')
+        self.assertIn("/blog/ ran a query 3 times on 'default'", result.stdout)
+        self.assertNotIn('ERROR', result.stdout)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics._registry.reset()
+
+    def test_series_over_the_cap_go_to_other(self):
+        registry = metrics.MetricsRegistry(max_series=2)
+        for view in ('a', 'b', 'c', 'd'):
+            registry.inc('repeat_queries_requests_total', (view, 'GET'))
+        totals = registry.collect()
+        self.assertEqual(totals[('repeat_queries_requests_total', ('a', 'GET'))], 1)
+        self.assertEqual(totals[('repeat_queries_requests_total', (metrics.OTHER, metrics.OTHER))], 2)
+        self.assertEqual(len(totals), 3)
+
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('repeat_queries_requests_total', ('post-"list"', 'GET'))
+        registry.observe('repeat_queries_request_queries', ('post-list', 'GET'), 6)
+        text = metrics.render(registry.collect())
+        self.assertIn('# TYPE repeat_queries_requests_total counter\n', text)
+        self.assertIn('repeat_queries_requests_total{view_name="post-\\"list\\"",method="GET"} 1\n', text)
+        self.assertIn('repeat_queries_request_queries_bucket{view_name="post-list",method="GET",le="5"} 0\n', text)
+        self.assertIn('repeat_queries_request_queries_bucket{view_name="post-list",method="GET",le="10"} 1\n', text)
+        self.assertIn('repeat_queries_request_queries_bucket{view_name="post-list",method="GET",le="+Inf"} 1\n', text)
+        self.assertIn('repeat_queries_request_queries_sum{view_name="post-list",method="GET"} 6\n', text)
+        self.assertIn('repeat_queries_request_queries_count{view_name="post-list",method="GET"} 1\n', text)
+
+    def test_shards_of_every_thread_are_added_up(self):
+        registry = metrics.MetricsRegistry()
+        release = threading.Event()
+
+        def count(times, wait):
+            for _ in range(times):
+                registry.inc('repeat_queries_requests_total', ('a', 'GET'))
+            if wait:
+                release.wait()
+
+        finished = threading.Thread(target=count, args=(3, False))
+        finished.start()
+        finished.join()
+        running = threading.Thread(target=count, args=(2, True))
+        running.start()
+        try:
+            count(1, False)
+            self.assertEqual(registry.collect()[('repeat_queries_requests_total', ('a', 'GET'))], 6)
+            # The shard of the finished thread was folded into the totals
+            self.assertEqual(len(registry._shards), 2)
+        finally:
+            release.set()
+            running.join()
+        self.assertEqual(registry.collect()[('repeat_queries_requests_total', ('a', 'GET'))], 6)
+
+    def test_shards_of_finished_threads_do_not_pile_up(self):
+        registry = metrics.MetricsRegistry()
+        for _ in range(50):
+            thread = threading.Thread(
+                target=registry.inc, args=('repeat_queries_requests_total', ('a', 'GET')))
+            thread.start()
+            thread.join()
+        # Retired when the next thread registered its shard, not by collect()
+        self.assertEqual(len(registry._shards), 1)
+        self.assertEqual(registry.collect()[('repeat_queries_requests_total', ('a', 'GET'))], 50)
+
+    def test_middleware_counts_requests(self):
+        seed_posts(3)
+        with config(SAMPLE_RATE=0):
+            Client().get('/blog/')
+        with config():
+            Client().get('/blog/')
+        totals = metrics.get_registry().collect()
+        self.assertEqual(totals[('repeat_queries_requests_total', ('post-list', 'GET'))], 2)
+        self.assertEqual(totals[('repeat_queries_sql_queries_total', ('post-list', 'GET', 'default'))], 8)
+        # Shapes are only counted for the sampled request
+        self.assertEqual(totals[('repeat_queries_similar_queries_total', ('post-list', 'GET', 'default'))], 3)
+        self.assertEqual(totals[('repeat_queries_request_queries', ('post-list', 'GET'))][-1], 2)
+        self.assertEqual(Request.objects.count(), 1)
+
+    def test_metrics_view(self):
+        metrics.get_registry().inc('repeat_queries_requests_total', ('a', 'GET'))
+        response = Client().get('/dashboard/metrics/')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn(b'repeat_queries_requests_total{view_name="a",method="GET"} 1', response.content)
+
+    def test_export_spans(self):
+        recorder = record_queries([('SELECT %s', [1]), ('SELECT %s', [2])])
+        recorder.generate_stats(None, None)
+        tracer = mock.Mock()
+        with mock.patch.object(metrics, 'get_tracer', return_value=tracer):
+            metrics.export_spans(recorder)
+        self.assertEqual(tracer.start_span.call_count, 2)
+        (name,), kwargs = tracer.start_span.call_args
+        self.assertEqual(name, 'SELECT')
+        self.assertEqual(kwargs['attributes']['db.statement'], 'SELECT %s')
+        self.assertEqual(kwargs['attributes']['repeat_queries.similar_count'], 2)
+        self.assertEqual(tracer.start_span.return_value.end.call_count, 2)
+        with mock.patch.object(metrics, 'get_tracer', return_value=None):
+            metrics.export_spans(recorder)
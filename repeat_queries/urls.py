@@ -1,6 +1,8 @@
 from django.conf.urls import url
 
-from repeat_queries.views import SQLView
+from repeat_queries.views import (
+    EndpointDashboardView, IndexAdvisorView, MetricsView, SQLQueryView, SQLView
+)
 
 urlpatterns = [
     url(
@@ -8,4 +10,24 @@ urlpatterns = [
         SQLView.as_view(),
         name='request_sql'
     ),
+    url(
+        r'^sql/(?P<query_id>\d+)/$',
+        SQLQueryView.as_view(),
+        name='sql_query'
+    ),
+    url(
+        r'^indexes/$',
+        IndexAdvisorView.as_view(),
+        name='index_advisor'
+    ),
+    url(
+        r'^endpoints/$',
+        EndpointDashboardView.as_view(),
+        name='endpoints'
+    ),
+    url(
+        r'^metrics/$',
+        MetricsView.as_view(),
+        name='metrics'
+    ),
 ]
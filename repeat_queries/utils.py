@@ -1,8 +1,104 @@
+import json
+import threading
+from functools import lru_cache
+
+import sqlparse
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six, timezone
+from django.utils.encoding import force_text
+
 
 def convert_epoch_to_datetime(epoch_time):
     from datetime import datetime
 
     epoch_in_sec = float(epoch_time)
-    date = datetime.fromtimestamp(epoch_in_sec)
+    # Aware in UTC like timezone.now(), naive local time without USE_TZ
+    if settings.USE_TZ:
+        return datetime.fromtimestamp(epoch_in_sec, tz=timezone.utc)
+    return datetime.fromtimestamp(epoch_in_sec)
+
+
+def quote_expr(element):
+    if isinstance(element, six.string_types):
+        return "'%s'" % force_text(element).replace("'", "''")
+    else:
+        return repr(element)
+
+
+def quote_params(params):
+    if not params:
+        return params
+    if isinstance(params, dict):
+        return {key: quote_expr(value) for key, value in params.items()}
+    return [quote_expr(p) for p in params]
+
+
+def interpolate_sql(sql, params, many=False):
+    """
+    Render ``sql`` with its parameters inlined, for display only. Of an
+    executemany only the first row is shown.
+    """
+    if many:
+        if not params:
+            return sql
+        params = params[0]
+    if not params:
+        return sql
+    params = quote_params(params)
+    try:
+        if isinstance(params, dict):
+            return sql % params
+        return sql % tuple(params)
+    except (TypeError, ValueError, KeyError):
+        return sql
+
+
+class ParamsEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        try:
+            return super(ParamsEncoder, self).default(o)
+        except TypeError:
+            return repr(o)
+
+
+def serialize_params(params):
+    if params is None:
+        return ''
+    return json.dumps(params, cls=ParamsEncoder)
+
+
+@lru_cache(maxsize=1024)
+def format_sql(sql):
+    """
+    Reindent ``sql`` for display, cached as reformatting is slow and the
+    ORM issues the same statements over and over.
+    """
+    return sqlparse.format(sql, reindent=True, keyword_case='upper')
+
+
+class Singleton(object):
+    """
+    The process wide instance built by ``factory``, created by the first
+    caller of get(). Creation holds a lock, so threads racing on the first
+    request share one instance instead of each starting its own workers.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self.factory()
+                instance = self._instance
+        return instance
 
-    return date
+    def reset(self):
+        with self._lock:
+            self._instance = None
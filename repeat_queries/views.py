@@ -1,26 +1,233 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.shortcuts import render
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Count, DateTimeField, DurationField, F, Sum, Value
+from django.db.models.expressions import ExpressionWrapper
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 
 from django.views.generic import View
-from repeat_queries.models import Request, SQLQuery
+from repeat_queries import metrics
+from repeat_queries.advisor import cached_suggestions
+from repeat_queries import settings as rq_settings
+from repeat_queries.models import EndpointRollup, QueryPattern, Request, SQLQuery
+from repeat_queries.utils import format_sql
+
+
+# Formatted SQL per fingerprint, so the statement of a query shape is
+# loaded and reformatted once instead of for every row showing it.
+_formatted_queries = {}
+MAX_FORMATTED_QUERIES = 2048
+
+
+def attach_formatted_queries(queries):
+    """
+    Set ``formatted`` on each query of a page, loading the SQL text of a
+    single row per fingerprint which is not cached yet.
+    """
+    samples = {}
+    for query in queries:
+        if not query.fingerprint:
+            samples[query.pk] = query
+        elif query.fingerprint not in _formatted_queries:
+            samples.setdefault(query.fingerprint, query)
+    if samples:
+        if len(_formatted_queries) > MAX_FORMATTED_QUERIES:
+            _formatted_queries.clear()
+        texts = SQLQuery.objects.filter(
+            pk__in=[query.pk for query in samples.values()]
+        ).values_list('pk', 'fingerprint', 'query')
+        for pk, fingerprint, sql in texts:
+            if fingerprint:
+                _formatted_queries[fingerprint] = format_sql(sql)
+            else:
+                samples[pk].formatted = format_sql(sql)
+    for query in queries:
+        if query.fingerprint:
+            query.formatted = _formatted_queries.get(query.fingerprint, '')
 
 
 class SQLView(View):
+    """
+    The queries of one request, a page at a time. The large traceback and
+    query columns are not loaded, see attach_formatted_queries and
+    SQLQueryView.
+    """
+    paginate_by = 100
+    max_paginate_by = 1000
 
     def get(self, request, *_, **kwargs):
         request_id = kwargs.get('request_id')
+        if not request_id:
+            raise KeyError('no profile_id or request_id')
+        rp_request = get_object_or_404(
+            Request.objects.only('id', 'path', 'method', 'start_time', 'time_taken'),
+            id=request_id,
+        )
+        query_set = SQLQuery.objects.filter(request_id=rp_request.pk)
+        totals = query_set.aggregate(num_queries=Count('id'), time_spent=Sum('duration'))
+
+        try:
+            per_page = min(int(request.GET.get('per_page', self.paginate_by)), self.max_paginate_by)
+        except ValueError:
+            per_page = self.paginate_by
+        # Only the primary keys are paginated, walking the (request,
+        # start_time) index, the rows of the page are loaded afterwards.
+        paginator = Paginator(
+            query_set.order_by('-start_time').values_list('pk', flat=True), max(per_page, 1))
+        # The total is known already, do not COUNT the rows again
+        paginator.count = totals['num_queries']
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+        queries = list(
+            SQLQuery.objects.filter(pk__in=list(page.object_list)).only(
+                'id', 'fingerprint', 'duration', 'start_time', 'stop_time',
+                'duplicate_count', 'similar_count', 'trans_id',
+            ).annotate(
+                start_time_relative=ExpressionWrapper(
+                    F('start_time') - Value(rp_request.start_time, output_field=DateTimeField()),
+                    output_field=DurationField(),
+                ),
+            ).order_by('-start_time')
+        )
+        attach_formatted_queries(queries)
+
         context = {
             'request': request,
+            'rp_request': rp_request,
+            'totals': totals,
+            'transactions': rp_request.transactions.order_by('start_time'),
+            'page': page,
+            'queries': queries,
         }
-        if request_id:
-            rp_request = Request.objects.get(id=request_id)
-            query_set = SQLQuery.objects.filter(request=rp_request).order_by('-start_time')
-            for q in query_set:
-                q.start_time_relative = q.start_time - rp_request.start_time
-            context['rp_request'] = rp_request
-            context['queries'] = query_set
-        if not request_id:
-            raise KeyError('no profile_id or request_id')
         return render(request, 'sql.html', context)
+
+
+class SQLQueryView(View):
+    """
+    A single query with its parameters and traceback.
+    """
+
+    def get(self, request, *_, **kwargs):
+        query = get_object_or_404(SQLQuery, pk=kwargs.get('query_id'))
+        context = {
+            'request': request,
+            'query': query,
+        }
+        return render(request, 'sql_query.html', context)
+
+
+class IndexAdvisorView(View):
+    """
+    The index suggestions of a database, computed at most once every
+    INDEX_ADVISOR_CACHE_SECONDS, see repeat_queries.advisor.
+    """
+    limit = 50
+    max_limit = 500
+
+    def get(self, request, *_, **kwargs):
+        using = request.GET.get('database', 'default')
+        if using not in settings.DATABASES:
+            return HttpResponseBadRequest('Unknown database %r' % using)
+        try:
+            limit = min(int(request.GET.get('limit', self.limit)), self.max_limit)
+        except ValueError:
+            limit = self.limit
+        context = {
+            'request': request,
+            'suggestions': cached_suggestions(using)[:max(limit, 1)],
+        }
+        return render(request, 'indexes.html', context)
+
+
+class MetricsView(View):
+    """
+    The metrics of this process in the Prometheus text format, each process
+    of the server keeps its own.
+    """
+
+    def get(self, request, *_, **kwargs):
+        return HttpResponse(
+            metrics.render(metrics.get_registry().collect()),
+            content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
+
+
+class EndpointDashboardView(View):
+    """
+    Latency percentiles and query counts per view over a time window, read
+    from the EndpointRollup totals, with the most repeated query shapes of
+    each view.
+    """
+    windows = OrderedDict([
+        ('1h', timedelta(hours=1)),
+        ('6h', timedelta(hours=6)),
+        ('24h', timedelta(days=1)),
+        ('7d', timedelta(days=7)),
+        ('30d', timedelta(days=30)),
+    ])
+    default_window = '24h'
+    # Windows up to this long are read from the per minute totals
+    max_minute_window = timedelta(hours=6)
+    top_repeated = 3
+
+    def get(self, request, *_, **kwargs):
+        window = request.GET.get('window')
+        if window not in self.windows:
+            window = self.default_window
+        since = timezone.now() - self.windows[window]
+        resolution = (
+            EndpointRollup.MINUTE if self.windows[window] <= self.max_minute_window
+            else EndpointRollup.HOUR
+        )
+        endpoints = EndpointRollup.objects.summary(since, resolution)
+
+        # The shapes and their totals are those of the window, kept per
+        # period by the rollups, QueryPattern only gives their SQL.
+        threshold = rq_settings.get_config()['N_PLUS_ONE_THRESHOLD'] or 2
+        for endpoint in endpoints:
+            shapes = sorted(
+                (totals, fingerprint) for fingerprint, totals in endpoint['repeated'].items()
+                if totals[0] >= threshold
+            )
+            endpoint['repeated'] = [
+                {
+                    'fingerprint': fingerprint,
+                    'max_per_request': max_per_request,
+                    'count': count,
+                    'num_requests': num_requests,
+                }
+                for (max_per_request, count, num_requests), fingerprint
+                in reversed(shapes[-self.top_repeated:])
+            ]
+        samples = QueryPattern.objects.filter(
+            view_name__in=[endpoint['view_name'] for endpoint in endpoints if endpoint['repeated']],
+            fingerprint__in={
+                shape['fingerprint'] for endpoint in endpoints for shape in endpoint['repeated']},
+        ).values_list('view_name', 'fingerprint', 'sample_query', 'suggestion')
+        samples = {
+            (view_name, fingerprint): (sample_query, suggestion)
+            for view_name, fingerprint, sample_query, suggestion in samples
+        }
+        for endpoint in endpoints:
+            for shape in endpoint['repeated']:
+                shape['sample_query'], shape['suggestion'] = samples.get(
+                    (endpoint['view_name'], shape['fingerprint']), (shape['fingerprint'], ''))
+
+        context = {
+            'request': request,
+            'windows': list(self.windows),
+            'window': window,
+            'endpoints': endpoints,
+        }
+        return render(request, 'endpoints.html', context)
@@ -0,0 +1,165 @@
+import atexit
+import collections
+import logging
+import os
+import threading
+from time import time
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections, router, transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+
+from repeat_queries import settings as rq_settings
+from repeat_queries.models import EndpointRollup, QueryPattern, Request, SQLQuery
+from repeat_queries.utils import Singleton
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseWriter(object):
+    """
+    Persists finished request profiles.
+
+    A profile is a dict with the unsaved ``request`` (a Request instance),
+    the list of its unsaved ``queries`` (SQLQuery instances), the
+    ``num_queries`` / ``sql_time`` totals of the recorder and the per
+    fingerprint ``patterns`` totals.
+    """
+
+    def write(self, profile):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def persist(self, profiles):
+        with transaction.atomic(using=router.db_for_write(SQLQuery)):
+            SQLQuery.objects.ingest(profiles)
+            QueryPattern.objects.merge(profiles)
+            if rq_settings.get_config()['STORE_ROLLUPS']:
+                EndpointRollup.objects.merge(profiles)
+        Request.garbage_collect(force=False)
+
+
+class SyncWriter(BaseWriter):
+    """
+    Stores the profile straight away, inside the response cycle.
+    """
+
+    def write(self, profile):
+        self.persist([profile])
+
+
+class MemoryWriter(BaseWriter):
+    """
+    Keeps the latest profiles in memory instead of storing them, for tests
+    and benchmarks.
+    """
+
+    def __init__(self, maxlen=None):
+        maxlen = maxlen or rq_settings.get_config()['WRITER_QUEUE_SIZE']
+        self.profiles = collections.deque(maxlen=maxlen)
+
+    def write(self, profile):
+        self.profiles.append(profile)
+
+
+class QueuedWriter(BaseWriter):
+    """
+    Hands profiles to a bounded queue drained by a background thread, which
+    stores them in batches so the request never waits on our own INSERTs.
+    """
+
+    def __init__(self, queue_size=None, flush_interval=None, batch_size=None,
+                 full_policy=None):
+        config = rq_settings.get_config()
+        self.queue_size = queue_size or config['WRITER_QUEUE_SIZE']
+        # 0 stores each profile as soon as it is queued
+        self.flush_interval = (
+            config['WRITER_FLUSH_INTERVAL'] if flush_interval is None else flush_interval)
+        self.batch_size = batch_size or config['WRITER_BATCH_SIZE']
+        self.full_policy = full_policy or config['WRITER_FULL_POLICY']
+        if self.full_policy not in ('drop', 'block'):
+            raise ValueError('WRITER_FULL_POLICY must be "drop" or "block"')
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def _ensure_worker(self):
+        # Restart the worker when we are running in a forked process
+        # (e.g. gunicorn with preload), threads do not survive a fork.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='repeat-queries-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, profile):
+        self._ensure_worker()
+        if self.full_policy == 'block':
+            self.queue.put(profile)
+            return
+        try:
+            self.queue.put_nowait(profile)
+        except queue.Full:
+            # Counted under the lock, many request threads may drop at once
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning(
+                    'Writer queue is full, %d recorded requests dropped so far', dropped)
+
+    def flush(self):
+        """
+        Block until every queued profile has been stored.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.persist(batch)
+            except Exception:
+                # A broken batch must not kill the worker, the connection
+                # may be unusable now so let django replace it.
+                logger.exception('Could not store %d recorded requests', len(batch))
+                close_old_connections()
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+_writer = Singleton(lambda: import_string(rq_settings.get_config()['WRITER'])())
+
+
+def get_writer():
+    return _writer.get()
+
+
+@receiver(setting_changed)
+def reset_writer(**kwargs):
+    if kwargs['setting'] == 'REPEAT_QUERIES':
+        _writer.reset()